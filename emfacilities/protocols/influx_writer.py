@@ -0,0 +1,171 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Batched writing of the report points to InfluxDB.
+"""
+
+import os
+import time
+
+# Number of points sent in each write request
+INFLUX_BATCH_SIZE = 5000
+# Attempts to send a batch before spooling it
+INFLUX_RETRIES = 3
+INFLUX_RETRY_DELAY = 2  # seconds, doubled after each failed attempt
+# Client errors of batches that are split to find the rejected lines
+# (bad request, e.g. a parse error or a field type conflict, and too large)
+INFLUX_SPLIT_CODES = (400, 413)
+
+
+def isRejected(error):
+    """ True if the error is the server rejecting the points (4xx), so
+    sending them again would fail again.
+    """
+    from influxdb.exceptions import InfluxDBClientError
+    return (isinstance(error, InfluxDBClientError) and error.code is not None
+            and 400 <= error.code < 500)
+
+
+class InfluxBatchWriter:
+    """ Accumulate the points of a report update encoded in line protocol
+    and send them with one write request per batchSize points.
+
+    A batch that can not be sent after retries attempts is kept, with
+    all the points after it, in a local spool file, and is sent first in
+    the next flush(), so the points are not lost if the database is
+    unreachable for a while.
+    """
+    def __init__(self, client, spoolPath, batchSize=INFLUX_BATCH_SIZE,
+                 retries=INFLUX_RETRIES, retryDelay=INFLUX_RETRY_DELAY):
+        self.client = client
+        self.spoolPath = spoolPath
+        self.batchSize = max(1, batchSize)
+        self.retries = max(1, retries)
+        self.retryDelay = retryDelay
+        self._lines = []
+
+    def __len__(self):
+        return len(self._lines)
+
+    def addPoint(self, point):
+        """ Add a point given as a dictionary with the keys measurement,
+        tags, fields and time (as in InfluxDBClient.write_points). The point
+        is encoded now, so the dictionary can be reused by the caller.
+        """
+        from influxdb.line_protocol import make_line
+        self._lines.append(make_line(point['measurement'],
+                                     tags=point.get('tags'),
+                                     fields=point.get('fields'),
+                                     time=point.get('time')))
+
+    def _readSpool(self):
+        if not os.path.exists(self.spoolPath):
+            return []
+        with open(self.spoolPath, encoding="utf-8") as f:
+            return [line for line in f.read().splitlines() if line]
+
+    def _writeSpool(self, lines):
+        if not lines:
+            if os.path.exists(self.spoolPath):
+                os.remove(self.spoolPath)
+            return
+        tmpPath = self.spoolPath + '.tmp'
+        with open(tmpPath, 'w', encoding="utf-8") as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmpPath, self.spoolPath)
+
+    def _send(self, batch):
+        """ Write a batch, retrying with an increasing delay if the server is
+        unreachable or fails. A batch rejected by the server because of its
+        points (400, 413) is not retried nor spooled, it would block all the
+        later points: it is split to send its valid lines and the rejected
+        lines are dropped. Other client errors (e.g. authentication or
+        database not found) are not retried either, but the batch is kept
+        until the configuration is fixed.
+        Return the lines that have to be spooled.
+        """
+        delay = self.retryDelay
+        for attempt in range(1, self.retries + 1):
+            try:
+                self.client.write_points(batch, protocol='line')
+                return []
+            except Exception as e:
+                if isRejected(e):
+                    return self._sendRejected(batch, e)
+                print("ERROR writing %d points to influx (attempt %d/%d): %s"
+                      % (len(batch), attempt, self.retries, e))
+                if attempt < self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+        return batch
+
+    def _sendRejected(self, batch, error):
+        """ Send the halves of a rejected batch, until the bad lines are
+        found and dropped. Return the lines not sent because of another
+        error, the ones that have to be spooled.
+        """
+        if error.code not in INFLUX_SPLIT_CODES:
+            print("ERROR: influx refused %d points, check the database and "
+                  "the user: %s" % (len(batch), error))
+            return batch
+        if len(batch) == 1:
+            print("ERROR: influx rejected the point, it is dropped: %s\n%s"
+                  % (error, batch[0]))
+            return []
+        half = len(batch) // 2
+        parts = [batch[:half], batch[half:]]
+        unsent = []
+        for i, part in enumerate(parts):
+            try:
+                self.client.write_points(part, protocol='line')
+            except Exception as e:
+                if not isRejected(e):
+                    # the server is not reachable now, send them later
+                    print("ERROR writing %d points to influx: %s"
+                          % (len(batch) - i * half, e))
+                    return unsent + [line for p in parts[i:] for line in p]
+                unsent += self._sendRejected(part, e)
+        return unsent
+
+    def flush(self):
+        """ Send the spooled and the accumulated points. Return the number of
+        points processed (sent or dropped because the server rejected them).
+        """
+        lines = self._readSpool() + self._lines
+        self._lines = []
+        sent = 0
+        kept = []
+        while sent < len(lines):
+            batch = lines[sent:sent + self.batchSize]
+            unsent = self._send(batch)
+            if unsent:
+                kept = unsent + lines[sent + len(batch):]
+                print("ERROR: %d points kept in %s. I continue"
+                      % (len(kept), self.spoolPath))
+                break
+            sent += len(batch)
+        self._writeSpool(kept)
+        return len(lines) - len(kept)
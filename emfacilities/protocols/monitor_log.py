@@ -0,0 +1,265 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Helpers shared by the monitors to store their samples in sqlite log files.
+"""
+
+import sqlite3 as lite
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# Number of buffered rows sent to sqlite in a single executemany call
+LOG_FLUSH_SIZE = 500
+# Database, in the monitor working dir, with the timing of the monitor steps
+MONITOR_TIMING_SQLITE = 'monitor_timing.sqlite'
+
+
+def connectLog(dbPath):
+    """ Open a monitor log database. The connection is in autocommit mode,
+    so transactions are explicitly handled by MonitorLogWriter, and uses
+    the WAL journal so the report readers do not block the writer.
+    The connection may be used from the MonitorScheduler threads, the
+    monitor lock serializes the access.
+    """
+    conn = lite.connect(dbPath, isolation_level=None,
+                        check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class MonitorLogWriter:
+    """ Store rows in a monitor log table using a prepared INSERT statement.
+    Rows are buffered and sent with executemany every flushSize rows. All the
+    rows appended inside a transaction() block (usually one monitor tick)
+    are committed together.
+    """
+    def __init__(self, conn, tableName, columns, flushSize=LOG_FLUSH_SIZE):
+        self.conn = conn
+        self.tableName = tableName
+        self.columns = list(columns)
+        self.flushSize = max(1, flushSize)
+        self._sql = "INSERT INTO %s(%s) VALUES(%s)" % (
+            tableName, ", ".join(self.columns),
+            ", ".join(["?"] * len(self.columns)))
+        self._rows = []
+        self._inTransaction = False
+        self.committed = False  # if the last transaction() was committed
+
+    def append(self, row):
+        """ Add a row to the buffer. The row can be a sequence with the
+        values in the same order than self.columns or a dictionary
+        with the column names as keys (missing columns are stored as NULL).
+        """
+        if isinstance(row, dict):
+            row = tuple(row.get(c) for c in self.columns)
+        self._rows.append(row)
+
+        if len(self._rows) >= self.flushSize:
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered rows. If there is no open transaction the rows
+        are committed in their own one. Return the number of written rows.
+        """
+        if not self._rows:
+            return 0
+
+        rows, self._rows = self._rows, []
+        if self._inTransaction:
+            self.conn.executemany(self._sql, rows)
+        else:
+            with self.transaction():
+                self.conn.executemany(self._sql, rows)
+        return len(rows)
+
+    @contextmanager
+    def transaction(self):
+        """ Commit all the rows appended inside the block at once. If sqlite
+        fails the rows are discarded and the monitor continues, so callers
+        must check self.committed before assuming the rows are stored.
+        """
+        self.committed = False
+        self.conn.execute("BEGIN")
+        self._inTransaction = True
+        try:
+            yield self
+            self.flush()
+            self.conn.execute("COMMIT")
+            self.committed = True
+        except lite.Error as e:
+            self.conn.execute("ROLLBACK")
+            self._rows = []
+            print("ERROR: saving data points in table %s. I continue"
+                  % self.tableName)
+            print(e)
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            self._rows = []
+            raise
+        finally:
+            self._inTransaction = False
+
+
+class MonitorLogColumns:
+    """ Cache with the columns of a monitor log table stored in NumPy arrays.
+    Each update() reads, in a single query, only the rows appended to the
+    table since the previous call and merges them into the cached arrays.
+
+    columns is a list of (key, sqlExpression, dtype) tuples. The key is used
+    to return the column and sqlExpression is what is selected from the
+    table (a column name or any sqlite expression).
+    """
+    def __init__(self, conn, tableName, columns):
+        self.conn = conn
+        self.tableName = tableName
+        self.columns = list(columns)
+        self.lastId = -1
+        self._size = 0
+        self._ids = np.empty(0, dtype=np.int64)
+        self._data = {key: np.empty(0, dtype=dtype)
+                      for key, _, dtype in self.columns}
+
+    def __len__(self):
+        return self._size
+
+    def update(self):
+        """ Read the new rows of the table. Return the number of new rows. """
+        cur = self.conn.cursor()
+        cur.row_factory = None  # plain tuples whatever the connection uses
+        cur.execute("select id, %s from %s where id > ? order by id"
+                    % (", ".join(expr for _, expr, _ in self.columns),
+                       self.tableName), (self.lastId,))
+        rows = cur.fetchall()
+        if not rows:
+            return 0
+
+        newColumns = list(zip(*rows))
+        self._ids = self._append(self._ids, newColumns[0])
+        for (key, _, _), values in zip(self.columns, newColumns[1:]):
+            self._data[key] = self._append(self._data[key], values)
+        self._size += len(rows)
+        self.lastId = int(self._ids[self._size - 1])
+        return len(rows)
+
+    def _append(self, array, values):
+        """ Append values after the first self._size elements of array,
+        growing its capacity geometrically so appends are amortized O(1).
+        """
+        newSize = self._size + len(values)
+        if newSize > len(array):
+            grown = np.empty(max(newSize, 2 * len(array)), dtype=array.dtype)
+            grown[:self._size] = array[:self._size]
+            array = grown
+        array[self._size:newSize] = values
+        return array
+
+    def getColumns(self, sinceId=None):
+        """ Return a dictionary {key: array} with the cached rows. If sinceId
+        is given only the rows with a log id greater than it are returned.
+        The arrays are views of the cache and must not be modified.
+        """
+        start = 0
+        if sinceId is not None:
+            start = int(np.searchsorted(self._ids[:self._size], sinceId,
+                                        side='right'))
+        return {key: array[start:self._size]
+                for key, array in self._data.items()}
+
+
+class MonitorTimingLog:
+    """ Store, for each run of a monitor step, its wall time, its lag
+    (how late it started with respect to its scheduled time) and the
+    number of ticks skipped because the previous step overran them.
+    It can be shared by several threads.
+    """
+    def __init__(self, dbPath):
+        self.conn = connectLog(dbPath)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS timing(
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                timestamp DATE DEFAULT (datetime('now')),
+                                name TEXT,
+                                wallTime FLOAT,
+                                lag FLOAT,
+                                skipped INTEGER)""")
+        self._writer = MonitorLogWriter(self.conn, 'timing',
+                                        ['name', 'wallTime', 'lag', 'skipped'])
+        self._lock = threading.Lock()
+
+    def record(self, name, wallTime, lag, skipped=0):
+        with self._lock:
+            with self._writer.transaction():
+                self._writer.append((name, wallTime, lag, skipped))
+
+    def getSummary(self):
+        """ Return a list with a dictionary of statistics per monitor. """
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.row_factory = None
+            cur.execute("""select name, count(*), avg(wallTime),
+                                  max(wallTime), sum(skipped > 0),
+                                  sum(skipped), avg(lag), max(lag)
+                           from timing group by name order by name""")
+            rows = cur.fetchall()
+        keys = ['name', 'runs', 'meanTime', 'maxTime', 'overruns',
+                'skipped', 'meanLag', 'maxLag']
+        return [dict(zip(keys, row)) for row in rows]
+
+
+class MonitorWatermarks:
+    """ Small key/value table with the progress of a report (e.g. the id of
+    the last row sent of each section). All the values of an update are
+    stored in a single transaction, so they are never half written.
+    """
+    def __init__(self, conn, tableName='watermarks'):
+        self.conn = conn
+        self.tableName = tableName
+        self.conn.execute("CREATE TABLE IF NOT EXISTS %s("
+                          "name TEXT PRIMARY KEY, value INTEGER)" % tableName)
+
+    def getAll(self):
+        cur = self.conn.cursor()
+        cur.row_factory = None
+        cur.execute("select name, value from %s" % self.tableName)
+        return dict(cur.fetchall())
+
+    def update(self, values):
+        """ Store the dictionary values. Return False if sqlite fails. """
+        try:
+            self.conn.execute("BEGIN")
+            self.conn.executemany("INSERT OR REPLACE INTO %s(name, value) "
+                                  "VALUES(?, ?)" % self.tableName,
+                                  [(k, int(v)) for k, v in values.items()])
+            self.conn.execute("COMMIT")
+            return True
+        except lite.Error as e:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK")
+            print("ERROR: saving %s. I continue" % self.tableName)
+            print(e)
+            return False
@@ -24,14 +24,98 @@
 # *
 # **************************************************************************
 
+import os
 import sys
 import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import pyworkflow.protocol.params as params
+from pyworkflow.protocol import getUpdatedProtocol
 
 from pwem.protocols import EMProtocol
 
 
+# Seconds a protocol read from its run.db is used without checking it again
+PROTOCOL_CACHE_TTL = 5
+
+
+def getFileKey(path):
+    """ Return (mtime, size) of path, and of its sqlite write ahead log if
+    any, to detect when it is modified. None if path does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    key = (stat.st_mtime, stat.st_size)
+    if os.path.exists(path + '-wal'):
+        walStat = os.stat(path + '-wal')
+        key += (walStat.st_mtime, walStat.st_size)
+    return key
+
+
+class ProtocolCache:
+    """ Updated protocols shared by the monitors and the reports running
+    in this process. A protocol is checked at most once every ttl seconds,
+    and read again from its run.db only if the file was modified.
+
+    The returned protocols (and their output sets) are shared, so use them
+    inside a lock(protocol) block if their sets are opened or iterated.
+    """
+    def __init__(self, ttl=PROTOCOL_CACHE_TTL):
+        self.ttl = ttl
+        self.requests = 0
+        self.reloads = 0
+        self._entries = {}  # key: [checkTime, run.db key, updated protocol]
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _getKey(prot):
+        return os.path.abspath(prot.getDbPath()), prot.getObjId()
+
+    def lock(self, prot):
+        """ Return the lock of prot. """
+        with self._lock:
+            return self._locks.setdefault(self._getKey(prot),
+                                          threading.RLock())
+
+    def get(self, prot):
+        """ Return prot updated from its run.db. """
+        key = self._getKey(prot)
+        with self.lock(prot):
+            self.requests += 1
+            entry = self._entries.get(key)
+            now = time.time()
+            if entry is not None and now - entry[0] < self.ttl:
+                return entry[2]
+            dbKey = getFileKey(key[0])
+            if entry is not None and dbKey is not None and entry[1] == dbKey:
+                entry[0] = now
+                return entry[2]
+            updatedProt = getUpdatedProtocol(prot)
+            self._entries[key] = [now, dbKey, updatedProt]
+            self.reloads += 1
+            return updatedProt
+
+    def getStatus(self, prot):
+        return self.get(prot).getStatus()
+
+    def getStats(self):
+        return {'requests': self.requests, 'reloads': self.reloads,
+                'saved': self.requests - self.reloads}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Cache shared by all the monitors of this process
+protocolCache = ProtocolCache()
+
+
 class ProtMonitor(EMProtocol):
     """ This is the base class for implementing 'Monitors', a special type
     of protocols intended to be used in the context of the Scipion-Box,
@@ -148,6 +232,11 @@ class Monitor:
         self.workingDir = kwargs['workingDir']
         self.samplingInterval = kwargs.get('samplingInterval', None)
         self.monitorTime = kwargs.get('monitorTime', None)
+        # MonitorTimingLog where the steps of loop are recorded, if any
+        self.timingLog = kwargs.get('timingLog', None)
+        # Held while the monitor data is modified or read, steps may run
+        # in a MonitorScheduler thread while the report reads the data
+        self.lock = threading.RLock()
 
         self._notifiers = []
 
@@ -170,14 +259,34 @@ class Monitor:
         pass
 
     def loop(self):
+        """ Call step every samplingInterval seconds, measured from the
+        start of the loop and not from the end of the previous step, so
+        the sampling does not drift. If a step takes longer than the
+        interval the ticks it overran are skipped.
+        """
         self.initLoop()
-        timeout = time.time() + 60. * self.monitorTime   # interval minutes from now
+        name = self.__class__.__name__
+        interval = self.samplingInterval
+        start = time.time()
+        timeout = start + 60. * self.monitorTime   # interval minutes from now
+        deadline = start
 
         while True:
+            t0 = time.time()
             finished = self.step()
-            if (time.time() > timeout) or finished:
+            now = time.time()
+            lag = t0 - deadline
+            deadline += interval
+            skipped = 0
+            if now > deadline and interval > 0:
+                skipped = int((now - deadline) // interval) + 1
+                deadline += skipped * interval
+            if self.timingLog is not None:
+                self.timingLog.record(name, now - t0, lag, skipped)
+
+            if (now > timeout) or finished:
                 break
-            time.sleep(self.samplingInterval)
+            time.sleep(max(0, deadline - now))
 
     def step(self):
         """ To be defined in subclasses. """
@@ -187,6 +296,146 @@ class Monitor:
         self._notifiers.append(notifier)
 
 
+class MonitorTask:
+    """ A function run by a MonitorScheduler every interval seconds
+    and its timing statistics.
+    """
+    def __init__(self, name, func, interval, lock=None, timingLog=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.lock = lock
+        self.timingLog = timingLog
+        self.nextTime = 0
+        self.future = None
+        self.runs = 0
+        self.skipped = 0
+        self._loggedSkipped = 0
+        self.errors = 0
+        self.totalTime = 0.
+        self.maxTime = 0.
+        self.lastTime = 0.
+
+    def run(self, scheduledTime=None):
+        """ Run the task function, holding its lock if any. Errors are
+        printed and the task will run again in the next tick.
+        """
+        t0 = time.time()
+        try:
+            if self.lock is None:
+                self.func()
+            else:
+                with self.lock:
+                    self.func()
+        except Exception:
+            self.errors += 1
+            print("An error happened in %s:" % self.name)
+            traceback.print_exc()
+        finally:
+            elapsed = time.time() - t0
+            self.runs += 1
+            self.totalTime += elapsed
+            self.maxTime = max(self.maxTime, elapsed)
+            self.lastTime = elapsed
+            if self.timingLog is not None:
+                skipped = self.skipped - self._loggedSkipped
+                self._loggedSkipped = self.skipped
+                lag = 0 if scheduledTime is None else t0 - scheduledTime
+                self.timingLog.record(self.name, elapsed, lag, skipped)
+
+    def getStats(self):
+        return {'runs': self.runs,
+                'skipped': self.skipped,
+                'errors': self.errors,
+                'total': self.totalTime,
+                'mean': self.totalTime / self.runs if self.runs else 0.,
+                'max': self.maxTime,
+                'last': self.lastTime}
+
+
+class MonitorScheduler:
+    """ Run several tasks (usually the steps of monitors and reports)
+    in a thread pool, each one with its own interval. Ticks are scheduled
+    at fixed times from the start, so they do not drift. A task is never
+    started while its previous run is still going on, the ticks due in
+    the meantime are skipped, so a slow task (e.g. the report with the
+    thumbnails) neither piles up work nor delays the others.
+    """
+    # Seconds between the timing statistics printed in the log
+    STATS_INTERVAL = 600
+
+    def __init__(self, monitorTime=None, timingLog=None):
+        self.monitorTime = monitorTime
+        self.timingLog = timingLog
+        self.tasks = []
+
+    def addTask(self, name, func, interval, lock=None):
+        task = MonitorTask(name, func, interval, lock, self.timingLog)
+        self.tasks.append(task)
+        return task
+
+    def run(self, isFinished):
+        """ Run the tasks until isFinished() returns True or monitorTime
+        minutes have passed. Runs in progress are waited for.
+        """
+        start = time.time()
+        timeout = None if self.monitorTime is None \
+            else start + 60. * self.monitorTime
+        nextStats = start + self.STATS_INTERVAL
+        for task in self.tasks:
+            task.nextTime = start
+
+        # one thread per task, so all of them can run at the same time
+        with ThreadPoolExecutor(max_workers=max(1, len(self.tasks)),
+                                thread_name_prefix='monitor') as executor:
+            while not isFinished():
+                now = time.time()
+                if timeout is not None and now > timeout:
+                    break
+
+                for task in self.tasks:
+                    if now < task.nextTime:
+                        continue
+                    # ticks that were completely missed
+                    missed = 0
+                    if task.interval > 0:
+                        missed = int((now - task.nextTime) // task.interval)
+                    scheduledTime = task.nextTime + missed * task.interval
+                    if task.future is not None and not task.future.done():
+                        task.skipped += missed + 1
+                    else:
+                        task.skipped += missed
+                        task.future = executor.submit(task.run, scheduledTime)
+                    task.nextTime = scheduledTime + task.interval
+
+                if now > nextStats:
+                    self.printStats()
+                    nextStats = now + self.STATS_INTERVAL
+
+                # wake up at the next tick or when a task finishes
+                running = [t.future for t in self.tasks
+                           if t.future is not None and not t.future.done()]
+                delay = max(0, min((t.nextTime for t in self.tasks),
+                                   default=now + 1) - now)
+                if running:
+                    wait(running, timeout=delay, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(delay)
+
+        self.printStats()
+
+    def printStats(self):
+        for task in self.tasks:
+            print("%(name)s: %(runs)d runs, %(skipped)d skipped, "
+                  "%(errors)d errors, mean %(mean).2f s, max %(max).2f s, "
+                  "last %(last).2f s"
+                  % dict(task.getStats(), name=task.name))
+        print("Protocols: %(requests)d requests, %(reloads)d read from "
+              "their run.db, %(saved)d reloads saved"
+              % protocolCache.getStats())
+        sys.stdout.flush()
+
+
 class EmailNotifier:
     def __init__(self, smtpServer, emailFrom, emailTo):
         self._smtpServer = smtpServer
@@ -27,7 +27,6 @@
 import os
 import sys
 from math import isinf
-import sqlite3 as lite
 import datetime
 import math
 import pytz
@@ -35,15 +34,32 @@ from configparser import ConfigParser
 import pyworkflow.protocol.params as params
 from pyworkflow import VERSION_1_1
 from pyworkflow.protocol.constants import STATUS_RUNNING
-from pyworkflow.protocol import getUpdatedProtocol
 
-from .protocol_monitor import ProtMonitor, Monitor
+from .protocol_monitor import ProtMonitor, Monitor, protocolCache
+from .monitor_log import (connectLog, MonitorLogWriter, MonitorLogColumns,
+                          LOG_FLUSH_SIZE)
 
 PHASE_SHIFT = 'phaseShift'
 TIME_STAMP = 'timeStamp'
 DEFOCUS_U = 'defocusU'
 RESOLUTION = 'resolution'
 CTF_LOG_SQLITE = 'ctf_log.sqlite'
+CTF_LOG_COLUMNS = ['timestamp', 'ctfID', 'defocusU', 'defocusV', 'defocus',
+                   'astigmatism', 'ratio', 'resolution', 'fitQuality',
+                   'phaseShift', 'micPath', 'psdPath', 'shiftPlotPath']
+# Columns returned by MonitorCTF.getDataHtml as (key, sql expression, dtype)
+CTF_HTML_COLUMNS = [(DEFOCUS_U, 'defocusU', float),
+                    ('defocusV', 'defocusV', float),
+                    ('astigmatism', 'astigmatism', float),
+                    ('ratio', 'ratio', float),
+                    ('idValues', 'ctfID', int),
+                    (RESOLUTION, 'resolution', float),
+                    ('fitQuality', 'fitQuality', float),
+                    (PHASE_SHIFT, 'phaseShift', float),
+                    ('imgMicPath', 'micPath', object),
+                    ('imgPsdPath', 'psdPath', object),
+                    ('imgShiftPath', 'shiftPlotPath', object),
+                    (TIME_STAMP, "strftime('%s', timestamp) * 1000", float)]
 
 
 class ProtMonitorCTF(ProtMonitor):
@@ -126,10 +142,16 @@ class MonitorCTF(Monitor):
         self.astigmatism = kwargs['astigmatism']
         self._dataBase = kwargs.get('dbName', CTF_LOG_SQLITE)
         self._tableName = kwargs.get('tableName', 'log')
-        self.readCTFs = set()
-
-        self.conn = lite.connect(os.path.join(self.workingDir, self._dataBase),
-                                 isolation_level=None)
+        # Highest CTF id already stored in the log, only newer ids are read
+        self.lastCtfId = 0
+
+        self.conn = connectLog(os.path.join(self.workingDir, self._dataBase))
+        self._logWriter = MonitorLogWriter(self.conn, self._tableName,
+                                           CTF_LOG_COLUMNS,
+                                           kwargs.get('flushSize',
+                                                      LOG_FLUSH_SIZE))
+        self._logColumns = MonitorLogColumns(self.conn, self._tableName,
+                                             CTF_HTML_COLUMNS)
         self.influx = influx
         if self.influx:
             # get results as a list of dictionaries
@@ -152,109 +174,120 @@ class MonitorCTF(Monitor):
 
     def initLoop(self):
         self._createTable()
+        self.lastCtfId = self._getLastCtfId()
+
+    def _getLastCtfId(self):
+        """ Return the highest ctfID stored in the log table. The log acts
+        as the persistent watermark, so a restarted monitor resumes from
+        there instead of reading again the whole CTF set.
+        """
+        cur = self.conn.cursor()
+        cur.row_factory = None  # plain tuples even in influx mode
+        cur.execute("select max(ctfID) from %s" % self._tableName)
+        lastId = cur.fetchone()[0]
+        return 0 if lastId is None else lastId
 
     def step(self):
-        prot = getUpdatedProtocol(self.protocol)
-        # Create set of processed CTF from CTF protocol
-        if hasattr(prot, 'outputCTF'):
-            CTFset = prot.outputCTF.getIdSet()
-        else:
-            return False
-        # find difference
+        with protocolCache.lock(self.protocol):
+            prot = protocolCache.get(self.protocol)
+            # Read the new CTFs produced by the CTF protocol
+            if hasattr(prot, 'outputCTF'):
+                self.ingestCTFs(prot.outputCTF)
+            else:
+                return False
+            # Finish when protocol is not longer running
+            return prot.getStatus() != STATUS_RUNNING
+
+    def ingestCTFs(self, setOfCTFs):
+        """ Store in the log the CTFs of setOfCTFs with an id greater than
+        self.lastCtfId. The new items are read in a single ordered pass
+        over the set, so the cost only depends on the number of new CTFs.
+        Return the number of CTFs read.
+        """
         sys.stdout.flush()
-        diffSet = CTFset - self.readCTFs
-        setOfCTFs = prot.outputCTF
         astigmatism = self.astigmatism
-
-        for ctfID in diffSet:
-            ctf = setOfCTFs[ctfID]
-            defocusU = ctf.getDefocusU()
-            defocusV = ctf.getDefocusV()
-
-            # Defocus angle
-            defocusAngle = ctf.getDefocusAngle()
-            if defocusAngle > 360 or defocusAngle < -360:
-                defocusAngle = 0
-
-            # Astigmatism
-            astig = abs(defocusU - defocusV)
-
-            # Resolution
-            resolution = ctf.getResolution()
-            if isinf(resolution):
-                resolution = 0.
+        newCTFs = 0
+        lastCtfId = self.lastCtfId
+
+        # All the CTFs of this tick are stored in a single transaction
+        with self._logWriter.transaction():
+            for ctf in setOfCTFs.iterItems(orderBy='id',
+                                           where='id > %d' % self.lastCtfId):
+                ctfID = ctf.getObjId()
+                defocusU = ctf.getDefocusU()
+                defocusV = ctf.getDefocusV()
+
+                # Defocus angle
+                defocusAngle = ctf.getDefocusAngle()
+                if defocusAngle > 360 or defocusAngle < -360:
+                    defocusAngle = 0
+
+                # Astigmatism
+                astig = abs(defocusU - defocusV)
+
+                # Resolution
+                resolution = ctf.getResolution()
+                if isinf(resolution):
+                    resolution = 0.
             
-            # Fit quality
-            fitQuality = ctf.getFitQuality()
-            if fitQuality is None or isinf(fitQuality): 
-                fitQuality = 0.
-
-            # PhaseShift
-            phaseShift = ctf.getPhaseShift() if ctf.hasPhaseShift() else 0.
-
-            psdPath = os.path.abspath(ctf.getPsdFile())
-            micPath = os.path.abspath(ctf.getMicrograph().getFileName())
-            shiftPlot = (getattr(ctf.getMicrograph(), 'plotCart', None)
-                         or getattr(ctf.getMicrograph(), 'plotGlobal', None))
-            if shiftPlot is not None:
-                shiftPlotPath = os.path.abspath(shiftPlot.getFileName())
-            else:
-                shiftPlotPath = ""
-
-            if defocusU < defocusV:
-                aux = defocusV
-                defocusV = defocusU
-                defocusU = aux
-                # TODO: check if this is always true
-                defocusAngle = 180. - defocusAngle
-                print("ERROR: defocusU should be greater than defocusV")
-
-            ctfCreationTime = ctf.getObjCreation()
-
-            # get CTFs with this ids a fill table
-            # do not forget to compute astigmatism
-            defocus = math.sqrt(defocusV*defocusV + defocusU * defocusU)
-            sql = """INSERT INTO %s(timestamp
-                                    , ctfID
-                                    , defocusU
-                                    , defocusV
-                                    , defocus
-                                    , astigmatism
-                                    , ratio
-                                    , resolution
-                                    , fitQuality
-                                    , phaseShift
-                                    , micPath
-                                    , psdPath
-                                    , shiftPlotPath)
-                     VALUES("%s",%d,%f,%f,%f,%f,%f,%f,%f,%f,"%s","%s","%s");""" %\
-                  (self._tableName, ctfCreationTime, ctfID, defocusU,
-                   defocusV, defocus, astig, defocusU / defocusV, resolution,
-                   fitQuality, phaseShift,  micPath, psdPath, shiftPlotPath)
-            try:
-                self.cur.execute(sql)
-            except Exception as e:
-                print("ERROR: saving one data point (CTF monitor). I continue")
-                print(e)
-                print(sql)
-
-            if abs(defocusU - defocusV) > astigmatism:
-                self.warning("Astigmatism (defocusU - defocusV)  = %f."
-                             % abs(defocusU - defocusV))
-
-            if defocusU > self.maxDefocus:
-                self.warning("DefocusU (%f) is larger than defocus "
-                             "maximum (%f)" % (defocusU, self.maxDefocus))
-                self.maxDefocus = defocusU
-
-            if defocusV < self.minDefocus:
-                self.warning("DefocusV (%f) is smaller than defocus "
-                             "minumum (%f)" % (defocusV, self.maxDefocus))
-                self.minDefocus = defocusV
-
-        self.readCTFs.update(diffSet)
-        # Finish when protocol is not longer running
-        return prot.getStatus() != STATUS_RUNNING
+                # Fit quality
+                fitQuality = ctf.getFitQuality()
+                if fitQuality is None or isinf(fitQuality): 
+                    fitQuality = 0.
+
+                # PhaseShift
+                phaseShift = ctf.getPhaseShift() if ctf.hasPhaseShift() else 0.
+
+                psdPath = os.path.abspath(ctf.getPsdFile())
+                micPath = os.path.abspath(ctf.getMicrograph().getFileName())
+                shiftPlot = (getattr(ctf.getMicrograph(), 'plotCart', None)
+                             or getattr(ctf.getMicrograph(), 'plotGlobal', None))
+                if shiftPlot is not None:
+                    shiftPlotPath = os.path.abspath(shiftPlot.getFileName())
+                else:
+                    shiftPlotPath = ""
+
+                if defocusU < defocusV:
+                    aux = defocusV
+                    defocusV = defocusU
+                    defocusU = aux
+                    # TODO: check if this is always true
+                    defocusAngle = 180. - defocusAngle
+                    print("ERROR: defocusU should be greater than defocusV")
+
+                ctfCreationTime = ctf.getObjCreation()
+
+                # get CTFs with this ids a fill table
+                # do not forget to compute astigmatism
+                defocus = math.sqrt(defocusV*defocusV + defocusU * defocusU)
+                self._logWriter.append((ctfCreationTime, ctfID, defocusU,
+                                        defocusV, defocus, astig,
+                                        defocusU / defocusV, resolution,
+                                        fitQuality, phaseShift, micPath,
+                                        psdPath, shiftPlotPath))
+
+                if abs(defocusU - defocusV) > astigmatism:
+                    self.warning("Astigmatism (defocusU - defocusV)  = %f."
+                                 % abs(defocusU - defocusV))
+
+                if defocusU > self.maxDefocus:
+                    self.warning("DefocusU (%f) is larger than defocus "
+                                 "maximum (%f)" % (defocusU, self.maxDefocus))
+                    self.maxDefocus = defocusU
+
+                if defocusV < self.minDefocus:
+                    self.warning("DefocusV (%f) is smaller than defocus "
+                                 "minumum (%f)" % (defocusV, self.maxDefocus))
+                    self.minDefocus = defocusV
+
+                lastCtfId = ctfID
+                newCTFs += 1
+
+        # only move past the CTFs once they are stored
+        if not self._logWriter.committed:
+            return 0
+        self.lastCtfId = lastCtfId
+        return newCTFs
 
     def _createTable(self):
         self.cur.execute("""CREATE TABLE IF NOT EXISTS  %s(
@@ -315,39 +348,16 @@ class MonitorCTF(Monitor):
 
         return listOfDictionaries
 
-    def getDataHtml(self):
-        """Fill a dictionary for each label in self.labeldisk.
-        The key is the label name. The value a list with
-        data read from the database"""
-        def get(name):
-            try:
-                self.cur.execute("select %s from %s" % (name, self._tableName))
-            except Exception as e:
-                print("MonitorCTF, ERROR reading data from db: %s" %
-                      os.path.join(self.workingDir, self._dataBase))
-            return [r[0] for r in self.cur.fetchall()]
-
-        # TODO: this multiple calls to get may raise a
-        # race condition. That is data may be added to the DB
-        # between two get call and therefore the lengths of
-        # the list can be different. IT would be better to do a single
-        # call to the database and retrieve all at the same time
-        # see getDataInflux for details
-        data = {
-            DEFOCUS_U: get('defocusU'),
-            'defocusV': get('defocusV'),
-            'astigmatism': get('astigmatism'),
-            'ratio': get('ratio'),
-            'idValues': get('ctfID'),
-            RESOLUTION: get('resolution'),
-            'fitQuality': get('fitQuality'),
-            PHASE_SHIFT: get('phaseShift'),
-            'imgMicPath': get('micPath'),
-            'imgPsdPath': get('psdPath'),
-            'imgShiftPath': get('shiftPlotPath'),
-            TIME_STAMP: get("strftime('%s', timestamp) * 1000")
-         }
-        # conn.close()
-        return data
-
-
+    def getDataHtml(self, sinceId=None):
+        """Return a dictionary with the columns of the log table used by the
+        html report and the viewer. The key is the label name and the value
+        a NumPy array with the data. All the columns are read in a single
+        query and only the rows appended since the previous call are read
+        from the database. If sinceId is given, only the rows with a log id
+        greater than sinceId are returned."""
+        try:
+            self._logColumns.update()
+        except Exception as e:
+            print("MonitorCTF, ERROR reading data from db: %s" %
+                  os.path.join(self.workingDir, self._dataBase))
+        return self._logColumns.getColumns(sinceId)
@@ -26,11 +26,16 @@
 
 import os
 
+import numpy as np
+
 import pyworkflow.protocol.params as params
 from pyworkflow.protocol.constants import STATUS_RUNNING
 from pyworkflow import VERSION_1_1
 
-from .protocol_monitor import ProtMonitor, Monitor
+from .protocol_monitor import ProtMonitor, Monitor, protocolCache
+
+MOVIE_GAIN_SUMMARY = "summaryForMonitor.txt"
+MOVIE_GAIN_WARNINGS = "warningsMonitor.txt"
 
 
 class ProtMonitorMovieGain(ProtMonitor):
@@ -103,7 +108,7 @@ class ProtMonitorMovieGain(ProtMonitor):
 
     def _summary(self):
         prot = self.inputProtocol.get()
-        fnWarning = prot._getPath("warningsMonitor.txt")
+        fnWarning = prot._getPath(MOVIE_GAIN_WARNINGS)
         if not os.path.exists(fnWarning):
             summary = ["Monitor movie gain, no warnings yet."]
         else:
@@ -130,6 +135,7 @@ class MonitorMovieGain(Monitor):
         self.ratio1Value = kwargs['ratio1Value']
         self.ratio2Value = kwargs['ratio2Value']
         self.influx = influx
+        self._reader = None
 
     def warning(self, msg):
         self.notify("Scipion Movie Gain Monitor WARNING", msg)
@@ -137,47 +143,49 @@ class MonitorMovieGain(Monitor):
     def initLoop(self):
         pass
 
+    def _getReader(self):
+        if self._reader is None:
+            self._reader = MovieGainReader(
+                self.protocol._getPath(MOVIE_GAIN_SUMMARY))
+        return self._reader
+
     def step(self):
         prot = self.protocol
-        fnSummary = prot._getPath("summaryForMonitor.txt")
-        fnWarning = prot._getPath("warningsMonitor.txt")
-        if not os.path.exists(fnSummary) or os.path.getsize(fnSummary) < 1:
+        first, last = self._getReader().update()
+        if last == 0:
             return False
-        fhSummary = open(fnSummary, "r")
-        if not os.path.exists(fnWarning):
-            fhWarning = open(fnWarning, "w")
-        else:
-            fhWarning = open(fnWarning, "a")
-
-        line = fhSummary.readlines()[-1]
-        stddev, perc25, perc975, maxVal = map(float, line.split()[1:])
-        movie_name = map(str, line.split()[0])
-        values = line.split()
-
-        if float(values[1]) > self.stddevValue:
-            self.warning("Residual gain standard deviation is %f."
-                         % stddev)
-            fhWarning.write("%s: Residual gain standard deviation is %f.\n"
-                            % (movie_name, stddev))
-
-        if (perc975 / perc25) > self.ratio1Value:
-            self.warning("The ratio between the 97.5 and 2.5 "
-                         "percentiles is %f."
-                         % (perc975 / perc25))
-            fhWarning.write("%s: The ratio between the 97.5 and 2.5 "
-                            "percentiles is %f.\n"
-                            % (movie_name, (perc975 / perc25)))
-
-        if (maxVal / perc975) > self.ratio2Value:
-            self.warning("The ratio between the maximum gain value "
-                         "and the 97.5 percentile is %f."
-                         % (maxVal / perc975))
-            fhWarning.write("%s: The ratio between the maximum gain value "
-                            "and the 97.5 percentile is %f.\n"
-                            % (movie_name, (maxVal / perc975)))
-        fhSummary.close()
-        fhWarning.close()
-        return prot.getStatus() != STATUS_RUNNING
+        if last > first:
+            self.checkMovies(first, last)
+        return protocolCache.getStatus(prot) != STATUS_RUNNING
+
+    def checkMovies(self, first, last):
+        """ Check the values of the movies read in [first, last). All the
+        warnings are written to the warnings file and notified together.
+        """
+        reader = self._getReader()
+        names = reader.names[first:last]
+        stddev, ratio1, ratio2 = [reader.getColumn(k)[first:last]
+                                  for k in ['stddev', 'ratio1', 'ratio2']]
+        messages = []
+        # values not defined (nan or inf) are not checked
+        stddev, ratio1, ratio2 = [np.where(np.isfinite(v), v, -np.inf)
+                                  for v in (stddev, ratio1, ratio2)]
+        for i in np.flatnonzero(stddev > self.stddevValue):
+            messages.append("%s: Residual gain standard deviation is %f."
+                            % (names[i], stddev[i]))
+        for i in np.flatnonzero(ratio1 > self.ratio1Value):
+            messages.append("%s: The ratio between the 97.5 and 2.5 "
+                            "percentiles is %f." % (names[i], ratio1[i]))
+        for i in np.flatnonzero(ratio2 > self.ratio2Value):
+            messages.append("%s: The ratio between the maximum gain value "
+                            "and the 97.5 percentile is %f."
+                            % (names[i], ratio2[i]))
+        if messages:
+            fnWarning = self.protocol._getPath(MOVIE_GAIN_WARNINGS)
+            with open(fnWarning, "a") as fhWarning:
+                fhWarning.write("\n".join(messages) + "\n")
+            self.warning("\n".join(messages))
+        return messages
 
     def getData(self, lastId=-1):
         if self.influx:
@@ -188,50 +196,114 @@ class MonitorMovieGain(Monitor):
 
     def getDataInflux(self, lastId=None):
         """retuen data as a list of dictionaries"""
-        prot = self.protocol
-        fnSummary = prot._getPath("summaryForMonitor.txt")
+        reader = self._getReader()
+        reader.update()
+        # idx start in 1, as in other protocols
+        first = max(0, lastId or 0)
         data = []
-        if not os.path.exists(fnSummary) < 1:
-            fhSummary = open(fnSummary, "r")
-            for idx, line in enumerate(fhSummary.readlines(), 1):  # star idx in 1
-                                             # in other protocols index start in 1
-                idx = int(idx)
-                if idx > lastId:  # where id > last_id
-                    row={}
-                    stddev, perc25, perc975, maxVal = map(float, line.split()[1:])
-                    row['idx'] = idx
-                    row['stddev'] = stddev
-                    row['ratio1'] = perc975 / perc25
-                    row['ratio2'] = maxVal / perc975
-                    data.append(row)
-            fhSummary.close()
+        columns = [reader.getColumn(k)[first:]
+                   for k in ['stddev', 'ratio1', 'ratio2']]
+        for idx, stddev, ratio1, ratio2 in zip(range(first + 1, len(reader) + 1),
+                                               *columns):
+            # influx can not store nan or inf, those fields are skipped
+            point = {'idx': idx}
+            for key, value in [('stddev', stddev), ('ratio1', ratio1),
+                               ('ratio2', ratio2)]:
+                if np.isfinite(value):
+                    point[key] = float(value)
+            data.append(point)
         # movie_000001: 0.016680 0.976350 1.028174 17.423561
         return data
 
-
     def getDataHtml(self):
-        idValues = []
-        stddevValues = []
-        ratio1Values = []
-        ratio2Values = []
-
-        prot = self.protocol
-        fnSummary = prot._getPath("summaryForMonitor.txt")
-        if not os.path.exists(fnSummary) < 1:
-            fhSummary = open(fnSummary, "r")
-            for idx, line in enumerate(fhSummary.readlines()):
-                stddev, perc25, perc975, maxVal = map(float, line.split()[1:])
-                idValues.append(idx)
-                stddevValues.append(stddev)
-                ratio1Values.append(perc975 / perc25)
-                ratio2Values.append(maxVal / perc975)
-            fhSummary.close()
-
+        reader = self._getReader()
+        reader.update()
         data = {
-            'idValues': idValues,
-            'standard_deviation': stddevValues,
-            'ratio1': ratio1Values,
-            'ratio2': ratio2Values
+            'idValues': np.arange(len(reader)),
+            'standard_deviation': reader.getColumn('stddev'),
+            'ratio1': reader.getColumn('ratio1'),
+            'ratio2': reader.getColumn('ratio2')
         }
         return data
 
+
+class MovieGainReader:
+    """ Follow the summary file of a movie gain protocol, with a line
+    per movie:  movie_000001: stddev perc25 perc975 max
+
+    update() only parses the lines appended since the previous call (it
+    remembers the file offset) and keeps the values, and the ratios
+    ratio1 = perc975 / perc25 and ratio2 = maxVal / perc975, in NumPy arrays.
+    The ratios with a zero percentile are stored as nan.
+    """
+    FILE_COLUMNS = ['stddev', 'perc25', 'perc975', 'maxVal']
+    COLUMNS = FILE_COLUMNS + ['ratio1', 'ratio2']
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.names = []
+        self._size = 0
+        self._data = np.empty((0, len(self.COLUMNS)))
+
+    def __len__(self):
+        return self._size
+
+    def reset(self):
+        self.offset = 0
+        self.names = []
+        self._size = 0
+
+    def update(self):
+        """ Read the new complete lines. Return (first, last), the range of
+        the rows read.
+        """
+        first = self._size
+        if not os.path.exists(self.path):
+            return first, first
+        if os.path.getsize(self.path) < self.offset:
+            self.reset()  # the file was created again
+            first = 0
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        # a line still being written is read in the next update
+        end = chunk.rfind(b'\n') + 1
+        if end == 0:
+            return first, first
+        self.offset += end
+
+        names, rows = [], []
+        for line in chunk[:end].decode().splitlines():
+            values = line.split()
+            if len(values) != len(self.FILE_COLUMNS) + 1:
+                continue
+            try:
+                rows.append([float(v) for v in values[1:]])
+            except ValueError:
+                continue
+            names.append(values[0].rstrip(':'))
+        self._append(names, rows)
+        return first, self._size
+
+    def _append(self, names, rows):
+        newSize = self._size + len(rows)
+        if newSize > len(self._data):
+            grown = np.empty((max(newSize, 2 * len(self._data)),
+                              len(self.COLUMNS)))
+            grown[:self._size] = self._data[:self._size]
+            self._data = grown
+        if rows:
+            new = self._data[self._size:newSize]
+            new[:, :len(self.FILE_COLUMNS)] = rows
+            # a ratio with a zero percentile is not defined: nan
+            for col, num, den in [(4, 2, 1), (5, 3, 2)]:
+                new[:, col] = np.nan
+                np.divide(new[:, num], new[:, den], out=new[:, col],
+                          where=new[:, den] != 0)
+        self.names.extend(names)
+        self._size = newSize
+
+    def getColumn(self, key):
+        """ Return a view of a column of the rows read. """
+        return self._data[:self._size, self.COLUMNS.index(key)]
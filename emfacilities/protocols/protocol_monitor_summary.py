@@ -36,7 +36,10 @@ import subprocess
 
 from .report_influx import ReportInflux
 from .report_html import ReportHtml
-from .protocol_monitor import ProtMonitor, Monitor
+from .report_publisher import isPublishTarget, checkPublishTarget
+from .protocol_monitor import (ProtMonitor, MonitorScheduler, protocolCache,
+                               PROTOCOL_CACHE_TTL)
+from .monitor_log import MonitorTimingLog, MONITOR_TIMING_SQLITE
 from .protocol_monitor_ctf import MonitorCTF
 from .protocol_monitor_movie_gain import MonitorMovieGain
 from .protocol_monitor_system import MonitorSystem
@@ -108,6 +111,15 @@ class ProtMonitorSummary(ProtMonitor):
                       label="Raise Alarm if Swap > XX%",
                       help="Raise alarm if swap allocated is greater "
                            "than given percentage")
+        form.addParam('sampleInterval', params.FloatParam, default=0.5,
+                      label="Usage sampling interval (sec)",
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Cpu, memory and gpu usage are read every "
+                           "*sampleInterval* seconds in the background and "
+                           "the mean, min, max and 95th percentile of the "
+                           "readings are logged with each sample, so short "
+                           "peaks are not missed. Set it to 0 to read them "
+                           "only once per sample")
 
         group = form.addGroup('GPU')
         group.addParam('doGpu', params.BooleanParam, default=False,
@@ -126,12 +138,22 @@ class ProtMonitorSummary(ProtMonitor):
                        default=1,  # usually 0 is the loopback
                        label="Interface", condition='doNetwork',
                        help="Name of the network interface to be checked")
+        group.addParam('perNic', params.BooleanParam, default=False,
+                       label="Check all interfaces", condition='doNetwork',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       help="Besides the selected interface, log the "
+                            "traffic of every network interface")
 
         group = form.addGroup('Disk')
         group.addParam('doDiskIO', params.BooleanParam, default=False,
                        label="Check Disk IO",
                        help="Set to true if you want to monitor the Disk "
                             "Acces")
+        group.addParam('perDisk', params.BooleanParam, default=False,
+                       label="Check each disk", condition='doDiskIO',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       help="Besides the total disk access, log the "
+                            "access to every disk")
 
         form.addSection('Mail settings')
         ProtMonitor._sendMailParams(self, form)
@@ -149,7 +171,34 @@ class ProtMonitorSummary(ProtMonitor):
                            "that will be replaced with the report folder. "
                            "For example: \n"
                            "rsync -avL %(REPORT_FOLDER)s "
-                           "scipion@webserver:public_html/")
+                           "scipion@webserver:public_html/\n"
+                           "It can also be a target where the report "
+                           "sends only the files that changed: "
+                           "file:///path/to/folder or "
+                           "sftp://user@host/path (using ~/.ssh/id_rsa, "
+                           "add ?key=keyFile to use another key)")
+        form.addParam('reportInterval', params.IntParam, default=0,
+                      label="Report interval (sec)",
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Generate the report each *reportInterval* "
+                           "seconds. The monitors keep taking samples each "
+                           "*samplingInterval* seconds while the report is "
+                           "generated. 0 means use the sampling interval")
+        form.addParam('thumbsWorkers', params.IntParam, default=2,
+                      label="Thumbnail processes",
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Number of processes creating the thumbnails "
+                           "of the report in the background")
+        form.addParam('thumbsWidth', params.IntParam, default=512,
+                      label="Thumbnail width (px)",
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Micrographs and PSDs are binned to be about "
+                           "this width in the report thumbnails")
+        form.addParam('transferChannels', params.IntParam, default=4,
+                      label="SFTP channels", condition='doInflux',
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Number of images uploaded at the same time to "
+                           "the web server of the grafana/influx report")
 
     # --------------------------- INSERT steps functions ---------------------
     def _insertAllSteps(self):
@@ -164,47 +213,56 @@ class ProtMonitorSummary(ProtMonitor):
         reportHtml = self.createHtmlReport(ctfMonitor, sysMonitor,
                                            movieGainMonitor)
 
-        monitor = Monitor(workingDir=self.workingDir.get(),
-                          samplingInterval=self.samplingInterval.get(),
-                          monitorTime=self.monitorTime.get())
-
-        def initAll():
-            if ctfMonitor is not None:
-                ctfMonitor.initLoop()
-            if movieGainMonitor is not None:
-                movieGainMonitor.initLoop()
-            sysMonitor.initLoop()
-
-        def stepAll():
-            finished = False
-            try:
-                if ctfMonitor is not None:
-                    # Call ctf monitor step
-                    ctfMonitor.step()
-
-                if movieGainMonitor is not None:
-                    # Call movie gain step
-                    movieGainMonitor.step()
-
-                # sysmonitor watches all input protocols so
-                # when sysmonitor done all protocols done
-                sysMonitorFinished = sysMonitor.step()
-                htmlFinished = reportHtml.generate(finished)
-                if sysMonitorFinished and htmlFinished:
-                    finished = True
-                    reportHtml.generate(finished)
-
-            except Exception as ex:
-                print("An error happened:")
-                import traceback
-                traceback.print_exc()
-
-            return finished
-
-        monitor.initLoop = initAll
-        monitor.step = stepAll
-
-        monitor.loop()
+        samplingInterval = self.samplingInterval.get()
+        # the monitors and the report read each protocol once per tick
+        protocolCache.ttl = min(PROTOCOL_CACHE_TTL, samplingInterval / 2.)
+        timingLog = MonitorTimingLog(self._getPath(MONITOR_TIMING_SQLITE))
+        scheduler = MonitorScheduler(monitorTime=self.monitorTime.get(),
+                                     timingLog=timingLog)
+        # each monitor in its own thread, so a slow one (or the report)
+        # does not delay the others
+        if ctfMonitor is not None:
+            scheduler.addTask('ctfMonitor', ctfMonitor.step,
+                              samplingInterval, lock=ctfMonitor.lock)
+        if movieGainMonitor is not None:
+            scheduler.addTask('movieGainMonitor', movieGainMonitor.step,
+                              samplingInterval, lock=movieGainMonitor.lock)
+
+        # sysmonitor watches all input protocols so
+        # when sysmonitor done all protocols done
+        state = {'sysFinished': False, 'finished': False}
+
+        def sysStep():
+            state['sysFinished'] = sysMonitor.step()
+
+        def reportStep():
+            sysFinished = state['sysFinished']
+            if sysFinished:
+                # the input protocols are done: read their last CTFs and
+                # gains (waiting for the running steps) before the last report
+                for monitor in [ctfMonitor, movieGainMonitor]:
+                    if monitor is not None:
+                        with monitor.lock:
+                            monitor.step()
+            htmlFinished = reportHtml.generate(False)
+            if sysFinished and htmlFinished:
+                reportHtml.generate(True)
+                state['finished'] = True
+
+        scheduler.addTask('sysMonitor', sysStep, samplingInterval,
+                          lock=sysMonitor.lock)
+        scheduler.addTask('report', reportStep, self._getReportInterval())
+
+        if ctfMonitor is not None:
+            ctfMonitor.initLoop()
+        if movieGainMonitor is not None:
+            movieGainMonitor.initLoop()
+        sysMonitor.initLoop()
+
+        scheduler.run(lambda: state['finished'])
+
+    def _getReportInterval(self):
+        return self.reportInterval.get() or self.samplingInterval.get()
 
     def createReportDir(self):
         self.reportDir = os.path.abspath(self._getExtraPath(self.getProject().getShortName()))
@@ -303,6 +361,9 @@ class ProtMonitorSummary(ProtMonitor):
                                gpusToUse=self.gpusToUse.get(),
                                doNetwork=self.doNetwork.get(),
                                doDiskIO=self.doDiskIO.get(),
+                               perNic=self.perNic.get(),
+                               perDisk=self.perDisk.get(),
+                               sampleInterval=self.sampleInterval.get(),
                                nif=MonitorSystem.getNifsNameList()[
                                    self.netInterfaces.get()])
 
@@ -320,11 +381,15 @@ class ProtMonitorSummary(ProtMonitor):
         if self.doInflux:
             htmlReport = ReportInflux(self, ctfMonitor, sysMonitor, movieGainMonitor,
                                     self.publishCmd.get(),
-                                    refreshSecs=self.samplingInterval.get())
+                                    refreshSecs=self._getReportInterval(),
+                                    convertWorkers=self.thumbsWorkers.get(),
+                                    transferChannels=self.transferChannels.get())
         else:
             htmlReport = ReportHtml(self, ctfMonitor, sysMonitor, movieGainMonitor,
                                 self.publishCmd.get(),
-                                refreshSecs=self.samplingInterval.get())
+                                refreshSecs=self._getReportInterval(),
+                                thumbsWorkers=self.thumbsWorkers.get(),
+                                thumbsWidth=self.thumbsWidth.get())
             htmlReport.setUp()
 
         return htmlReport
@@ -343,7 +408,11 @@ class ProtMonitorSummary(ProtMonitor):
 
     def validate(self):
         errors = []
-        if self.publishCmd.get() != '':
+        if isPublishTarget(self.publishCmd.get() or ''):
+            error = checkPublishTarget(self.publishCmd.get())
+            if error:
+                errors.append(error)
+        elif self.publishCmd.get() != '':
             self.reportDir = os.path.abspath(
                 self._getExtraPath(self.getProject().getShortName()))
             pwutils.makePath(self.reportDir)
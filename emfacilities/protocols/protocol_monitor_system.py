@@ -25,10 +25,12 @@
 # **************************************************************************
 
 import os
+import re
 import sys
 import time
-import sqlite3 as lite
+import threading
 import datetime
+import numpy as np
 import pytz
 from configparser import ConfigParser
 
@@ -44,16 +46,19 @@ import pyworkflow.protocol.params as params
 
 from pyworkflow import VERSION_1_1
 from pyworkflow.protocol.constants import STATUS_RUNNING
-from pyworkflow.protocol import getUpdatedProtocol
 
 from pynvml import (nvmlInit, nvmlDeviceGetHandleByIndex,
                     nvmlDeviceGetMemoryInfo, nvmlDeviceGetUtilizationRates,
                     NVMLError, nvmlDeviceGetTemperature, NVML_TEMPERATURE_GPU,
                     nvmlDeviceGetComputeRunningProcesses)
 
-from .protocol_monitor import ProtMonitor, Monitor
+from .protocol_monitor import ProtMonitor, Monitor, protocolCache
+from .monitor_log import (connectLog, MonitorLogWriter, MonitorLogColumns,
+                          LOG_FLUSH_SIZE)
 
 SYSTEM_LOG_SQLITE = 'system_log.sqlite'
+# Aggregates stored for each label sampled by the background thread
+SAMPLE_STATS = ['min', 'max', 'p95']
 
 
 def initGPU():
@@ -86,6 +91,15 @@ class ProtMonitorSystem(ProtMonitor):
                       label="Raise Alarm if Swap > XX%",
                       help="Raise alarm if swap allocated is greater "
                            "than given percentage")
+        form.addParam('sampleInterval', params.FloatParam, default=0.5,
+                      label="Usage sampling interval (sec)",
+                      expertLevel=params.LEVEL_ADVANCED,
+                      help="Cpu, memory and gpu usage are read every "
+                           "*sampleInterval* seconds in the background and "
+                           "the mean, min, max and 95th percentile of the "
+                           "readings are logged with each sample, so short "
+                           "peaks are not missed. Set it to 0 to read them "
+                           "only once per sample")
 
         #form.addParam('monitorTime', params.FloatParam, default=300,
         #              label="Total Logging time (min)",
@@ -119,12 +133,22 @@ class ProtMonitorSystem(ProtMonitor):
                        default=1,  # usually 0 is the loopback
                        label="Interface", condition='doNetwork',
                        help="Name of the network interface to be checked")
+        group.addParam('perNic', params.BooleanParam, default=False,
+                       label="Check all interfaces", condition='doNetwork',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       help="Besides the selected interface, log the "
+                            "traffic of every network interface")
 
         group = form.addGroup('Disk')
         group.addParam('doDiskIO', params.BooleanParam, default=False,
                        label="Check Disk IO",
                        help="Set to true if you want to monitor the Disk "
                             "Access")
+        group.addParam('perDisk', params.BooleanParam, default=False,
+                       label="Check each disk", condition='doDiskIO',
+                       expertLevel=params.LEVEL_ADVANCED,
+                       help="Besides the total disk access, log the "
+                            "access to every disk")
 
     # --------------------------- STEPS functions ----------------------------
 
@@ -149,6 +173,9 @@ class ProtMonitorSystem(ProtMonitor):
                                doGpu=self.doGpu.get(),
                                doNetwork=self.doNetwork.get(),
                                doDiskIO=self.doDiskIO.get(),
+                               perNic=self.perNic.get(),
+                               perDisk=self.perDisk.get(),
+                               sampleInterval=self.sampleInterval.get(),
                                nif=MonitorSystem.getNifsNameList()[
                                    self.netInterfaces.get()],
                                gpusToUse=self.gpusToUse.get())
@@ -213,7 +240,14 @@ class MonitorSystem(Monitor):
         self.doGpu = kwargs['doGpu']
         self.doNetwork = kwargs['doNetwork']
         self.doDiskIO = kwargs['doDiskIO']
-        self.samplingTime = 1.  # seconds
+        self.perNic = kwargs.get('perNic', False)
+        self.perDisk = kwargs.get('perDisk', False)
+        # Seconds between background samples of cpu, memory and gpus usage,
+        # 0 means take just one sample per tick
+        self.sampleInterval = kwargs.get('sampleInterval', 0)
+        # Previous (time, network counters, disk counters) snapshot,
+        # transfer rates are computed from the deltas between ticks
+        self._ioCounters = None
 
         self.labelList = ["cpu", "mem", "swap"]
         if self.doGpu:
@@ -231,25 +265,55 @@ class MonitorSystem(Monitor):
             self.gpusToUse = None
         if self.doNetwork:
             self.nif = kwargs['nif']
-            self.netLabelList = []  # in the future we may display
-            # all the network interfaces
-            self.netLabelList.append("%s_send" % self.nif)
-            self.netLabelList.append("%s_recv" % self.nif)
+            # selected interface first, then the others if requested
+            self.nifs = [self.nif]
+            if self.perNic:
+                self.nifs += [nif for nif in self.getNifsNameList()
+                              if nif not in self.nifs and nif != 'lo']
+            self.netLabelList = []
+            for nif in self.nifs:
+                self.netLabelList.append(self._ioLabel("%s_send" % nif))
+                self.netLabelList.append(self._ioLabel("%s_recv" % nif))
             self.labelList += self.netLabelList
         else:
             self.nif = None
+            self.nifs = []
         if self.doDiskIO:
-            self.netLabelList = []  # in the future we may display
-            # all the network interfaces
-            self.netLabelList.append("disk_read")
-            self.netLabelList.append("disk_write")
-            self.labelList += self.netLabelList
+            # total disk access, then each disk if requested
+            self.disks = []
+            if self.perDisk:
+                self.disks = [disk for disk in
+                              psutil.disk_io_counters(perdisk=True)
+                              if not disk.startswith(('loop', 'ram'))]
+            self.diskLabelList = ["disk_read", "disk_write"]
+            for disk in self.disks:
+                self.diskLabelList.append(self._ioLabel("disk_read_%s" % disk))
+                self.diskLabelList.append(self._ioLabel("disk_write_%s" % disk))
+            self.labelList += self.diskLabelList
         else:
-            pass
+            self.disks = []
 
-        self.conn = lite.connect(os.path.join(self.workingDir,
-                                              self._dataBase),
-                                 isolation_level=None)
+        # Labels read by the background sampler, for each one the tick
+        # mean is stored in its column plus the min, max and p95 columns
+        self.sampledLabels = ["cpu", "mem", "swap"]
+        if self.doGpu:
+            self.sampledLabels += self.gpuLabelList
+        self.statsLabelList = []
+        if self.sampleInterval > 0:
+            self.statsLabelList = ["%s_%s" % (label, stat)
+                                   for label in self.sampledLabels
+                                   for stat in SAMPLE_STATS]
+        self._sampler = None
+        self._samples = None
+        self._samplesLock = threading.Lock()
+        self._stopSampling = threading.Event()
+
+        self.conn = connectLog(os.path.join(self.workingDir, self._dataBase))
+        self._logWriter = MonitorLogWriter(self.conn, self._tableName,
+                                           self.labelList +
+                                           self.statsLabelList,
+                                           kwargs.get('flushSize',
+                                                      LOG_FLUSH_SIZE))
         self.influx = influx
         if influx:
             # get results as a list of dictionaries
@@ -269,70 +333,188 @@ class MonitorSystem(Monitor):
             self.timeZone = confParser.get('influx', 'timeZone')
 
         self.cur = self.conn.cursor()
+        # hours since the first sample and the value of each label
+        hours = ("(julianday(timestamp) - (select julianday(timestamp) "
+                 "from %s where id=1)) * 24" % self._tableName)
+        self._logColumns = MonitorLogColumns(
+            self.conn, self._tableName,
+            [('idValues', hours, float)] +
+            [(label, label, float) for label in self.labelList])
+        self._initTime = None
 
     def warning(self, msg):
         self.notify("Scipion System Monitor WARNING", msg)
 
+    @staticmethod
+    def _ioLabel(name):
+        """ Interface and disk names are used as column names. """
+        return re.sub(r'\W', '_', name)
+
     def initLoop(self):
         self._createTable()
         psutil.cpu_percent(True)
         psutil.virtual_memory()
-
-    def step(self):
-        valuesDict = {}
-        valuesDict['table'] = self._tableName
-        cpu = valuesDict['cpu'] = psutil.cpu_percent(interval=0)
-        mem = valuesDict['mem'] = psutil.virtual_memory().percent
-        swap = valuesDict['swap'] = psutil.swap_memory().percent
+        self._ioCounters = self._readIOCounters()
+        if self.sampleInterval > 0:
+            self.startSampler()
+
+    def startSampler(self):
+        """ Start a thread that reads the cpu, memory and gpus usage every
+        self.sampleInterval seconds into a ring buffer. The samples taken
+        between two ticks are aggregated in step.
+        """
+        if self._sampler is not None:
+            return
+        # room for two ticks of samples, older ones are overwritten
+        capacity = int(2 * (self.samplingInterval or 60) /
+                       self.sampleInterval) + 1
+        self._samples = RingBuffer(capacity, len(self.sampledLabels))
+        self._stopSampling.clear()
+        self._sampler = threading.Thread(name="systemSampler",
+                                         target=self._sampleLoop,
+                                         daemon=True)
+        self._sampler.start()
+
+    def stopSampler(self):
+        if self._sampler is not None:
+            self._stopSampling.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def _sampleLoop(self):
+        while not self._stopSampling.wait(self.sampleInterval):
+            usage = self._readUsage()
+            with self._samplesLock:
+                self._samples.append([usage.get(label, np.nan)
+                                      for label in self.sampledLabels])
+
+    def _readUsage(self):
+        """ Return a dictionary with the current cpu, memory and gpus
+        usage (the labels in self.sampledLabels).
+        """
+        usage = {}
+        usage['cpu'] = psutil.cpu_percent(interval=0)
+        usage['mem'] = psutil.virtual_memory().percent
+        usage['swap'] = psutil.swap_memory().percent
         # some code examples:
         # https://github.com/ngi644/datadog_nvml/blob/master/nvml.py
         if self.doGpu:
-            for i in self.gpusToUse:
+            # copy, the devices that fail are removed
+            for i in list(self.gpusToUse):
                 try:
                     handle = nvmlDeviceGetHandleByIndex(i)
                     memInfo = nvmlDeviceGetMemoryInfo(handle)
-                    valuesDict["gpuMem_%d" % i] = \
+                    usage["gpuMem_%d" % i] = \
                         float(memInfo.used)*100./float(memInfo.total)
                     util = nvmlDeviceGetUtilizationRates(handle)
-                    valuesDict["gpuUse_%d" % i] = util.gpu
+                    usage["gpuUse_%d" % i] = util.gpu
                     temp = nvmlDeviceGetTemperature(handle,
                                                     NVML_TEMPERATURE_GPU)
-                    valuesDict["gpuTem_%d" % i] = temp
+                    usage["gpuTem_%d" % i] = temp
                 except NVMLError as err:
+                    # reported once, the device is not monitored anymore
                     msg = "ERROR monitoring GPU %d: %s." \
                           " Remove device %d from FORM" % (i, err, i)
                     print(red(msg))
-
+                    self.gpusToUse = [g for g in self.gpusToUse if g != i]
+        return usage
+
+    def _addUsage(self, valuesDict):
+        """ Add to valuesDict the usage values for this tick. With the
+        background sampler the label stores the mean of the samples taken
+        since the previous tick and label_min, label_max and label_p95
+        the other aggregates. Otherwise, the current usage is stored.
+        """
+        samples = None
+        if self._sampler is not None:
+            with self._samplesLock:
+                samples = self._samples.drain()
+        if samples is None or len(samples) == 0:
+            usage = self._readUsage()
+            valuesDict.update(usage)
+            if not self.statsLabelList:
+                return
+            samples = np.array([[usage.get(label, np.nan)
+                                 for label in self.sampledLabels]])
+
+        for i, label in enumerate(self.sampledLabels):
+            column = samples[:, i]
+            column = column[~np.isnan(column)]
+            if len(column) == 0:
+                continue
+            valuesDict[label] = float(np.mean(column))
+            valuesDict["%s_min" % label] = float(np.min(column))
+            valuesDict["%s_max" % label] = float(np.max(column))
+            valuesDict["%s_p95" % label] = float(np.percentile(column, 95))
+
+    def _readIOCounters(self):
+        """ Return a (time, network counters, disk counters) snapshot.
+        Counters are None if they are not monitored or can not be read.
+        """
+        netCounters = diskCounters = None
         if self.doNetwork:
             try:
-                # measure a sort interval
-                pnic_before = psutil.net_io_counters(pernic=True)[self.nif]
-                time.sleep(self.samplingTime)  # sec
-                pnic_after = psutil.net_io_counters(pernic=True)[self.nif]
-                bytes_sent = pnic_after.bytes_sent - pnic_before.bytes_sent
-                bytes_recv = pnic_after.bytes_recv - pnic_before.bytes_recv
-                valuesDict["%s_send" % self.nif] = \
-                    bytes_sent * self.samplingTime / 1048576
-                valuesDict["%s_recv" % self.nif] = \
-                    bytes_recv * self.samplingTime / 1048576
+                netCounters = psutil.net_io_counters(pernic=True)
             except Exception as ex:
-                msg = "cannot get information of network interface %s" % \
-                      self.nif
-
+                print("cannot get information of network interfaces: %s" % ex)
         if self.doDiskIO:
             try:
-                # measure a sort interval
-                disk_before = psutil.disk_io_counters(perdisk=False)
-                time.sleep(self.samplingTime)  # sec
-                disk_after = psutil.disk_io_counters(perdisk=False)
-                bytes_read = disk_after.read_bytes - disk_before.read_bytes
-                bytes_write = disk_after.write_bytes - disk_before.write_bytes
-                valuesDict["disk_read"] = \
-                    self.samplingTime * bytes_read / self.mega
-                valuesDict["disk_write"] = \
-                    self.samplingTime * bytes_write / self.mega
+                diskCounters = {None: psutil.disk_io_counters(perdisk=False)}
+                if self.disks:
+                    diskCounters.update(psutil.disk_io_counters(perdisk=True))
             except Exception as ex:
-                msg = "cannot get information of disk usage "
+                print("cannot get information of disk usage: %s" % ex)
+        return time.time(), netCounters, diskCounters
+
+    def _addIORates(self, valuesDict):
+        """ Add to valuesDict the network and disk transfer rates (MB/s)
+        computed from the counters increment since the previous tick.
+        This does not sleep, so it takes microseconds.
+        """
+        now, netCounters, diskCounters = self._readIOCounters()
+        if self._ioCounters is None:
+            self._ioCounters = (now, netCounters, diskCounters)
+            return
+        before, netBefore, diskBefore = self._ioCounters
+        self._ioCounters = (now, netCounters, diskCounters)
+        elapsed = now - before
+        if elapsed <= 0:
+            return
+
+        def rate(after, before):
+            # counters may be reset (e.g. interface restarted)
+            return max(after - before, 0) / elapsed / self.mega
+
+        if netCounters and netBefore:
+            for nif in self.nifs:
+                if nif in netCounters and nif in netBefore:
+                    valuesDict[self._ioLabel("%s_send" % nif)] = \
+                        rate(netCounters[nif].bytes_sent,
+                             netBefore[nif].bytes_sent)
+                    valuesDict[self._ioLabel("%s_recv" % nif)] = \
+                        rate(netCounters[nif].bytes_recv,
+                             netBefore[nif].bytes_recv)
+
+        if diskCounters and diskBefore:
+            for disk in [None] + self.disks:
+                if disk in diskCounters and disk in diskBefore:
+                    suffix = "" if disk is None else "_%s" % disk
+                    valuesDict[self._ioLabel("disk_read%s" % suffix)] = \
+                        rate(diskCounters[disk].read_bytes,
+                             diskBefore[disk].read_bytes)
+                    valuesDict[self._ioLabel("disk_write%s" % suffix)] = \
+                        rate(diskCounters[disk].write_bytes,
+                             diskBefore[disk].write_bytes)
+
+    def step(self):
+        valuesDict = {}
+        self._addUsage(valuesDict)
+        cpu = valuesDict.get('cpu', 0)
+        mem = valuesDict.get('mem', 0)
+        swap = valuesDict.get('swap', 0)
+
+        if self.doNetwork or self.doDiskIO:
+            self._addIORates(valuesDict)
 
         if self.cpuAlert < 100 and cpu > self.cpuAlert:
             self.warning("CPU allocation =%f." % cpu)
@@ -346,31 +528,16 @@ class MonitorSystem(Monitor):
             self.warning("SWAP allocation =%f." % swap)
             self.swapAlert = swap
 
-        sqlCommand = "INSERT INTO %(table)s ("
-        for label in self.labelList:
-            sqlCommand += "%s, " % label
-        # remove last comma
-        sqlCommand = sqlCommand[:-2]
-        sqlCommand += ") VALUES("
-        for label in self.labelList:
-            sqlCommand += "%"+"(%s)f, " % label
-        # remove last comma
-        sqlCommand = sqlCommand[:-2]
-        sqlCommand += ");"
-
-        sql = sqlCommand % valuesDict
-
-        try:
-            self.cur.execute(sql)
-        except Exception as e:
-            print("ERROR: saving one data point (monitor). I continue")
+        with self._logWriter.transaction():
+            self._logWriter.append(valuesDict)
 
         # Return finished = True if all protocols have finished
         finished = []
         for prot in self.protocols:
-            updatedProt = getUpdatedProtocol(prot)
-            finished.append(updatedProt.getStatus() != STATUS_RUNNING)
+            finished.append(protocolCache.getStatus(prot) != STATUS_RUNNING)
 
+        if all(finished):
+            self.stopSampler()
         return all(finished)
 
     def _createTable(self):
@@ -379,13 +546,22 @@ class MonitorSystem(Monitor):
                                 timestamp DATE DEFAULT
                                      (datetime('now')),
                                 """ % self._tableName
-        for label in self.labelList:
+        for label in self.labelList + self.statsLabelList:
             sqlCommand += "%s FLOAT,\n" % label
         # remove last comma and new line
         sqlCommand = sqlCommand[:-2]
         sqlCommand += ")"
         self.cur.execute(sqlCommand)
 
+        # the table may come from a previous run with other labels
+        self.cur.execute("PRAGMA table_info(%s)" % self._tableName)
+        columns = [(r['name'] if isinstance(r, dict) else r[1])
+                   for r in self.cur.fetchall()]
+        for label in self.labelList + self.statsLabelList:
+            if label not in columns:
+                self.cur.execute("ALTER TABLE %s ADD COLUMN %s FLOAT"
+                                 % (self._tableName, label))
+
     def getLabels(self):
         return self.labelList
 
@@ -428,57 +604,56 @@ class MonitorSystem(Monitor):
 
         return listOfDictionaries
 
-    def getDataHtml(self):
+    def getDataHtml(self, sinceId=None):
         """Fill a dictionary for each label in self.labeldisk.
-        The key is the label name. The value a list with
-        data read from the database"""
-        cur = self.cur
+        The key is the label name. The value a NumPy array with
+        data read from the database. All the labels are read in a single
+        query and only the rows added since the previous call are read.
+        If sinceId is given, only the rows with a log id greater than
+        sinceId are returned."""
+        try:
+            self._logColumns.update()
+        except Exception as e:
+            print("ERROR readind data (plotter). I continue")
+            print(e)
 
         # Starting time
-        cur.execute("select julianday(timestamp)  from %s where id=1" %
-                    self._tableName)
-        data = cur.fetchone()
-
-        # fill list with adquisition times
-        if (data is None) or (len(data) == 0):
-            initTime = 0
-            initTimeTitle = 0
-            idValues = [0]
-        else:
-            initTime = data[0]
-            cur.execute("select timestamp  from %s where id=1" %
-                        self._tableName)
-            initTimeTitle = cur.fetchone()[0]
-            cur.execute("select (julianday(timestamp) - %f)*24  from %s" %
-                        (initTime, self._tableName))
-            idValues = [r[0] for r in cur.fetchall()]
-
-        def get(name):
-            try:
-                cur.execute("select %s from %s" % (name, self._tableName))
-            except Exception as e:
-                print("ERROR readind data (plotter). I continue")
-                print("SQLCOMMAND", "select %s from %s" %
-                      (name, self._tableName))
-            data = cur.fetchall()
-            if len(data) == 0:
-                return [0]
-            else:
-                return [r[0] for r in data]
-
-        # TODO: this multiple calls to get may raise a
-        # race condition. That is data may be added to the DB
-        # between two get call and therefore the lengths of
-        # the list can be different. IT would be better to do a single
-        # call to the database and retrieve all at the same time
-        # see getDataInflux for details
+        if self._initTime is None and len(self._logColumns):
+            cur = self.conn.cursor()
+            cur.row_factory = None
+            cur.execute("select julianday(timestamp), timestamp from %s "
+                        "where id=1" % self._tableName)
+            self._initTime = cur.fetchone()
+
+        initTime, initTimeTitle = self._initTime or (0, 0)
         data = {'initTime': initTime,
-                'initTimeTitle': initTimeTitle,
-                'idValues': idValues}
+                'initTimeTitle': initTimeTitle}
+        data.update(self._logColumns.getColumns(sinceId))
+        return data
 
-        # fill several lists with requested data
-        for label in self.labelList:
-            data[label] = get(label)
 
-        # conn.close()
-        return data
+class RingBuffer:
+    """ Fixed size buffer, backed by a NumPy array, keeping the last
+    capacity rows of width values appended to it.
+    """
+    def __init__(self, capacity, width):
+        self._data = np.full((capacity, width), np.nan)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values):
+        self._data[self._next] = values
+        self._next = (self._next + 1) % len(self._data)
+        self._count = min(self._count + 1, len(self._data))
+
+    def drain(self):
+        """ Return the stored rows, oldest first, and empty the buffer. """
+        capacity = len(self._data)
+        first = (self._next - self._count) % capacity
+        rows = np.take(self._data, range(first, first + self._count),
+                       axis=0, mode='wrap')
+        self._count = 0
+        return rows
@@ -31,8 +31,11 @@ from pwem.protocols.protocol import EMProtocol
 from pwem.objects import Micrograph, Particle, Class3D, Class2D
 from pwem.emlib.image import ImageHandler as ih
 from pwem.emlib import MDL_XCOOR, MDL_YCOOR, MDL_MICROGRAPH_ID
+from .set_tables import readSetIds, readSetColumns, readClassesItemIds, copySetRows, \
+  getTablePrefix
 
 import os
+from collections import deque
 from joblib import delayed, Parallel
 import networkx as nx
 import numpy as np
@@ -156,7 +159,7 @@ class UsedItemsTracker(EMProtocol):
 
     self.inpDic, self.outDic = self.buildInputsDic(self.project), self.buildOutputsDic(self.project)
     self.protDic = self.project.getProtocolsDict()
-    self.outGraph = self.generateOutputsGraphRec(self.getObjId())
+    self.outGraph = self.generateOutputsGraph(self.getObjId())
 
   def getUsedItemsStep(self):
     #Used particles: further from root
@@ -297,19 +300,12 @@ class UsedItemsTracker(EMProtocol):
     return particleSets, originalParticlesCodes
 
   def getUnused(self, usedParticlesSets, originalParticlesSets):
-    usedParticlesIds = self.joinParticleSetsIds(usedParticlesSets)
-    notParticles, notUsedIds = [], []
-
-    for particleSet in originalParticlesSets:
-      for part in particleSet:
-        if not part.getObjId() in usedParticlesIds and not part.getObjId() in notUsedIds:
-          cPart = part.clone()
-          notParticles.append(cPart)
-          notUsedIds.append(cPart.getObjId())
-
-    notParticlesSet = self.createScipionSet(notParticles, '_unused')
-    notParticlesSet.copyInfo(originalParticlesSets[0])
-    return notParticlesSet
+    '''Set with the particles of the original sets whose id is not in the used sets. The ids are compared as
+    NumPy arrays read from the sets sqlite and the unused particles are copied in bulk'''
+    usedIds = self.joinParticleSetsIds(usedParticlesSets)
+    originalIds = self.joinParticleSetsIds(originalParticlesSets)
+    notUsedIds = originalIds[~np.isin(originalIds, usedIds, assume_unique=True)]
+    return self.createScipionSet(originalParticlesSets, notUsedIds, '_unused')
 
   def getOriginalMicrographs(self):
     if self.originalMicrographs.get() is None:
@@ -514,28 +510,36 @@ class UsedItemsTracker(EMProtocol):
 
   def updateClassSet(self, outClasses, newClass, cl3D):
     '''Updated the set of classes "outClassess" with a "newClass", conformed by the particles
-    of a previous class "cl3D"'''
+    of a previous class "cl3D", which are copied in bulk from its sqlite table'''
     outClasses.append(newClass)
+    outClasses.write(properties=False)
+    copySetRows(cl3D.getFileName(), outClasses.getFileName(), srcPrefix=cl3D.getPrefix(),
+                dstPrefix='Class%03d' % newClass.getObjId())
     enabledClass = outClasses[newClass.getObjId()]
-    enabledClass.enableAppend()
-    for part in cl3D:
-      enabledClass.append(part)
-    enabledClass.setSamplingRate(part.getSamplingRate())
+    if enabledClass.getSize():
+      enabledClass.setSamplingRate(cl3D.getFirstItem().getSamplingRate())
     outClasses.update(enabledClass)
     return outClasses
 
-  def createScipionSet(self, particles, suffix=''):
+  def copySetItems(self, outSet, sourceSets, ids=None, idMap=None):
+    '''Copies in bulk to outSet the items of sourceSets with an id in the ids array (all if None). An item
+    id is only copied from the first set having it. idMap is passed to copySetRows'''
+    outSet.close()
+    for sourceSet in sourceSets:
+      copySetRows(sourceSet.getFileName(), outSet.getFileName(), ids, idMap=idMap)
+    outSet.load()
+    outSet.write()
+    return outSet
+
+  def createScipionSet(self, particlesSets, ids, suffix=''):
     scipionSet = self._createSetOfParticles(suffix)
-    for part in particles:
-      scipionSet.append(part)
-    return scipionSet
+    scipionSet.copyInfo(particlesSets[0])
+    return self.copySetItems(scipionSet, particlesSets, ids)
 
   def joinParticleSetsIds(self, particleSets):
-    ids = set([])
-    for particles in particleSets:
-      for part in particles:
-        ids.add(part.getObjId())
-    return ids
+    '''Sorted array with the ids of the items of all the sets'''
+    ids = [readSetIds(particles) for particles in particleSets]
+    return np.unique(np.concatenate(ids)) if ids else np.empty(0, dtype=np.int64)
 
   def joinSets(self, sets):
     if len(sets) == 1:
@@ -556,22 +560,19 @@ class UsedItemsTracker(EMProtocol):
   def buildSetOfCoordinates(self, outputMics, coords, coordSets, suffix=''):
     outputCoordinates = self._createSetOfCoordinates(outputMics, suffix)
     outputCoordinates.copyInfo(coordSets[0])
+    # the coordinates are already new objects, scaled from the particles ones
     for coord in coords:
-      outputCoordinates.append(coord.clone())
+      outputCoordinates.append(coord)
 
     return outputCoordinates
 
   def buildSetOfCTF(self, ctfSet, ctfSets):
+    '''Each CTF takes the id of its micrograph in micDic (matched by file name), only the first CTF of
+    each micrograph is kept and the CTFs of other micrographs are skipped'''
     outputCTF = self._createSetOfCTF()
     outputCTF.copyInfo(ctfSets[0])
-    for ctf in ctfSet:
-      mic = ctf.getMicrograph()
-      ctf.copyObjId(mic)
-      try:
-        outputCTF.append(ctf)
-      except:
-        pass
-    return outputCTF
+    micIds = {micFile: micId for micId, micFile in self.micDic.items()}
+    return self.copySetItems(outputCTF, [ctfSet], idMap=('_micObj._filename', micIds))
 
   def buildSetOfMics(self, micSet):
     outputMics = self._createSetOfMicrographs()
@@ -623,14 +624,16 @@ class UsedItemsTracker(EMProtocol):
   def countParticlesPerMic(self, particlesSet):
     micCountDic, nMicDic = {}, {}
 
-    for part in particlesSet:
-      micId = part.getMicId()
+    parts = readSetColumns(particlesSet.getFileName(), [('_micId', '_coordinate._micId')],
+                           getTablePrefix(particlesSet.getPrefix()), skipNull=True)
+    micIds, counts = np.unique(parts[('_micId', '_coordinate._micId')], return_counts=True)
+    for micId, count in zip(micIds.tolist(), counts.tolist()):
       if micId in self.micDic:
         micFile = self.micDic[micId]
         if micFile in micCountDic:
-          micCountDic[micFile] += 1
+          micCountDic[micFile] += count
         else:
-          micCountDic[micFile] = 1
+          micCountDic[micFile] = count
           nMicDic[micId] = micFile
 
     for micId, micFile in self.micDic.items():
@@ -641,25 +644,34 @@ class UsedItemsTracker(EMProtocol):
     return micCountDic, nMicDic
 
   def countParticlesPerClass(self, particlesSet, classDic):
-    classCountDic = {}
-    for part in particlesSet:
-      partId = part.getObjId()
-      if partId in classDic:
-        classId = classDic[partId]
-        if classId in classCountDic:
-          classCountDic[classId] += 1
-        else:
-          classCountDic[classId] = 1
-    return classCountDic
+    '''Returns a dictionary {classId: number of particles of particlesSet}, classDic are the arrays returned by
+    buildClassesDic'''
+    classPartIds, classIds = classDic
+    partIds = readSetIds(particlesSet)
+    idx = np.searchsorted(classPartIds, partIds)
+    inClass = idx < len(classPartIds)
+    inClass[inClass] = classPartIds[idx[inClass]] == partIds[inClass]
+    usedClassIds, counts = np.unique(classIds[idx[inClass]], return_counts=True)
+    return dict(zip(usedClassIds.tolist(), counts.tolist()))
 
   def getLongestPath(self, outGraph, node1, node2, dir='both'):
     '''Return the longest path between two nodes in a directed graph'''
-    if nx.has_path(outGraph, node1, node2) and dir in ['both', 'down']:
-      allPaths = nx.all_simple_paths(outGraph, node1, node2)
-      return max(allPaths, key=len)
-    if nx.has_path(outGraph, node2, node1) and dir in ['both', 'up']:
-      allPaths = nx.all_simple_paths(outGraph, node2, node1)
-      return max(allPaths, key=len)
+    if dir in ['both', 'down']:
+      path = getDagPath(outGraph, node1, node2)
+      if path is not None:
+        return path
+    if dir in ['both', 'up']:
+      return getDagPath(outGraph, node1, node2, upwards=True)
+    return None
+
+  def getPathLength(self, outGraph, oriNode, targetNode, dir='both'):
+    '''Number of nodes of the longest path between oriNode and targetNode (None if there is no path)'''
+    if dir in ['both', 'down']:
+      length = getDagPathLengths(outGraph, oriNode)[0].get(targetNode)
+      if length is not None:
+        return length
+    if dir in ['both', 'up']:
+      return getDagPathLengths(outGraph, oriNode, upwards=True)[0].get(targetNode)
     return None
 
   def validateConditions(self, node, conditions):
@@ -700,9 +712,8 @@ class UsedItemsTracker(EMProtocol):
     for nodeKey in outGraph.nodes:
       if nodeKey != 'root' and nodeKey.split('.')[0] != oriNode.split('.')[0] and \
               self.validateConditions(outGraph.nodes[nodeKey], nodeConditions):
-        longPath = self.getLongestPath(outGraph, oriNode, nodeKey, dir)
-        if longPath is not None:
-          dist = len(longPath)
+        dist = self.getPathLength(outGraph, oriNode, nodeKey, dir)
+        if dist is not None:
           if dist > maxDist:
             maxDist = dist
             furthestCodes = [nodeKey]
@@ -717,7 +728,9 @@ class UsedItemsTracker(EMProtocol):
     for nodeKey in outGraph.nodes:
       if nodeKey != 'root' and nodeKey.split('.')[0] != oriNode.split('.')[0] and \
               self.validateConditions(outGraph.nodes[nodeKey], nodeConditions):
-        dist = len(self.getLongestPath(outGraph, oriNode, nodeKey, dir))
+        dist = self.getPathLength(outGraph, oriNode, nodeKey, dir)
+        if dist is None:
+          continue
         if dist < minDist:
           minDist = dist
           closestCodes = [nodeKey]
@@ -774,29 +787,36 @@ class UsedItemsTracker(EMProtocol):
         outDic[protId][key] = oValue
     return outDic
 
-  def generateOutputsGraphRec(self, curProtId, outGraph=nx.DiGraph(), prevCode=None):
-    '''Generates a directed graph from a project with the protocol outputs as nodes, starting from the
-    current protocol Id (curProtId) and moving upwards. Therefore, the resulting outputs graphs contains
-    only those outputs necessary for the generation of the input of this protocol (default volume)'''
-    inpKeys = self.inpDic[curProtId].keys()
-    if len(inpKeys) == 0:
-      if not 'root' in outGraph:
-        outGraph.add_node('root')
-      outGraph.add_edge('root', prevCode)
-      return outGraph
-
-    for k in inpKeys:
-      outCodes = self.protDic[curProtId][k]
+  def getProtInputCodes(self, protId):
+    '''Output codes (protId.atrName) used as inputs by the protocol protId'''
+    inpCodes = []
+    for k in self.inpDic[protId].keys():
+      outCodes = self.protDic[protId][k]
       if not type(outCodes) == list:
         outCodes = [outCodes]
+      inpCodes += [self.manageCodes(outCode)[2] for outCode in outCodes]
+    return inpCodes
 
-      for outCode in outCodes:
-        protId, outKey, outCode = self.manageCodes(outCode)
-        outGraph, nextProId = self.addNode(outCode, outGraph)
-        if prevCode is not None:
-          outGraph.add_edge(outCode, prevCode)
-
-        outGraph = self.generateOutputsGraphRec(nextProId, outGraph, outCode)
+  def generateOutputsGraph(self, curProtId):
+    '''Generates a directed graph from a project with the protocol outputs as nodes, starting from the
+    current protocol Id (curProtId) and moving upwards. Therefore, the resulting outputs graphs contains
+    only those outputs necessary for the generation of the input of this protocol (default volume).
+    The outputs are visited breadth first, each of them only once, and the inputs of each protocol
+    are only resolved once'''
+    outGraph = nx.DiGraph()
+    inpCodes = {}
+    pending = deque(self.getProtInputCodes(curProtId))
+    visited = set(pending)
+    while pending:
+      outCode = pending.popleft()
+      outGraph, parentId = self.addNode(outCode, outGraph)
+      if parentId not in inpCodes:
+        inpCodes[parentId] = self.getProtInputCodes(parentId)
+      for parentCode in inpCodes[parentId] or ['root']:
+        outGraph.add_edge(parentCode, outCode)
+        if parentCode != 'root' and parentCode not in visited:
+          visited.add(parentCode)
+          pending.append(parentCode)
     return outGraph
 
   def manageCodes(self, outCode):
@@ -850,20 +870,21 @@ class UsedItemsTracker(EMProtocol):
     return sets
 
   def buildMicDic(self, micSets):
+    '''Returns a dictionary: {micId: micFile}'''
     micDic = {}
     for micSet in micSets:
-      for mic in micSet:
-        micDic[mic.getObjId()] = mic.getFileName()
+      mics = readSetColumns(micSet.getFileName(), ['id', '_filename'],
+                            getTablePrefix(micSet.getPrefix()))
+      micDic.update(zip(mics['id'].tolist(), mics['_filename'].tolist()))
     return micDic
 
   def buildClassesDic(self, classSets):
-    '''Returns a dictionary: {partId: classID}'''
-    classDic = {}
-    for classSet in classSets:
-      for classObj in classSet:
-        for part in classObj:
-          classDic[part.getObjId()] = classObj.getObjId()
-    return classDic
+    '''Returns the arrays (partIds, classIds) with the particle ids, sorted, and the id of their class'''
+    partIds, classIds = zip(*[readClassesItemIds(classSet) for classSet in classSets])
+    partIds, classIds = np.concatenate(partIds), np.concatenate(classIds)
+    # as in a dictionary, the last class of a particle in several sets is kept
+    partIds, lastIdx = np.unique(partIds[::-1], return_index=True)
+    return partIds, classIds[::-1][lastIdx]
 
   def getParticleCoordinates(self, particlesSet):
     coords = []
@@ -912,6 +933,47 @@ class UsedItemsTracker(EMProtocol):
     return oriClassesSets[0], completeCode
 
 
+def getDagCache(graph):
+  '''Return the cache of a DAG with its topological order and the path lengths already computed. The cache
+  is stored in the graph attributes and computed again if nodes or edges are added to the graph'''
+  key = (graph.number_of_nodes(), graph.number_of_edges())
+  cache = graph.graph.get('dagCache')
+  if cache is None or cache['key'] != key:
+    cache = {'key': key, 'order': list(nx.topological_sort(graph)), 'lengths': {}}
+    graph.graph['dagCache'] = cache
+  return cache
+
+def getDagPathLengths(graph, source, longest=True, upwards=False):
+  '''Number of nodes of the longest (or shortest) path from source to each node reachable from it (or from each
+  node to source if upwards), computed for all the nodes in one pass over the topological order of the DAG.
+  Returns the dictionaries ({node: length}, {node: previous node in the path}), cached per source'''
+  cache = getDagCache(graph)
+  key = (source, longest, upwards)
+  if key not in cache['lengths']:
+    order = reversed(cache['order']) if upwards else cache['order']
+    nextNodes = graph.predecessors if upwards else graph.successors
+    lengths, prevs = {source: 1}, {source: None}
+    for node in order:
+      if node not in lengths:
+        continue
+      length = lengths[node] + 1
+      for nextNode in nextNodes(node):
+        curLength = lengths.get(nextNode)
+        if curLength is None or (length > curLength if longest else length < curLength):
+          lengths[nextNode], prevs[nextNode] = length, node
+    cache['lengths'][key] = lengths, prevs
+  return cache['lengths'][key]
+
+def getDagPath(graph, source, target, longest=True, upwards=False):
+  '''Longest (or shortest) path from source to target (from target to source if upwards) in a DAG'''
+  lengths, prevs = getDagPathLengths(graph, source, longest, upwards)
+  if target not in lengths:
+    return None
+  path = [target]
+  while prevs[path[-1]] is not None:
+    path.append(prevs[path[-1]])
+  return path if upwards else path[::-1]
+
 def computeMicPSD(micFile, psdPath):
   imageMic = ih().read(micFile)
   dimX, dimY, _, _ = imageMic.getDimensions()
@@ -0,0 +1,156 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Incremental storage of the html report data.
+"""
+
+import json
+import os
+import shutil
+from os.path import join, exists
+
+import numpy as np
+import pyworkflow.utils as pwutils
+
+# Folder, inside the report dir, with the data files
+REPORT_DATA_DIR = 'data'
+# Number of rows in each data chunk file
+REPORT_CHUNK_SIZE = 1000
+REPORT_STATE_FILE = 'state.js'
+
+
+def toJson(value):
+    """ json.dumps handling the NumPy types. """
+    def convert(o):
+        if isinstance(o, np.generic):
+            return o.item()
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        raise TypeError("%s is not JSON serializable" % type(o))
+
+    return json.dumps(value, default=convert)
+
+
+class ReportDataWriter:
+    """ Write the data of the html report as JavaScript files, so the page
+    can load them with script tags (also when it is opened as a local file).
+
+    Each stream (e.g. the CTF values) is a table whose rows are only
+    appended. The rows are stored in data/<stream>_<k>.js files of
+    chunkSize rows, one R(stream, index, row); line per row, so each tick
+    just adds the new rows and the page only loads the chunks with rows
+    it does not have. A chunk is replaced with a copy that has the new
+    rows, so the page never reads a partially written row. Values that
+    change on each tick (status, histograms...) are small and are stored
+    in data/state.js, which is atomically replaced on each tick.
+
+    If the columns of a stream change, the stream is written again from
+    the first row with a new version, and the page loads it again.
+    """
+    def __init__(self, reportDir, chunkSize=REPORT_CHUNK_SIZE):
+        self.dataDir = join(reportDir, REPORT_DATA_DIR)
+        self.chunkSize = chunkSize
+        self.columns = {}
+        self.counts = {}
+        self.versions = {}
+        self.written = set()  # files written since the last popWritten()
+        # data from previous runs can not be trusted, so start from scratch
+        pwutils.cleanPath(self.dataDir)
+        pwutils.makePath(self.dataDir)
+
+    def getCount(self, stream):
+        return self.counts.get(stream, 0)
+
+    def append(self, stream, columns, rows):
+        """ Append rows (sequences of values in the columns order) to the
+        stream. The columns of a stream are set by the first call, they
+        can only be changed with appendColumns.
+        """
+        columns = list(columns)
+        if self.columns.setdefault(stream, columns) != columns:
+            raise ValueError("The columns of the report stream %s changed "
+                             "from %s to %s" % (stream, self.columns[stream],
+                                                columns))
+        count = self.getCount(stream)
+        chunks = {}
+        for row in rows:
+            chunks.setdefault(count // self.chunkSize, []).append(
+                "R(%s,%d,%s);\n" % (toJson(stream), count, toJson(row)))
+            count += 1
+        for k, lines in sorted(chunks.items()):
+            chunkPath = self.getChunkPath(stream, k)
+            tmpPath = chunkPath + '.tmp'
+            if exists(chunkPath):
+                shutil.copyfile(chunkPath, tmpPath)
+            with open(tmpPath, 'a', encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(tmpPath, chunkPath)
+            self.written.add(chunkPath)
+        self.counts[stream] = count
+
+    def appendColumns(self, stream, data, keys):
+        """ Append to the stream the rows of the dictionary of columns data
+        (only the keys columns) not written yet. If the keys are not the
+        columns of the stream, all the rows are written again.
+        """
+        if stream in self.columns and self.columns[stream] != list(keys):
+            self.resetStream(stream)
+        count = self.getCount(stream)
+        columns = [np.asarray(data[k])[count:].tolist() for k in keys]
+        self.append(stream, keys, zip(*columns))
+
+    def resetStream(self, stream):
+        """ Remove the rows of the stream and start a new version of it. """
+        for k in range(0, self.getCount(stream), self.chunkSize):
+            pwutils.cleanPath(self.getChunkPath(stream, k // self.chunkSize))
+        self.columns.pop(stream, None)
+        self.counts[stream] = 0
+        self.versions[stream] = self.versions.get(stream, 0) + 1
+
+    def getChunkPath(self, stream, k):
+        return join(self.dataDir, "%s_%d.js" % (stream, k))
+
+    def writeState(self, state, rawValues=None):
+        """ Atomically replace the state file with S(state);. The state is
+        completed with the streams information. rawValues is a dictionary
+        with values already formatted as JavaScript.
+        """
+        state = dict(state, chunkSize=self.chunkSize,
+                     streams=self.counts, columns=self.columns,
+                     versions=self.versions)
+        text = toJson(state)
+        for key, value in (rawValues or {}).items():
+            text = text[:-1] + ', %s: %s}' % (toJson(key), value)
+        tmpPath = join(self.dataDir, REPORT_STATE_FILE + '.tmp')
+        with open(tmpPath, 'w', encoding="utf-8") as f:
+            f.write("S(%s);\n" % text)
+        os.replace(tmpPath, join(self.dataDir, REPORT_STATE_FILE))
+        self.written.add(join(self.dataDir, REPORT_STATE_FILE))
+
+    def popWritten(self):
+        """ Return the files written since the previous call. """
+        written, self.written = self.written, set()
+        return written
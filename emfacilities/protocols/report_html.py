@@ -28,19 +28,25 @@
 
 import json
 import os
+import re
 from os.path import join, exists, abspath, basename
 import numpy as np
 import subprocess
+import threading
 import multiprocessing
 from datetime import datetime
 from statistics import median, mean
 
-from pyworkflow.protocol import getUpdatedProtocol
 import pyworkflow.utils as pwutils
 
 from pwem.emlib.image import ImageHandler
 
 from .summary_provider import SummaryProvider
+from .monitor_log import MonitorTimingLog, MONITOR_TIMING_SQLITE
+from .protocol_monitor import protocolCache
+from .report_data import ReportDataWriter, REPORT_DATA_DIR, toJson
+from .thumbnails import createThumbnail, ThumbnailCache, THUMB_WIDTH
+from .report_publisher import ReportPublisher, isPublishTarget
 
 # --------------------- CONSTANTS -----------------------------------
 # These constants are the keys used in the ctfMonitor function
@@ -56,10 +62,107 @@ MIC_THUMBS = 'imgMicThumbs'
 PSD_THUMBS = 'imgPsdThumbs'
 SHIFT_THUMBS = 'imgShiftThumbs'
 MIC_ID = 'micId'
+# Streams of rows in the report data files
+CTF_STREAM = 'ctf'
+MICS_STREAM = 'mics'
+GAIN_STREAM = 'gain'
+SYSTEM_STREAM = 'system'
+# Templates with this key load the data from the report data files,
+# others get all the data in the html file
+REPORT_DATA_KEY = 'dataDir'
+# Conversions done to create the thumbnails
+THUMB_COPY = 'copy'
+THUMB_CONVERT = 'convert'
+THUMB_PSD = 'psd'
 DEFOCUS_HIST_BIN_WIDTH = 0.5
 RESOLUTION_HIST_BIN_WIDTH = 0.5
 
 
+def makeThumbnail(kind, srcPath, dstPath, width=THUMB_WIDTH):
+    """ Create the thumbnail dstPath from the image srcPath. It is run by
+    the report thumbnails pool processes. Return dstPath.
+    """
+    if kind == THUMB_COPY:
+        pwutils.copyFile(srcPath, dstPath)
+    elif kind == THUMB_PSD:
+        ih = ImageHandler()
+        psdImg = ih.read(srcPath)
+        psdImg.convertPSD()
+        psdImg.write(dstPath)
+        ih.convert(dstPath, pwutils.replaceExt(dstPath, "jpg"))
+    else:
+        createThumbnail(srcPath, dstPath, width)
+    return dstPath
+
+
+class ReportTemplate:
+    """ Html template of the report. The file is read and split in its
+    literal text and its %(key)<spec> slots only once, and read again only
+    if it is modified, so rendering just joins the literals with the values.
+    """
+    # %(key) followed by the conversion spec: flags, width, precision,
+    # length modifier and type (as in the % operator), or %%
+    SLOT_REGEX = re.compile(r'%(?:\((\w+)\)([#0\- +]*\d*(?:\.\d*)?[hlL]?'
+                            r'[diouxXeEfFgGcrsa])|%)')
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.text = ''
+        self.literals = []
+        self.keys = []
+        self.specs = []
+
+    def load(self):
+        """ Read the template if it was modified since the last call.
+        Return True if it was read.
+        """
+        mtime = os.path.getmtime(self.path) if exists(self.path) else None
+        if mtime == self.mtime:
+            return False
+
+        self.mtime = mtime
+        self.text = ''
+        self.literals = []
+        self.keys = []
+        self.specs = []
+        if mtime is not None:
+            with open(self.path, encoding="utf-8") as f:
+                self.text = text = f.read()
+            # literals[i] goes before keys[i], %% is just a literal %
+            literals = ['']
+            pos = 0
+            for match in self.SLOT_REGEX.finditer(text):
+                literals[-1] += text[pos:match.start()]
+                if match.group(1) is None:
+                    literals[-1] += '%'
+                else:
+                    self.keys.append(match.group(1))
+                    self.specs.append(match.group(2))
+                    literals.append('')
+                pos = match.end()
+            literals[-1] += text[pos:]
+            self.literals = literals
+        return True
+
+    def exists(self):
+        return self.mtime is not None
+
+    def hasKey(self, key):
+        return key in self.keys
+
+    def render(self, args):
+        """ Same as template % args. """
+        parts = [self.literals[0]]
+        for key, spec, literal in zip(self.keys, self.specs,
+                                      self.literals[1:]):
+            value = args[key]
+            parts.append(str(value) if spec == 's'
+                         else ('%' + spec) % (value,))
+            parts.append(literal)
+        return ''.join(parts)
+
+
 class ReportHtml:
     """ Create an html report with a summary of the processing.
     The report will be updated with a given frequency.
@@ -78,6 +181,15 @@ class ReportHtml:
         self.movieGainMonitor = movieGainMonitor
         self.lastThumbIndex = 0
         self.thumbsReady = 0
+        # Thumbnails are created by a pool of thumbsWorkers processes,
+        # the destination paths of the queued and created ones are kept
+        self.thumbsWorkers = max(1, kwargs.get('thumbsWorkers', 2))
+        self.thumbsWidth = kwargs.get('thumbsWidth', THUMB_WIDTH)
+        self._thumbsPool = None
+        self._thumbsCache = None
+        self._thumbsPending = {}  # destination: source path
+        self._thumbsDone = set()
+        self._thumbsLock = threading.RLock()
         self.itemsAddedMovies = []
         self.itemsAddedAlign = []
         self.itemsAddedCTF = []
@@ -87,6 +199,9 @@ class ReportHtml:
         self.diffItemsAddedCTF = []
 
         self.thresholdRate = 0.1
+        self._timingLog = None
+        self.dataWriter = None
+        self._shellWritten = False
 
         self.thumbPaths = {MIC_THUMBS: [],
                            PSD_THUMBS: [],
@@ -99,8 +214,14 @@ class ReportHtml:
         # Get the html template to be used, by default use the one
         # in scipion/config/templates
         self.template = self._getHTMLTemplatePath()
+        self.reportTemplate = ReportTemplate(self.template)
 
         self.publishCmd = publishCmd
+        # a file:// or sftp:// target is published by the report itself,
+        # sending only the changed files
+        self.publisher = None
+        if publishCmd and isPublishTarget(publishCmd):
+            self.publisher = ReportPublisher(self.reportDir, publishCmd)
         self.refreshSecs = kwargs.get('refreshSecs', 60)
         self.one_minute_freq_operator = self.refreshSecs / 60.0
         self.five_minute_freq_operator = self.refreshSecs / 300.0
@@ -121,11 +242,10 @@ class ReportHtml:
             print("Customized HTML template found at %s." % template)
         return template
 
-    def getHTMLReportText(self):
-        if exists(self.template):
-            return open(self.template, encoding="utf-8").read()
-        else:
-            return ""
+    def addChanged(self, path):
+        """ Mark a report file to be published. """
+        if self.publisher is not None:
+            self.publisher.addChanged(path)
 
     def info(self, msg):
         if self.protocol._log is not None:
@@ -134,20 +254,105 @@ class ReportHtml:
             print(msg)
 
     def checkNewThumbsReady(self):
-        thumbKeys = [MIC_THUMBS]
-        if PSD_THUMBS in self.thumbPaths.keys():
-            lastThumb = min(len(self.thumbPaths[PSD_THUMBS]), len(self.thumbPaths[MIC_THUMBS]))
-            thumbKeys.append(PSD_THUMBS)
-        else:
-            lastThumb = len(self.thumbPaths[MIC_THUMBS])
-        if SHIFT_THUMBS in self.thumbPaths.keys():
-            thumbKeys.append(SHIFT_THUMBS)
-        for i in range(self.thumbsReady, lastThumb):
-            pathsReady = [exists(join(self.reportDir, self.thumbPaths[k][i])) for k in thumbKeys]
-            if all(pathsReady):
+        """ Update self.thumbsReady, the number of micrographs (from the
+        first one) whose thumbnails are all created, and return it.
+        """
+        thumbKeys = [k for k in [MIC_THUMBS, PSD_THUMBS, SHIFT_THUMBS]
+                     if k in self.thumbPaths]
+        lastThumb = min(len(self.thumbPaths[k]) for k in thumbKeys)
+        with self._thumbsLock:
+            while self.thumbsReady < lastThumb:
+                i = self.thumbsReady
+                if not all(join(self.reportDir, self.thumbPaths[k][i])
+                           in self._thumbsDone for k in thumbKeys):
+                    break
                 self.thumbsReady += 1
         return self.thumbsReady
 
+    def getThumbTasks(self, i):
+        """ Return the (kind, srcPath, dstPath) conversions needed to create
+        the thumbnails of the micrograph i.
+        """
+        tasks = []
+        # mic thumbnails
+        dstImgPath = join(self.reportDir, self.thumbPaths[MIC_THUMBS][i])
+        kind = THUMB_COPY if self.micThumbSymlinks else THUMB_CONVERT
+        tasks.append((kind, self.thumbPaths[MIC_PATH][i], dstImgPath))
+
+        # shift plots
+        if SHIFT_THUMBS in self.thumbPaths:
+            dstImgPath = join(self.reportDir, self.thumbPaths[SHIFT_THUMBS][i])
+            tasks.append((THUMB_COPY, self.thumbPaths[SHIFT_PATH][i],
+                          dstImgPath))
+
+        # Psd thumbnails
+        # If there ARE thumbnail for the PSD (no ctf protocol and
+        # moviealignment hasn't computed it
+        if PSD_THUMBS in self.thumbPaths:
+            srcImgPath = self.thumbPaths[PSD_PATH][i]
+            dstImgPath = join(self.reportDir, self.thumbPaths[PSD_THUMBS][i])
+            if self.ctfProtocol is None:
+                if srcImgPath is not None:
+                    kind = THUMB_PSD if srcImgPath.endswith('psd') else THUMB_COPY
+                    tasks.append((kind, srcImgPath, dstImgPath))
+            else:
+                tasks.append((THUMB_CONVERT, srcImgPath, dstImgPath))
+        return tasks
+
+    def getThumbsCache(self):
+        """ Thumbnails created in previous runs of the protocol. """
+        if self._thumbsCache is None:
+            self._thumbsCache = ThumbnailCache(
+                self.protocol._getExtraPath('thumbnails.sqlite'))
+        return self._thumbsCache
+
+    def submitReportImages(self, firstThumbIndex=0):
+        """ Queue in the thumbnails pool the thumbnails not created yet.
+        Each thumbnail is queued only once, even if it is requested again
+        before it is done. The pool callbacks update self.thumbsReady.
+        """
+        numMics = len(self.thumbPaths[MIC_PATH])
+        cache = self.getThumbsCache()
+        with self._thumbsLock:
+            for i in range(firstThumbIndex, numMics):
+                for kind, srcPath, dstPath in self.getThumbTasks(i):
+                    if (dstPath in self._thumbsDone
+                            or dstPath in self._thumbsPending):
+                        continue
+                    if cache.isValid(srcPath, dstPath, self.thumbsWidth):
+                        self._thumbsDone.add(dstPath)
+                        continue
+                    if self._thumbsPool is None:
+                        self._thumbsPool = multiprocessing.Pool(self.thumbsWorkers)
+                    self._thumbsPending[dstPath] = srcPath
+                    self._thumbsPool.apply_async(
+                        makeThumbnail, (kind, srcPath, dstPath, self.thumbsWidth),
+                        callback=self._onThumbDone,
+                        error_callback=lambda e, dstPath=dstPath:
+                        self._onThumbError(dstPath, e))
+        self.checkNewThumbsReady()
+
+    def _onThumbDone(self, dstPath):
+        with self._thumbsLock:
+            srcPath = self._thumbsPending.pop(dstPath, None)
+            self._thumbsDone.add(dstPath)
+        if srcPath is not None:
+            self.getThumbsCache().add(srcPath, dstPath, self.thumbsWidth)
+        self.addChanged(dstPath)
+        self.checkNewThumbsReady()
+
+    def _onThumbError(self, dstPath, error):
+        # it will be queued again in the next report update
+        print("ERROR creating thumbnail %s: %s" % (dstPath, error))
+        with self._thumbsLock:
+            self._thumbsPending.pop(dstPath, None)
+
+    def closeThumbsPool(self):
+        if self._thumbsPool is not None:
+            self._thumbsPool.close()
+            self._thumbsPool.join()
+            self._thumbsPool = None
+
     def setUp(self):
         """Setup actions for the html report: create directories to store
         thumbnails, check if thumbnails are already generated in the
@@ -157,6 +362,8 @@ class ReportHtml:
         pwutils.makePath(join(self.reportDir, MIC_THUMBS),
                          join(self.reportDir, PSD_THUMBS),
                          join(self.reportDir, SHIFT_THUMBS))
+        # read and split the template once
+        self.reportTemplate.load()
         # check if align protocol already has thumbnails
         if (hasattr(self.alignProtocol, 'doComputeMicThumbnail')
                 and self.alignProtocol._doComputeMicThumbnail()):
@@ -191,128 +398,84 @@ class ReportHtml:
                 self.thumbPaths[PSD_THUMBS].append(psdThumb)
                 self.thumbPaths[PSD_PATH].append(psdPath)
 
-        # get alignment and mic thumbs
-        if self.alignProtocol is not None:
-            getMicFromCTF = False
-            updatedProt = getUpdatedProtocol(self.alignProtocol)
-            outputSet = getMicSet(updatedProt)
-            if outputSet is not None:
-                if micIdSet is None:
-                    micIdSet = list(outputSet.getIdSet())
-            else:
-                return
-
-        elif self.ctfProtocol is not None:
-            getMicFromCTF = True
-            updatedProt = getUpdatedProtocol(self.ctfProtocol)
-            if hasattr(updatedProt, 'outputCTF'):
-                outputSet = updatedProt.outputCTF
-                if micIdSet is None:
-                    micIdSet = list(outputSet.getIdSet())
-            else:
-                return
-        else:
+        # get alignment and mic thumbs, the sets of the cached protocol
+        # are shared with the monitors
+        prot = (self.alignProtocol if self.alignProtocol is not None
+                else self.ctfProtocol)
+        if prot is None:
             return
-
-        for micId in micIdSet[thumbsDone:]:
-            mic = outputSet[micId]
-            if getMicFromCTF:
-                mic = mic.getMicrograph()
-            if hasattr(mic, 'thumbnail'):
-                srcMicFn = abspath(mic.thumbnail.getFileName())
-            else:
-                srcMicFn = abspath(mic.getFileName())
-            micThumbFn = join(MIC_THUMBS, pwutils.replaceExt(basename(srcMicFn), ext))
-            self.thumbPaths[MIC_PATH].append(srcMicFn)
-            self.thumbPaths[MIC_THUMBS].append(micThumbFn)
-
-            shiftPlot = (getattr(mic, 'plotCart', None) or getattr(mic, 'plotGlobal', None))
-            if shiftPlot is not None:
-                shiftPath = "" if shiftPlot is None else abspath(shiftPlot.getFileName())
-                shiftCopy = "" if shiftPlot is None else join(SHIFT_THUMBS,
-                                                              pwutils.replaceExt(basename(shiftPath), ext))
-                self.thumbPaths[SHIFT_PATH].append(shiftPath)
-                self.thumbPaths[SHIFT_THUMBS].append(shiftCopy)
+        with protocolCache.lock(prot):
+            if self.alignProtocol is not None:
+                getMicFromCTF = False
+                updatedProt = protocolCache.get(self.alignProtocol)
+                outputSet = getMicSet(updatedProt)
+                if outputSet is not None:
+                    if micIdSet is None:
+                        micIdSet = list(outputSet.getIdSet())
+                else:
+                    return
+
+            elif self.ctfProtocol is not None:
+                getMicFromCTF = True
+                updatedProt = protocolCache.get(self.ctfProtocol)
+                if hasattr(updatedProt, 'outputCTF'):
+                    outputSet = updatedProt.outputCTF
+                    if micIdSet is None:
+                        micIdSet = list(outputSet.getIdSet())
+                else:
+                    return
             else:
-                if SHIFT_PATH in self.thumbPaths:
-                    self.thumbPaths.pop(SHIFT_PATH, None)
-                if SHIFT_THUMBS in self.thumbPaths:
-                    self.thumbPaths.pop(SHIFT_THUMBS, None)
-
-            self.thumbPaths[MIC_ID].append(micId)
-
-            if self.ctfProtocol is None:
+                return
 
-                def getMicPSDPath(mic):
-                    if hasattr(mic, 'psdJpeg'):
-                        return mic.psdJpeg.getFileName()
-                    elif hasattr(mic, 'psdCorr'):
-                        return mic.psdCorr.getFileName()
-                    else:
-                        return None
-
-                psdPath = getMicPSDPath(mic)
-                psdThumb = None
-                if psdPath is None:
-                    psdThumb = join(PSD_THUMBS, pwutils.replaceExt(basename(str(psdPath)), ext))
-                    self.thumbPaths[PSD_THUMBS].append(psdThumb)
-                    self.thumbPaths[PSD_PATH].append(psdPath)
+            for micId in micIdSet[thumbsDone:]:
+                micId = int(micId)  # ids may come in a NumPy array
+                mic = outputSet[micId]
+                if getMicFromCTF:
+                    mic = mic.getMicrograph()
+                if hasattr(mic, 'thumbnail'):
+                    srcMicFn = abspath(mic.thumbnail.getFileName())
                 else:
-                    if PSD_THUMBS in self.thumbPaths:
-                        self.thumbPaths.pop(PSD_THUMBS, None)
-                    if PSD_PATH in self.thumbPaths:
-                        self.thumbPaths.pop(PSD_PATH, None)
-
-    def generateReportImages(self, firstThumbIndex=0, micScaleFactor=6):
-        """ Function to generate thumbnails for the report. Uses data from
-        self.thumbPaths.
-
-        ===== Params =====
-        - firstThumbIndex: index from which we start generating thumbnails
-        - micScaleFactor: how much to reduce in size the micrographs.
-
-        """
-        ih = ImageHandler()
+                    srcMicFn = abspath(mic.getFileName())
+                micThumbFn = join(MIC_THUMBS, pwutils.replaceExt(basename(srcMicFn), ext))
+                self.thumbPaths[MIC_PATH].append(srcMicFn)
+                self.thumbPaths[MIC_THUMBS].append(micThumbFn)
+
+                shiftPlot = (getattr(mic, 'plotCart', None) or getattr(mic, 'plotGlobal', None))
+                if shiftPlot is not None:
+                    shiftPath = "" if shiftPlot is None else abspath(shiftPlot.getFileName())
+                    shiftCopy = "" if shiftPlot is None else join(SHIFT_THUMBS,
+                                                                  pwutils.replaceExt(basename(shiftPath), ext))
+                    self.thumbPaths[SHIFT_PATH].append(shiftPath)
+                    self.thumbPaths[SHIFT_THUMBS].append(shiftCopy)
+                else:
+                    if SHIFT_PATH in self.thumbPaths:
+                        self.thumbPaths.pop(SHIFT_PATH, None)
+                    if SHIFT_THUMBS in self.thumbPaths:
+                        self.thumbPaths.pop(SHIFT_THUMBS, None)
 
-        numMics = len(self.thumbPaths[MIC_PATH])
+                self.thumbPaths[MIC_ID].append(micId)
 
-        for i in range(firstThumbIndex, numMics):
-            print('Generating images for mic %d' % (i+1))
-            # mic thumbnails
-            dstImgPath = join(self.reportDir, self.thumbPaths[MIC_THUMBS][i])
-            if not exists(dstImgPath):
-                if self.micThumbSymlinks:
-                    pwutils.copyFile(self.thumbPaths[MIC_PATH][i], dstImgPath)
-                else:
-                    ih.convert(self.thumbPaths[MIC_PATH][i], pwutils.replaceExt(dstImgPath, "jpg"))
-
-            # shift plots
-            if SHIFT_THUMBS in self.thumbPaths:
-                dstImgPath = join(self.reportDir, self.thumbPaths[SHIFT_THUMBS][i])
-                if not exists(dstImgPath):
-                    pwutils.copyFile(self.thumbPaths[SHIFT_PATH][i], dstImgPath)
-
-            # Psd thumbnails
-            # If there ARE thumbnail for the PSD (no ctf protocol and
-            # moviealignment hasn't computed it
-            if PSD_THUMBS in self.thumbPaths:
                 if self.ctfProtocol is None:
-                    srcImgPath = self.thumbPaths[PSD_PATH][i]
-                    dstImgPath = join(self.reportDir, self.thumbPaths[PSD_THUMBS][i])
-                    if not exists(dstImgPath) and srcImgPath is not None:
-                        if srcImgPath.endswith('psd'):
-                            psdImg1 = ih.read(srcImgPath)
-                            psdImg1.convertPSD()
-                            psdImg1.write(dstImgPath)
-                            ih.convert(dstImgPath, pwutils.replaceExt(dstImgPath, "jpg"))
-                        else:
-                            pwutils.copyFile(srcImgPath, dstImgPath)
-                else:
-                    dstImgPath = join(self.reportDir, self.thumbPaths[PSD_THUMBS][i])
-                    if not exists(dstImgPath):
-                        ih.convert(self.thumbPaths[PSD_PATH][i], pwutils.replaceExt(dstImgPath, "jpg"))
 
-        return
+                    def getMicPSDPath(mic):
+                        if hasattr(mic, 'psdJpeg'):
+                            return mic.psdJpeg.getFileName()
+                        elif hasattr(mic, 'psdCorr'):
+                            return mic.psdCorr.getFileName()
+                        else:
+                            return None
+
+                    psdPath = getMicPSDPath(mic)
+                    psdThumb = None
+                    if psdPath is None:
+                        psdThumb = join(PSD_THUMBS, pwutils.replaceExt(basename(str(psdPath)), ext))
+                        self.thumbPaths[PSD_THUMBS].append(psdThumb)
+                        self.thumbPaths[PSD_PATH].append(psdPath)
+                    else:
+                        if PSD_THUMBS in self.thumbPaths:
+                            self.thumbPaths.pop(PSD_THUMBS, None)
+                        if PSD_PATH in self.thumbPaths:
+                            self.thumbPaths.pop(PSD_PATH, None)
 
     def processDefocusValues(self, defocusList):
         maxDefocus = self.protocol.maxDefocus.get()*1e-4
@@ -412,19 +575,29 @@ class ReportHtml:
 
         return timeSeries
 
+    def getTimingData(self):
+        """ Return the timing statistics of the monitor steps, if any. """
+        timingPath = self.protocol._getPath(MONITOR_TIMING_SQLITE)
+        if self._timingLog is None and exists(timingPath):
+            self._timingLog = MonitorTimingLog(timingPath)
+        summary = [] if self._timingLog is None else self._timingLog.getSummary()
+        return summary + [self.provider.getTimingSummary()]
+
     def getResolutionHistogram(self, resolutionValues):
         if len(resolutionValues) == 0:
             return []
-        maxValue = int(np.ceil(max(resolutionValues)))
+        maxValue = int(np.ceil(np.max(resolutionValues)))
         edges = np.append(np.arange(0, maxValue, RESOLUTION_HIST_BIN_WIDTH), maxValue)
         values, binEdges = np.histogram(resolutionValues, bins=edges, range=(0, maxValue))
         return list(zip(values, binEdges))
 
     def generate(self, finished):
         self.movieStatus = "-"
-        reportTemplate = self.getHTMLReportText()
+        # read again the template only if it has been modified
+        if self.reportTemplate.load():
+            self._shellWritten = False
 
-        if not reportTemplate:
+        if not self.reportTemplate.exists():
             raise Exception("HTML template file '%s' not found. "
                             % self.template)
 
@@ -483,65 +656,51 @@ class ReportHtml:
         runLines += ']}'
         print(runLines, "\n")
         # Ctf monitor chart data
-        data = {} if self.ctfMonitor is None else self.ctfMonitor.getData()
+        data = {}
+        if self.ctfMonitor is not None:
+            with self.ctfMonitor.lock:
+                data = self.ctfMonitor.getData()
 
+        ctfStats = {}
         if data:
             numMicsDone = len(self.thumbPaths[PSD_THUMBS])
             numMics = len(data[PSD_PATH])
-            numMicsToDo = numMics - numMicsDone
             self.getThumbPaths(ctfData=data, thumbsDone=numMicsDone, micIdSet=data['idValues'])
 
             if len(data['defocusU']) < 100:
-                data['defocusCoverage'] = self.processDefocusValues(data['defocusU'])
+                ctfStats['defocusCoverage'] = self.processDefocusValues(data['defocusU'])
             else:
-                data['defocusCoverage'] = self.processDefocusValues(data['defocusU'][:-50])
-                data['defocusCoverageLast50'] = self.processDefocusValues(data['defocusU'][-50:])
-
-            data['resolutionHistogram'] = self.getResolutionHistogram(data['resolution'])
+                ctfStats['defocusCoverage'] = self.processDefocusValues(data['defocusU'][:-50])
+                ctfStats['defocusCoverageLast50'] = self.processDefocusValues(data['defocusU'][-50:])
 
-            data['timeSeries'] = self.getTimeSeries(data)
+            ctfStats['resolutionHistogram'] = self.getResolutionHistogram(data['resolution'])
 
         else:
             # Thumbnails for Micrograph Table
             numMicsDone = len(self.thumbPaths[MIC_THUMBS])
             self.getThumbPaths(thumbsDone=numMicsDone)
             numMics = len(self.thumbPaths[MIC_PATH])
-            numMicsToDo = numMics - numMicsDone
 
-        if numMicsToDo <= 10:
-            # we have few new images, eg streaming mode, generate thumbnails now
-            self.generateReportImages(firstThumbIndex=numMicsDone)
-        else:
-            # we have many images, generate thumbs in a separate process
-            process = multiprocessing.Process(target=self.generateReportImages,
-                                              args=(numMicsDone,))
-            process.start()
+        # thumbnails are created in the background, the missing ones of the
+        # new micrographs (or of older ones whose conversion failed) are queued
+        self.submitReportImages(firstThumbIndex=self.thumbsReady)
 
         # send over only thumbnails of the mics that have been fully processed
-        self.thumbsReady = self.checkNewThumbsReady()
-        thumbsLoading = numMics - self.thumbsReady
-        for k in [MIC_THUMBS, SHIFT_THUMBS, PSD_THUMBS]:
-            if k in self.thumbPaths:
-                data[k] = self.thumbPaths[k][:self.thumbsReady] + ['']*thumbsLoading
-
-        data[MIC_ID] = self.thumbPaths[MIC_ID]
-
+        self.checkNewThumbsReady()
         reportFinished = self.thumbsReady == numMics
-
-        def convert(o):
-            if isinstance(o, np.int64): return int(o)
-            raise TypeError
-
-        ctfData = json.dumps(data, default=convert)
+        if finished and reportFinished:
+            self.closeThumbsPool()
 
         # Movie gain monitor chart data
-        data = [] if self.movieGainMonitor is None else self.movieGainMonitor.getData()
-
-        movieGainData = json.dumps(data)
+        movieGainData = []
+        if self.movieGainMonitor is not None:
+            with self.movieGainMonitor.lock:
+                movieGainData = self.movieGainMonitor.getData()
 
         # system monitor chart data
-        data = self.sysMonitor.getData()
-        systemData = json.dumps(data, default=convert)
+        with self.sysMonitor.lock:
+            systemData = self.sysMonitor.getData()
+
         tnow = datetime.now()
         args = {'projectName': projName,
                 'startTime': pwutils.dateStr(project.getCreationTime(), secs=True),
@@ -551,20 +710,41 @@ class ReportHtml:
                 'scipionVersion': os.environ['SCIPION_VERSION'],
                 'acquisitionLines': acquisitionLines,
                 'runLines': runLines,
-                'ctfData': ctfData,
-                'movieGainData': movieGainData,
-                'systemData': systemData,
-                'refresh': self.refreshSecs
+                'timingData': toJson(self.getTimingData()),
+                'refresh': self.refreshSecs,
+                'dataDir': REPORT_DATA_DIR
                 }
 
-        self.info("Writing report html to: %s" % abspath(self.reportPath))
-        pwutils.cleanPath(self.reportPath)
-        reportFile = open(self.reportPath, 'w', encoding="utf-8")
-        reportTemplate = reportTemplate % args
-        reportFile.write(reportTemplate)
-        reportFile.close()
-
-        if self.publishCmd:
+        if self.reportTemplate.hasKey(REPORT_DATA_KEY):
+            self.writeReportData(args, data, ctfStats, movieGainData,
+                                 systemData)
+            # the page is static, it does not change between calls
+            if not self._shellWritten:
+                self.writeReportText(self.reportTemplate.render(args))
+                self._shellWritten = True
+        else:
+            # customized template from a previous version, the whole
+            # report is written on each call
+            if data:
+                data.update(ctfStats)
+                data['timeSeries'] = self.getTimeSeries(data)
+
+            thumbsLoading = numMics - self.thumbsReady
+            for k in [MIC_THUMBS, SHIFT_THUMBS, PSD_THUMBS]:
+                if k in self.thumbPaths:
+                    data[k] = self.thumbPaths[k][:self.thumbsReady] + ['']*thumbsLoading
+
+            data[MIC_ID] = self.thumbPaths[MIC_ID]
+
+            args.update(ctfData=toJson(data),
+                        movieGainData=toJson(movieGainData),
+                        systemData=toJson(systemData))
+            self.writeReportText(self.reportTemplate.render(args))
+
+        if self.publisher is not None:
+            # the last publication has to be complete
+            self.publisher.publish(wait=finished and reportFinished)
+        elif self.publishCmd:
             self.info("Publishing the report:")
             cmd = self.publishCmd % {'REPORT_FOLDER': self.reportDir}
             self.info(cmd)
@@ -575,3 +755,63 @@ class ReportHtml:
             if err.decode("utf-8") != '':
                 self.info('Error publishing the report: {}'.format(err.decode("utf-8") ))
         return reportFinished
+
+    def writeReportText(self, reportText):
+        """ Write the report to a temporary file and rename it, so the
+        publisher or the browser never get a partially written report.
+        """
+        self.info("Writing report html to: %s" % abspath(self.reportPath))
+        tmpPath = self.reportPath + '.tmp'
+        with open(tmpPath, 'w', encoding="utf-8") as reportFile:
+            reportFile.write(reportText)
+        os.replace(tmpPath, self.reportPath)
+        self.addChanged(self.reportPath)
+
+    def writeReportData(self, args, ctfData, ctfStats, movieGainData,
+                        systemData):
+        """ Append the new rows of each data stream to the report data files
+        and update the report state. Only the static page is written to
+        index.html, its scripts load the data.
+        """
+        if self.dataWriter is None:
+            self.dataWriter = ReportDataWriter(self.reportDir)
+        writer = self.dataWriter
+
+        if ctfData:
+            writer.appendColumns(CTF_STREAM, ctfData,
+                                 [k for k in ctfData
+                                  if k not in [MIC_PATH, PSD_PATH, SHIFT_PATH]])
+
+        # thumbnails and ids of the micrographs table
+        if MICS_STREAM in writer.columns:
+            keys = writer.columns[MICS_STREAM]
+        else:
+            keys = [k for k in [MIC_ID, MIC_THUMBS, SHIFT_THUMBS, PSD_THUMBS]
+                    if k in self.thumbPaths]
+        numMics = len(self.thumbPaths[MIC_ID])
+        rows = [[self.thumbPaths[k][i]
+                 if i < len(self.thumbPaths.get(k, [])) else ''
+                 for k in keys]
+                for i in range(writer.getCount(MICS_STREAM), numMics)]
+        writer.append(MICS_STREAM, keys, rows)
+
+        if movieGainData:
+            writer.appendColumns(GAIN_STREAM, movieGainData,
+                                 list(movieGainData.keys()))
+
+        keys = [k for k, v in systemData.items()
+                if isinstance(v, (list, np.ndarray))]
+        writer.appendColumns(SYSTEM_STREAM, systemData, keys)
+
+        state = {'dateStr': args['dateStr'],
+                 'projectDuration': args['projectDuration'],
+                 'projectStatus': args['projectStatus'],
+                 'thumbsReady': self.thumbsReady,
+                 'ctfStats': ctfStats,
+                 'systemInfo': {k: v for k, v in systemData.items()
+                                if k not in keys}}
+        writer.writeState(state, {'acquisition': '[%s]' % args['acquisitionLines'],
+                                  'runs': '[%s]' % args['runLines'],
+                                  'timingData': args['timingData']})
+        for path in writer.popWritten():
+            self.addChanged(path)
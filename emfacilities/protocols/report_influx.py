@@ -31,14 +31,18 @@ from datetime import datetime, timedelta
 from configparser import ConfigParser
 import urllib3
 import base64
+import multiprocessing
 import time
 from emfacilities.constants import SECRETSFILE
-from .transport import Connect
+from .transport import getConnection, closeConnections, SFTP_CHANNELS
 
 import pyworkflow.utils as pwutils
 from pwem.emlib.image import ImageHandler
 
 from .summary_provider import SummaryProvider
+from .monitor_log import connectLog, MonitorWatermarks, MONITOR_TIMING_SQLITE
+from .thumbnails import createThumbnail
+from .influx_writer import InfluxBatchWriter, INFLUX_BATCH_SIZE
 
 
 # --------------------- CONSTANTS -----------------------------------
@@ -52,6 +56,94 @@ SHIFT_PATH = 'imgShiftPath'
 # used in the execution.summary.template.html to read data (where
 # they will need to be changed if they're changed here)
 CONFILE = 'monitor.conf'
+# points not sent yet to the database
+INFLUX_SPOOL = 'influx_spool.txt'
+# CTF rows whose images are converted and uploaded at a time
+TRANSFER_CHUNK = 50
+# times the images of a CTF row are tried before giving up
+TRANSFER_MAX_ATTEMPTS = 5
+
+
+def convertTransferImages(row):
+    """ Create the JPGs of the PSD and the micrograph of a TransferLog row.
+    It is run by the conversion pool processes. Return (id, error).
+    """
+    ctfId, psdPath, psdJpg, micPath, micJpg = row
+    try:
+        ImageHandler().convert(psdPath, psdJpg)
+        createThumbnail(micPath, micJpg)
+        return ctfId, None
+    except Exception as e:
+        return ctfId, str(e)
+
+
+class TransferLog:
+    """ Table with the images of each CTF row that have to be uploaded to
+    the web server, so the pending ones are known without querying influx.
+    """
+    COLUMNS = ['id', 'time', 'shiftPlotPath', 'psdPath', 'psdJpg',
+               'micPath', 'micJpg', 'psdField', 'micField']
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS transfers(
+                                id INTEGER PRIMARY KEY,
+                                time TEXT,
+                                shiftPlotPath TEXT,
+                                psdPath TEXT,
+                                psdJpg TEXT,
+                                micPath TEXT,
+                                micJpg TEXT,
+                                psdField TEXT,
+                                micField TEXT,
+                                transferred INTEGER DEFAULT 0,
+                                attempts INTEGER DEFAULT 0)""")
+        # logs created before the attempts were counted
+        columns = [row[1] for row in
+                   self.conn.execute("PRAGMA table_info(transfers)")]
+        if 'attempts' not in columns:
+            self.conn.execute("ALTER TABLE transfers "
+                              "ADD COLUMN attempts INTEGER DEFAULT 0")
+
+    def add(self, rows):
+        """ Add rows (dictionaries with the COLUMNS keys). Rows already
+        added are ignored.
+        """
+        self.conn.execute("BEGIN")
+        self.conn.executemany("INSERT OR IGNORE INTO transfers(%s) VALUES(%s)"
+                              % (", ".join(self.COLUMNS),
+                                 ", ".join(["?"] * len(self.COLUMNS))),
+                              [tuple(r.get(c) for c in self.COLUMNS)
+                               for r in rows])
+        self.conn.execute("COMMIT")
+
+    def getPending(self, limit=TRANSFER_CHUNK, beforeId=None):
+        """ Return the newest rows not transferred yet, skipping those
+        that failed too many times. With beforeId only the older rows
+        are returned, to page past the rows already tried.
+        """
+        cur = self.conn.cursor()
+        cur.row_factory = None
+        query = ("SELECT %s FROM transfers WHERE transferred = 0 "
+                 "AND attempts < ?" % ", ".join(self.COLUMNS))
+        args = [TRANSFER_MAX_ATTEMPTS]
+        if beforeId is not None:
+            query += " AND id < ?"
+            args.append(beforeId)
+        cur.execute(query + " ORDER BY id DESC LIMIT ?", args + [limit])
+        return [dict(zip(self.COLUMNS, row)) for row in cur.fetchall()]
+
+    def setFailed(self, ids):
+        self.conn.execute("BEGIN")
+        self.conn.executemany("UPDATE transfers SET attempts = attempts + 1 "
+                              "WHERE id = ?", [(i,) for i in ids])
+        self.conn.execute("COMMIT")
+
+    def setTransferred(self, ids):
+        self.conn.execute("BEGIN")
+        self.conn.executemany("UPDATE transfers SET transferred = 1 "
+                              "WHERE id = ?", [(i,) for i in ids])
+        self.conn.execute("COMMIT")
 
 class ReportInflux:
     """ Create a report (html or influxdb) with a summary of the processing.
@@ -91,31 +183,19 @@ class ReportInflux:
             self.refreshSecs = 10
         self.ih = ImageHandler()
 
-        # Create a config file to store data we are going to
-        # need in other iteration. So far is only used by influx
-        # but it certainly  be used by hte standard html
-        # for example to decide which files need to be tranfered
-        self.confFileName = self.protocol._getTmpPath(CONFILE)
-        if not os.path.isfile(self.confFileName):
-            # Create the configuration file as it doesn't exist yet
-            self.confParser = ConfigParser()
-            self.confParser.add_section("project")
-            self.confParser.set("project", "projectName",
-                           self.protocol.getProject().getShortName())
-            self.confParser.set("project", "properties", "1")
-            self.confParser.set("project", "acquisition", "1")
-            self.confParser.set("project", "summary", "1")
-            self.confParser.add_section('ctf')
-            self.confParser.set("ctf", "lastId", "0")
-            self.confParser.add_section("gain")
-            self.confParser.set("gain", "lastId", "0")
-            self.confParser.add_section("system")
-            self.confParser.set("system", "lastId", "0")
-            with open(self.confFileName, 'w') as confFile:
-                self.confParser.write(confFile)
-        else:
-            self.confParser = ConfigParser()
-            self.confParser.read(self.confFileName)
+        # Last rows sent of each section. They were stored in the CONFILE
+        # file, which is only read to continue the runs that created it
+        conn = connectLog(self.protocol._getPath(MONITOR_TIMING_SQLITE))
+        self.watermarks = MonitorWatermarks(conn)
+        self.transferLog = TransferLog(conn)
+        self._newTransfers = []
+        self.convertWorkers = max(1, kwargs.get('convertWorkers', 2))
+        self.transferChannels = kwargs.get('transferChannels', SFTP_CHANNELS)
+        self._convertPool = None
+        self.marks = self.watermarks.getAll()
+        if not self.marks:
+            self.marks = self._readConfFile()
+            self.watermarks.update(self.marks)
 
         # open connection to database
         # I put this import here so users with no database
@@ -149,6 +229,8 @@ class ReportInflux:
         self.keyfiletype = confParser.get('paramiko', 'keyfiletype')
         self.remote_path = confParser.get('paramiko', 'remote_path')
         self.hostparamiko = confParser.get('paramiko', 'hostparamiko')
+        batchSize = confParser.getint('influx', 'batchSize',
+                                      fallback=INFLUX_BATCH_SIZE)
         try:
             # since I am using a self generated certificate
             # the certificate can not be verified against a
@@ -168,6 +250,9 @@ class ReportInflux:
             # InfluxDB does nothing and does not return an error.
             # self.client.create_database("scipion")
             self.client.switch_database(self.dataBaseName)
+            self.writer = InfluxBatchWriter(
+                self.client, self.protocol._getTmpPath(INFLUX_SPOOL),
+                batchSize=batchSize)
 
             self.projectName = slugify(self.protocol.getProject().getShortName())
 
@@ -186,6 +271,24 @@ class ReportInflux:
         except Exception as e:
             print("Error:", e)
 
+    def _readConfFile(self):
+        """ Return the initial watermarks, from the CONFILE file if the
+        report was started by a previous version of the protocol.
+        """
+        marks = {'properties': 1, 'acquisition': 1, 'summary': 1,
+                 'ctf': 0, 'gain': 0, 'system': 0}
+        confFileName = self.protocol._getTmpPath(CONFILE)
+        if os.path.isfile(confFileName):
+            confParser = ConfigParser()
+            confParser.read(confFileName)
+            for key in ['properties', 'acquisition', 'summary']:
+                marks[key] = confParser.getint('project', key,
+                                               fallback=marks[key])
+            for key in ['ctf', 'gain', 'system']:
+                marks[key] = confParser.getint(key, 'lastId',
+                                               fallback=marks[key])
+        return marks
+
     #def __del__(self):
     #    if self.influxsb:
     #        self.client.close()
@@ -217,7 +320,7 @@ class ReportInflux:
         tags['section'] = 'properties'
         pointsDict['tags'] = tags
         fields = {}
-        firstTime = self.confParser.getint("project", "properties")
+        firstTime = self.marks['properties']
 
         fieldKeys  = {'dateStr': 4, 'projectDuration': 3, 'projectStatus': 2}
         fieldNames = {'dateStr': "<b>Last Update</b>",
@@ -236,10 +339,8 @@ class ReportInflux:
             # str is need because all values must have the same type
             fields['valueStr'] = str(eval(metric)[0])
             pointsDict['fields'] = fields
-            self.client.write_points([pointsDict])
-        self.confParser.set("project", "properties", "0")
-        with open(self.confFileName, 'w') as confFile:
-            self.confParser.write(confFile)
+            self.writer.addPoint(pointsDict)
+        self.marks['properties'] = 0
 
         # acquisition section
         self.provider.refreshObjects()
@@ -250,7 +351,7 @@ class ReportInflux:
         pointsDict['tags'] = tags
 
         fields = {}
-        firstTime = self.confParser.getint("project", "acquisition")
+        firstTime = self.marks['acquisition']
 
         if firstTime:
             delta = 0
@@ -260,13 +361,11 @@ class ReportInflux:
                 fields['metric'] = "<b>" + metricName + "</b>"
                 fields['valueNum'] = float(value)
                 pointsDict['fields'] = fields
-                self.client.write_points([pointsDict])
+                self.writer.addPoint(pointsDict)
                 delta = delta -1
                 # update first time only if some date has been read.
                 # do not place this upside the loop
-                self.confParser.set("project", "acquisition", "0")
-                with open(self.confFileName, 'w') as confFile:
-                    self.confParser.write(confFile)
+                self.marks['acquisition'] = 0
 
         # send summary section
         pointsDict = {}  # dictionary for data points
@@ -291,12 +390,14 @@ class ReportInflux:
                 fields['output'] = obj.output
                 fields['size'] = str(obj.outSize)
             pointsDict['fields'] = fields
-            self.client.write_points([pointsDict])
+            self.writer.addPoint(pointsDict)
 
         # Ctf monitor chart data
-        last_id = self.confParser.getint("ctf", "lastId")
-        listDictionaryCTF = {} if self.ctfMonitor is None else \
-            self.ctfMonitor.getData(lastId=last_id)
+        last_id = self.marks['ctf']
+        listDictionaryCTF = {}
+        if self.ctfMonitor is not None:
+            with self.ctfMonitor.lock:
+                listDictionaryCTF = self.ctfMonitor.getData(lastId=last_id)
         if listDictionaryCTF:
             pointsDict = {}  # dictionary for data points
             pointsDict['measurement'] = self.projectName
@@ -345,18 +446,20 @@ class ReportInflux:
                         fields[key] = ctf[key]
                 # while be use to control image creation
                 fields["transferImage"] = False
+                self._newTransfers.append(self._getTransferRow(
+                    ctf['id'], pointsDict.get('time'), fields))
                 pointsDict['fields'] = fields
                 pointsDict['tags'] = tags
-                self.client.write_points([pointsDict])
+                self.writer.addPoint(pointsDict)
                 last_id += 1
-            self.confParser.set("ctf", "lastId", str(last_id))
-            with open(self.confFileName, 'w') as confFile:
-                self.confParser.write(confFile)
+            self.marks['ctf'] = last_id
 
         # GAIN Section
-        last_id = self.confParser.getint("gain", "lastId")
-        listDictionaryGain = {} if self.movieGainMonitor is None else \
-            self.movieGainMonitor.getData(lastId=last_id)
+        last_id = self.marks['gain']
+        listDictionaryGain = {}
+        if self.movieGainMonitor is not None:
+            with self.movieGainMonitor.lock:
+                listDictionaryGain = self.movieGainMonitor.getData(lastId=last_id)
         if listDictionaryGain:
             pointsDict = {}  # dictionary for data points
             pointsDict['measurement'] = self.projectName
@@ -374,16 +477,16 @@ class ReportInflux:
                 # put current time
                 localNow = tnow + timedelta(seconds=counter)
                 pointsDict['time'] = localNow # .strftime('%Y-%m-%dT%H:%M:%SZ')
-                self.client.write_points([pointsDict])
+                self.writer.addPoint(pointsDict)
                 last_id += 1
-            self.confParser.set("gain", "lastId", str(last_id))
-            with open(self.confFileName, 'w') as confFile:
-                self.confParser.write(confFile)
+            self.marks['gain'] = last_id
 
         # SYSTEM data
-        last_id = self.confParser.getint("system", "lastId")
-        listDictionarySystem = {} if self.sysMonitor is None else \
-            self.sysMonitor.getData(lastId=last_id)
+        last_id = self.marks['system']
+        listDictionarySystem = {}
+        if self.sysMonitor is not None:
+            with self.sysMonitor.lock:
+                listDictionarySystem = self.sysMonitor.getData(lastId=last_id)
         if listDictionarySystem:
             pointsDict = {}  # dictionary for data points
             pointsDict['measurement'] = self.projectName
@@ -400,95 +503,143 @@ class ReportInflux:
                     else:
                         fields[key] = system[key]
                 pointsDict['fields'] = fields
-                self.client.write_points([pointsDict])
+                self.writer.addPoint(pointsDict)
                 last_id += 1
-            self.confParser.set("system", "lastId", str(last_id))
-            with open(self.confFileName, 'w') as confFile:
-                self.confParser.write(confFile)
+            self.marks['system'] = last_id
+        # all the points of this update, in batches, and then where the
+        # next update has to start (the points not sent are spooled)
+        self.writer.flush()
+        if self._newTransfers:
+            self.transferLog.add(self._newTransfers)
+            self._newTransfers = []
+        self.watermarks.update(self.marks)
         self.transferFiles()
+        if finished:
+            self.closeConvertPool()
+            closeConnections()
         return last_id # reportFinished
 
 
+    def _getTransferRow(self, ctfId, time, fields):
+        """ Return the TransferLog row of a CTF point. psdField and micField
+        are the values of the point fields once the images are uploaded.
+        """
+        psdPng = fields.get('psdPathLocalPng')
+        micPng = fields.get('micPathLocalPng')
+        return {'id': ctfId, 'time': time,
+                'shiftPlotPath': fields.get('shiftPlotPathLocal'),
+                'psdPath': fields.get('psdPathLocal'),
+                'psdJpg': pwutils.replaceExt(psdPng, 'jpg') if psdPng else None,
+                'micPath': fields.get('micPathLocal'),
+                'micJpg': pwutils.replaceExt(micPng, 'jpg') if micPng else None,
+                'psdField': fields.get('psdPath', '').replace('.png', '.jpg'),
+                'micField': fields.get('micPath', '').replace('.png', '.jpg')}
+
+    def getConvertPool(self):
+        if self._convertPool is None:
+            self._convertPool = multiprocessing.Pool(self.convertWorkers)
+        return self._convertPool
+
+    def closeConvertPool(self):
+        if self._convertPool is not None:
+            self._convertPool.close()
+            self._convertPool.join()
+            self._convertPool = None
+
     def transferFiles(self):
-        # get images that need to  be transfered
-        # in grupos of 10 images
+        """ Upload the images of the CTF rows not transferred yet.
+        The JPGs are created by a pool of processes and each one is
+        uploaded as soon as it is ready, over several SFTP channels.
+        """
         start_time = time.time()
-        query = '''select * 
-                   from "%s"  
-                   where section = 'ctf'
-                     and transferImage = false
-                   order by time desc
-                   limit 10'''% self.projectName
-
-        result = self.client.query(query)
-        if len(result) < 1:
+        rows = self.transferLog.getPending()
+        if not rows:
             return True
- 
-        connect = Connect(host=self.hostparamiko,
-                          port=22,
-                          username= deCrypt(self.usernameParamiko),
-                          password=None,
-                          keyfilepath=deCrypt(self.keyfilepath),
-                          keyfiletype=deCrypt(self.keyfiletype),
-                          remote_path=self.remote_path,
-                          projectName=self.projectName)
-
-        while True:
-            result = self.client.query(query)
-            source = []
-            target = []
-            newPoints = []
-            points = result.get_points()
-            for point in points:
-                tags = {}
-                tags['section'] = 'ctf'
-                pointsDict = {}
-                source.append(point['shiftPlotPathLocal']) # shift plot
-                source.append(pwutils.replaceExt(point['psdPathLocalPng'], 'jpg'))    # psd image
-                source.append(pwutils.replaceExt(point['micPathLocalPng'], 'jpg'))    # micrograph
-
-                self.ih.convert(point['psdPathLocal'], pwutils.replaceExt(point['psdPathLocalPng'], 'jpg'))
-
-                self.ih.convert(point['micPathLocal'], pwutils.replaceExt(point['micPathLocalPng'], 'jpg'))
-
-                # add files to transfer list
-                target.append(os.path.join(self.projectName,
-                                           basename(point['shiftPlotPathLocal'])))
-                target.append(os.path.join(self.projectName, basename(pwutils.replaceExt(point['psdPathLocalPng'], 'jpg'))))
-                target.append(os.path.join(self.projectName, basename(pwutils.replaceExt(point['micPathLocalPng'], 'jpg'))))
-                #
-                point['transferImage'] = True
-                pointsDict['time'] = point['time']
-                tags['id'] = point['id']
-                del point['time']
-                del point['section']
-                del point['id']
-                point['micPath'] = point['micPath'].replace('.png', '.jpg')
-                point['psdPath'] = point['psdPath'].replace('.png', '.jpg')
-                pointsDict['fields'] = point
-                pointsDict['tags'] = tags
-                pointsDict['measurement'] = self.projectName
-                newPoints.append(pointsDict)
-            try:
-                connect.put(source, target)
-            except Exception as e:
-                print("Error tranfering files: ", e)
-                return False # do not mark files are read
-            # update influx
-            try:
-                self.client.write_points(points=newPoints)
-            except Exception as e:
-                print("Error updating database: ", e)
-                return False # do not mark files are read
-
-            elapsed_time = time.time() - start_time
-            if elapsed_time > self.refreshSecs:
-                break
-            elif len(result) == 0:
+
+        # the connection is kept open between reports
+        connect = getConnection(host=self.hostparamiko,
+                                port=22,
+                                username= deCrypt(self.usernameParamiko),
+                                password=None,
+                                keyfilepath=deCrypt(self.keyfilepath),
+                                keyfiletype=deCrypt(self.keyfiletype),
+                                remote_path=self.remote_path,
+                                projectName=self.projectName)
+        while rows:
+            if self._transferRows(connect, rows) is None:
+                break  # server or database down, retry next time
+            if time.time() - start_time > self.refreshSecs:
                 break
-        connect.close()
+            # the failed rows are left for the next time
+            rows = self.transferLog.getPending(
+                beforeId=min(row['id'] for row in rows))
         return True
 
+    def _transferRows(self, connect, rows):
+        """ Upload the images of rows. Return the number of rows done, those
+        with all their files uploaded, or None when nothing could be
+        uploaded or influx could not be updated.
+        """
+        rowsDict = {row['id']: row for row in rows}
+        expected = {row['id']: ([row['shiftPlotPath']] if row['shiftPlotPath'] else [])
+                    + [row['psdJpg'], row['micJpg']] for row in rows}
+
+        def filesToUpload():
+            # the shift plots are already created, the JPGs are uploaded
+            # in the order they are converted
+            for row in rows:
+                if row['shiftPlotPath']:
+                    yield row['shiftPlotPath'], self._getTarget(row['shiftPlotPath'])
+            jobs = [(row['id'], row['psdPath'], row['psdJpg'],
+                     row['micPath'], row['micJpg']) for row in rows]
+            for ctfId, error in self.getConvertPool().imap_unordered(
+                    convertTransferImages, jobs):
+                if error is not None:
+                    print("Error converting images of ctf %s: %s"
+                          % (ctfId, error))
+                    continue
+                row = rowsDict[ctfId]
+                for path in [row['psdJpg'], row['micJpg']]:
+                    yield path, self._getTarget(path)
+
+        results = connect.putMany(filesToUpload(), self.transferChannels)
+        uploaded = set()
+        for local, remote, error in results:
+            if error is None:
+                uploaded.add(local)
+            else:
+                print("Error transferring %s: %s" % (local, error))
+        if not uploaded:
+            return None  # the attempts are not counted if the server is down
+        # rows with a file not converted, not uploaded or never tried are
+        # transferred again later, up to TRANSFER_MAX_ATTEMPTS times
+        failedIds = [ctfId for ctfId in rowsDict
+                     if not all(path in uploaded for path in expected[ctfId])]
+        self.transferLog.setFailed(failedIds)
+        rowsDict = {ctfId: row for ctfId, row in rowsDict.items()
+                    if ctfId not in failedIds}
+
+        if not rowsDict:
+            return 0
+        # mark the points in influx, only the fields that change
+        newPoints = [{'measurement': self.projectName,
+                      'time': row['time'],
+                      'tags': {'section': 'ctf', 'id': row['id']},
+                      'fields': {'transferImage': True,
+                                 'micPath': row['micField'],
+                                 'psdPath': row['psdField']}}
+                     for row in rowsDict.values()]
+        try:
+            self.client.write_points(points=newPoints)
+        except Exception as e:
+            print("Error updating database: ", e)
+            return None  # they will be transferred again
+        self.transferLog.setTransferred(rowsDict.keys())
+        return len(rowsDict)
+
+    def _getTarget(self, localPath):
+        return os.path.join(self.projectName, basename(localPath))
+
 def slugify(text):
     """
     Remove character that can not be used in databases
@@ -0,0 +1,190 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Publication of the html report files that changed since the last update.
+"""
+
+import os
+import shutil
+import threading
+from os.path import join, relpath, dirname, exists, expanduser
+from urllib.parse import urlparse, parse_qs, unquote
+
+import pyworkflow.utils as pwutils
+
+from .report_data import REPORT_STATE_FILE
+
+PUBLISH_SCHEMES = ('file', 'sftp')
+DEFAULT_SSH_KEY = '~/.ssh/id_rsa'
+
+
+def isPublishTarget(publishCmd):
+    """ Return True if publishCmd is a target url (file:// or sftp://)
+    handled by ReportPublisher instead of a shell command.
+    """
+    return urlparse(publishCmd.strip()).scheme in PUBLISH_SCHEMES
+
+
+def checkPublishTarget(target):
+    """ Return an error message if the target can not be used. """
+    url = urlparse(target.strip())
+    if url.scheme == 'file':
+        path = unquote(url.path)
+        parent = path if exists(path) else dirname(path.rstrip('/'))
+        if not os.access(parent, os.W_OK):
+            return "Can not write in %s" % parent
+    elif not url.hostname or not url.username:
+        return "The sftp target must be sftp://user@host[:port]/path"
+    return None
+
+
+class LocalBackend:
+    """ Copy the files to a local (or mounted) directory. """
+    def __init__(self, path):
+        self.path = path
+
+    def putMany(self, files):
+        results = []
+        for local, remote in files:
+            dst = join(self.path, remote)
+            try:
+                pwutils.makePath(dirname(dst))
+                # the readers never see a partially copied file
+                shutil.copyfile(local, dst + '.tmp')
+                os.replace(dst + '.tmp', dst)
+                results.append((local, remote, None))
+            except (IOError, OSError) as e:
+                results.append((local, remote, str(e)))
+        return results
+
+
+class SftpBackend:
+    """ Upload the files with the shared transport.Connect of the host. """
+    def __init__(self, url):
+        from .transport import getConnection
+        query = parse_qs(url.query)
+        keyfile = expanduser(query.get('key', [DEFAULT_SSH_KEY])[0])
+        keytype = query.get('keytype', ['RSA'])[0]
+        self.connect = getConnection(url.hostname, url.port or 22,
+                                     unquote(url.username), None,
+                                     keyfile, keytype,
+                                     unquote(url.path), '')
+
+    def putMany(self, files):
+        # the readers never see a partially uploaded file
+        return self.connect.putMany(files, atomic=True)
+
+
+def createBackend(target):
+    url = urlparse(target.strip())
+    if url.scheme == 'file':
+        return LocalBackend(unquote(url.path))
+    return SftpBackend(url)
+
+
+class ReportPublisher:
+    """ Copy the report to the target given as file:///path or
+    sftp://user@host[:port]/path[?key=keyFile&keytype=RSA|DSA].
+
+    The first publication copies the whole report dir, then only the
+    files marked with addChanged() are copied. Each publication runs in
+    a background thread; the files changed while it runs are sent in the
+    next one. The data files are sent before the state and the page, so
+    the page never refers to data that is not published yet.
+    """
+    def __init__(self, reportDir, target):
+        self.reportDir = reportDir
+        self.target = target
+        self._backend = None
+        self._changed = set()
+        self._fullSync = True
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def addChanged(self, path):
+        with self._lock:
+            self._changed.add(path)
+
+    def _getPending(self):
+        with self._lock:
+            if self._fullSync:
+                self._fullSync = False
+                for root, _, files in os.walk(self.reportDir):
+                    self._changed.update(join(root, f) for f in files
+                                         if not f.endswith('.tmp'))
+            changed, self._changed = self._changed, set()
+
+        return sorted(p for p in changed if exists(p))
+
+    @staticmethod
+    def _getStage(path):
+        """ The data files go first, then the state and the page. """
+        name = os.path.basename(path)
+        if name.endswith('.html'):
+            return 2
+        return 1 if name == REPORT_STATE_FILE else 0
+
+    def _push(self, paths):
+        failed = []
+        try:
+            if self._backend is None:
+                self._backend = createBackend(self.target)
+            for stage in range(3):
+                results = self._backend.putMany(
+                    (p, relpath(p, self.reportDir)) for p in paths
+                    if self._getStage(p) == stage)
+                for local, remote, error in results:
+                    if error:
+                        print("ERROR publishing %s: %s" % (remote, error))
+                        failed.append(local)
+                if failed:
+                    # do not publish a state that refers to missing data
+                    failed.extend(p for p in paths if self._getStage(p) > stage)
+                    break
+        except Exception as e:
+            print("ERROR publishing the report to %s: %s" % (self.target, e))
+            failed = paths
+        # they will be sent again in the next publication
+        with self._lock:
+            self._changed.update(failed)
+
+    def publish(self, wait=False):
+        """ Send the changed files in the background. If wait is True, wait
+        until all the changed files (also the ones marked during a previous
+        publication still running) are sent.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            if not wait:
+                return  # the changes are sent in the next publication
+            self._thread.join()
+        paths = self._getPending()
+        if not paths:
+            return
+        self._thread = threading.Thread(target=self._push, args=(paths,),
+                                        daemon=True)
+        self._thread.start()
+        if wait:
+            self._thread.join()
@@ -0,0 +1,205 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Bulk access to the sqlite tables of the Scipion sets, for the protocols
+that handle millions of items and only need some of their columns.
+"""
+
+import os
+import sqlite3 as lite
+from urllib.parse import quote
+
+import numpy as np
+
+
+def connectSet(dbPath):
+    """ Open read only the sqlite file of a set. """
+    return lite.connect('file:%s?mode=ro' % quote(os.path.abspath(dbPath)),
+                        uri=True)
+
+
+def readTableColumns(conn, labels, prefix='', skipNull=False):
+    """ Return a dictionary {label: array} with the values of the items in
+    the table prefix + 'Objects', sorted by id. The labels are the item
+    attributes as stored in the Classes table (e.g. '_micId' or
+    '_coordinate._x') or 'id'. A label can also be a tuple of attributes,
+    the first one not NULL is read (attributes not in the table are
+    ignored). If skipNull, the items with some NULL value are discarded.
+    """
+    mapping = dict(conn.execute("SELECT label_property, column_name "
+                                "FROM %sClasses" % prefix).fetchall())
+    mapping['id'] = 'id'
+    exprs = []
+    for label in labels:
+        columns = [mapping[alt] for alt in
+                   (label if isinstance(label, tuple) else (label,))
+                   if alt in mapping]
+        if not columns:
+            raise ValueError("%sObjects has no column %s" % (prefix, label))
+        exprs.append(columns[0] if len(columns) == 1 else
+                     "COALESCE(%s)" % ", ".join(columns))
+
+    sql = "SELECT %s FROM %sObjects" % (", ".join(exprs), prefix)
+    if skipNull:
+        sql += " WHERE " + " AND ".join("%s IS NOT NULL" % e for e in exprs)
+    rows = conn.execute(sql + " ORDER BY id").fetchall()
+    if not rows:
+        return {label: np.empty(0, dtype=np.int64) for label in labels}
+    return {label: np.array(values) for label, values in zip(labels, zip(*rows))}
+
+
+def readSetColumns(dbPath, labels, prefix='', skipNull=False):
+    """ readTableColumns of the set sqlite dbPath. """
+    conn = connectSet(dbPath)
+    try:
+        return readTableColumns(conn, labels, prefix, skipNull)
+    finally:
+        conn.close()
+
+
+def readSetIds(scipionSet):
+    """ Return a sorted NumPy array with the ids of all the items (enabled
+    or not, as when iterating the set) read directly from the set sqlite.
+    """
+    return readSetColumns(scipionSet.getFileName(), ['id'],
+                          getTablePrefix(scipionSet.getPrefix()))['id']
+
+
+def readClassesItemIds(classesSet):
+    """ Return the arrays (itemIds, classIds) with the ids of the items of
+    all the classes of a set of classes and the id of their class. The
+    items of each class are stored in the tables with prefix ClassXXX_.
+    """
+    conn = connectSet(classesSet.getFileName())
+    try:
+        tables = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")}
+        itemIds, classIds = [], []
+        for classId in readTableColumns(conn, ['id'])['id'].tolist():
+            prefix = 'Class%03d_' % classId
+            if prefix + 'Objects' in tables:
+                ids = readTableColumns(conn, ['id'], prefix)['id']
+                itemIds.append(ids)
+                classIds.append(np.full(len(ids), classId, dtype=np.int64))
+    finally:
+        conn.close()
+    if not itemIds:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(itemIds), np.concatenate(classIds)
+
+
+def getTablePrefix(prefix):
+    """ Table prefix as used by the set mappers (e.g. Class001 -> Class001_). """
+    prefix = (prefix or '').strip()
+    return prefix + '_' if prefix and not prefix.endswith('_') else prefix
+
+
+def _createTablesFrom(conn, srcPrefix, dstPrefix):
+    """ Create in the main database the set tables missing, with the schema
+    of the ones in the attached database src. The Classes rows are copied.
+    """
+    existing = {row[0] for row in conn.execute(
+        "SELECT name FROM main.sqlite_master WHERE type='table'")}
+    for srcName, dstName in [('Properties', 'Properties'),
+                             (srcPrefix + 'Classes', dstPrefix + 'Classes'),
+                             (srcPrefix + 'Objects', dstPrefix + 'Objects')]:
+        if dstName in existing:
+            continue
+        sql, = conn.execute("SELECT sql FROM src.sqlite_master WHERE "
+                            "type='table' AND name=?", (srcName,)).fetchone()
+        conn.execute(sql.replace(srcName, 'main.' + dstName, 1))
+        if srcName.endswith('Classes'):
+            conn.execute("INSERT INTO main.%s SELECT * FROM src.%s"
+                         % (dstName, srcName))
+
+
+def copySetRows(srcPath, dstPath, ids=None, srcPrefix='', dstPrefix='',
+                idMap=None):
+    """ Copy, in a single transaction, the items of the set sqlite srcPath
+    whose id is in the array ids (all if None) to the set sqlite dstPath.
+    The tables missing in dstPath are created as in srcPath, otherwise
+    the columns are matched by attribute through the Classes tables.
+    idMap is an optional (label, {value: id}) pair: only the items whose
+    label attribute has one of the values are copied, stored with its id,
+    e.g. a CTF with the id of its micrograph. Items whose (new) id is
+    already in dstPath are not copied. Return the number of copied items.
+    """
+    srcPrefix, dstPrefix = getTablePrefix(srcPrefix), getTablePrefix(dstPrefix)
+    conn = lite.connect('file:%s' % quote(os.path.abspath(dstPath)),
+                        uri=True, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS src", (
+            'file:%s?mode=ro' % quote(os.path.abspath(srcPath)),))
+        if conn.execute("SELECT name FROM src.sqlite_master WHERE type='table' "
+                        "AND name=?", (srcPrefix + 'Objects',)).fetchone() is None:
+            return 0  # no item was ever added to the set
+        conn.execute("BEGIN")
+        try:
+            _createTablesFrom(conn, srcPrefix, dstPrefix)
+            srcColumns = dict(conn.execute("SELECT label_property, column_name "
+                                           "FROM src.%sClasses" % srcPrefix))
+            dstColumns = dict(conn.execute("SELECT label_property, column_name "
+                                           "FROM main.%sClasses" % dstPrefix))
+            # the row of the item itself (self) has no column
+            labels = [label for label in dstColumns
+                      if label in srcColumns and label != 'self']
+            dstCols = ['id', 'enabled', 'label', 'comment', 'creation']
+            srcCols = list(dstCols)
+            dstCols += [dstColumns[label] for label in labels]
+            srcCols += [srcColumns[label] for label in labels]
+
+            source = "src.%sObjects s" % srcPrefix
+            if idMap is not None:
+                label, newIds = idMap
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS copyIdMap("
+                             "value PRIMARY KEY, id INTEGER)")
+                conn.execute("DELETE FROM temp.copyIdMap")
+                conn.executemany("INSERT OR REPLACE INTO temp.copyIdMap "
+                                 "VALUES(?, ?)", newIds.items())
+                # the items without a new id are not copied
+                source += (" JOIN temp.copyIdMap m ON m.value = s.%s"
+                           % srcColumns[label])
+                srcCols[0] = "m.id"
+            srcCols = [c if c == "m.id" else "s." + c for c in srcCols]
+
+            sql = ("INSERT OR IGNORE INTO main.%sObjects(%s) SELECT %s FROM %s"
+                   % (dstPrefix, ", ".join(dstCols), ", ".join(srcCols),
+                      source))
+            if ids is not None:
+                conn.execute("CREATE TEMP TABLE IF NOT EXISTS copyIds("
+                             "id INTEGER PRIMARY KEY)")
+                conn.execute("DELETE FROM temp.copyIds")
+                conn.executemany("INSERT OR IGNORE INTO temp.copyIds VALUES(?)",
+                                 zip(np.asarray(ids).tolist()))
+                sql += " WHERE s.id IN (SELECT id FROM temp.copyIds)"
+            count = conn.execute(sql).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    return count
@@ -25,12 +25,15 @@
 # *
 # **************************************************************************
 
+import time
+
 import pyworkflow.object as pwobj
 from pyworkflow.gui.tree import TreeProvider
-from pyworkflow.protocol import getUpdatedProtocol
 
 from pwem.protocols import ProtImportImages
 
+from .protocol_monitor import protocolCache, getFileKey
+
 
 class SummaryProvider(TreeProvider):
     """Create the tree elements for a Protocol run"""
@@ -41,58 +44,95 @@ class SummaryProvider(TreeProvider):
                                    ('Number', 100)]
         self._parentDict = {}
         self.acquisition = []
+        # protocols (see ProtocolCache) and output sets are only read
+        # again when their sqlite files are modified
+        self._sets = {}  # output set id: (file key, size, sampling rate)
+        self.refreshStats = {'runs': 0, 'totalTime': 0., 'maxTime': 0.,
+                             'lastTime': 0., 'setsReopened': 0}
         self.refreshObjects()
 
     def getObjects(self):
         return self._objects
 
+    def _getSetInfo(self, outSetId, outSet):
+        """ Return (size, sampling rate) of the output set. """
+        fileKey = getFileKey(outSet.getFileName())
+        cached = self._sets.get(outSetId)
+        if fileKey is not None and cached is not None and cached[0] == fileKey:
+            return cached[1:]
+        outSet.load()
+        outSet.loadAllProperties()
+        info = (outSet.getSize(), outSet.getSamplingRate()
+                if hasattr(outSet, 'getSamplingRate') else None)
+        outSet.close()
+        self._sets[outSetId] = (fileKey,) + info
+        self.refreshStats['setsReopened'] += 1
+        return info
+
     def refreshObjects(self):
-        objects = []
-        objIds = []  # need to store ids too to avoid duplication in runs table
+        t0 = time.time()
+        objects = {}  # use the ids to avoid duplication in runs table
 
         def addObj(objId, name, output='', size='', parent=None):
-            if objId not in objIds:
+            if objId not in objects:
                 obj = pwobj.Object(objId=objId)
                 obj.name = name
                 obj.output = output
                 obj.outSize = size
                 obj._objParent = parent
-                objIds.append(objId)
-                objects.append(obj)
+                objects[objId] = obj
                 return obj
             else:
                 return None
 
-        prots = [getUpdatedProtocol(p) for p in self.protocol.getInputProtocols()]
-
-        for prot in prots:
-            pobj = addObj(prot.getObjId(),
-                          '%s (id=%s)' % (prot.getRunName(), prot.strId()))
-            for outName, outSet in prot.iterOutputAttributes(pwobj.Set):
-                outSet.load()
-                outSet.loadAllProperties()
-                # outSetId needs to be compound id to avoid duplicate ids
-                outSetId = '%s.%s' % (outSet.getObjId(), prot.getObjId())
-                addObj(outSetId, '', outName, outSet.getSize(), pobj)
-                outSet.close()
-                # Store acquisition parameters in case of the import protocol
-                # NOTE by Yaiza: we force the string containing the Å to be unicode
-                # because this is the encoding used when generating report in report_html.py
-                if isinstance(prot, ProtImportImages):
-                    self.acquisition = [("Microscope Voltage (kV): ",
-                                         prot.voltage.get()),
-                                        ("Spherical aberration (mm): ",
-                                         prot.sphericalAberration.get()),
-                                        ("Magnification: ",
-                                         prot.magnification.get()),
-                                        (u"Pixel Size (Å/px): ",
-                                         round(outSet.getSamplingRate(), 2))
-                                        ]
-                    if prot.dosePerFrame.get() is not None:
-                        self.acquisition.append((u"Dose per frame (e/Å²):",
-                                                 prot.dosePerFrame.get()))
-
-        self._objects = objects
+        for inputProt in self.protocol.getInputProtocols():
+            with protocolCache.lock(inputProt):
+                self._addProtocol(protocolCache.get(inputProt), addObj)
+
+        self._objects = list(objects.values())
+
+        elapsed = time.time() - t0
+        stats = self.refreshStats
+        stats['runs'] += 1
+        stats['totalTime'] += elapsed
+        stats['lastTime'] = elapsed
+        stats['maxTime'] = max(stats['maxTime'], elapsed)
+
+    def _addProtocol(self, prot, addObj):
+        """ Add the objects of prot and its output sets. """
+        pobj = addObj(prot.getObjId(),
+                      '%s (id=%s)' % (prot.getRunName(), prot.strId()))
+        for outName, outSet in prot.iterOutputAttributes(pwobj.Set):
+            # outSetId needs to be compound id to avoid duplicate ids
+            outSetId = '%s.%s' % (outSet.getObjId(), prot.getObjId())
+            size, samplingRate = self._getSetInfo(outSetId, outSet)
+            addObj(outSetId, '', outName, size, pobj)
+            # Store acquisition parameters in case of the import protocol
+            # NOTE by Yaiza: we force the string containing the Å to be unicode
+            # because this is the encoding used when generating report in report_html.py
+            if isinstance(prot, ProtImportImages):
+                self.acquisition = [("Microscope Voltage (kV): ",
+                                     prot.voltage.get()),
+                                    ("Spherical aberration (mm): ",
+                                     prot.sphericalAberration.get()),
+                                    ("Magnification: ",
+                                     prot.magnification.get()),
+                                    (u"Pixel Size (Å/px): ",
+                                     round(samplingRate, 2))
+                                    ]
+                if prot.dosePerFrame.get() is not None:
+                    self.acquisition.append((u"Dose per frame (e/Å²):",
+                                             prot.dosePerFrame.get()))
+
+    def getTimingSummary(self):
+        """ Return the refresh statistics with the keys used by
+        MonitorTimingLog.getSummary.
+        """
+        stats = self.refreshStats
+        return {'name': 'SummaryProvider', 'runs': stats['runs'],
+                'meanTime': stats['totalTime'] / max(1, stats['runs']),
+                'maxTime': stats['maxTime'], 'overruns': 0, 'skipped': 0,
+                'meanLag': 0, 'maxLag': 0}
 
     def getObjectInfo(self, obj):
         info = {'key': obj.strId(),
@@ -0,0 +1,222 @@
+# **************************************************************************
+# *
+# * Authors:     agent (agent@local)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Creation of small JPG thumbnails of micrographs and PSDs for the reports.
+"""
+
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from .monitor_log import connectLog
+
+# Default width in pixels of the thumbnails
+THUMB_WIDTH = 512
+# Percentiles used to set the thumbnail contrast
+THUMB_CONTRAST = (0.5, 99.5)
+# Rows of each binning block read from the MRC files
+THUMB_ROW_SAMPLES = 2
+# Output rows binned at a time, so the memory used does not grow with
+# the image size
+THUMB_ROWS_CHUNK = 64
+
+MRC_EXTENSIONS = ('.mrc', '.mrcs', '.st', '.ali')
+MRC_HEADER_SIZE = 1024
+# MRC mode: data type
+MRC_MODES = {0: np.int8, 1: np.int16, 2: np.float32,
+             6: np.uint16, 12: np.float16}
+
+
+class MrcImage:
+    """ Minimal reader of MRC files that memory-maps the data, so only the
+    pages of the rows actually used are read from disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        header = np.fromfile(path, dtype=np.uint8, count=MRC_HEADER_SIZE)
+        if len(header) < MRC_HEADER_SIZE:
+            raise ValueError("%s is not a MRC file" % path)
+        # machine stamp: 0x11 big endian, 0x44 (or not set) little endian
+        byteOrder = '>' if header[212] == 0x11 else '<'
+        words = header.view(byteOrder + 'i4')
+        self.nx, self.ny, self.nz, mode = (int(w) for w in words[:4])
+        if mode not in MRC_MODES or min(self.nx, self.ny, self.nz) < 1:
+            raise ValueError("%s: unsupported MRC mode %d or size %dx%dx%d"
+                             % (path, mode, self.nx, self.ny, self.nz))
+        self.dtype = np.dtype(MRC_MODES[mode]).newbyteorder(byteOrder)
+        # the extended header size (NSYMBT) is the word 24
+        self.offset = MRC_HEADER_SIZE + int(words[23])
+
+    def getDim(self):
+        return self.nx, self.ny, self.nz
+
+    def getData(self, index=1):
+        """ Return a read only memory map of the section index (from 1). """
+        if not 1 <= index <= self.nz:
+            raise IndexError("%s: section %d out of %d"
+                             % (self.path, index, self.nz))
+        sectionSize = self.nx * self.ny * self.dtype.itemsize
+        return np.memmap(self.path, dtype=self.dtype, mode='r',
+                         offset=self.offset + (index - 1) * sectionSize,
+                         shape=(self.ny, self.nx))
+
+    def getBinned(self, factor, index=1, rowSamples=THUMB_ROW_SAMPLES):
+        """ Return the section index binned by factor. Only rowSamples
+        equally spaced rows of each block of factor rows are read, and
+        averaged with the factor columns of the block.
+        """
+        data = self.getData(index)
+        if factor <= 1:
+            return np.array(data, dtype=np.float32)
+        rowSamples = max(1, min(rowSamples, factor))
+        h, w = self.ny // factor, self.nx // factor
+        offsets = (np.arange(rowSamples) * factor) // rowSamples
+        binned = np.empty((h, w), dtype=np.float32)
+        for start in range(0, h, THUMB_ROWS_CHUNK):
+            end = min(start + THUMB_ROWS_CHUNK, h)
+            rows = (np.arange(start, end)[:, None] * factor + offsets).ravel()
+            block = np.asarray(data[rows, :w * factor], dtype=np.float32)
+            block = block.reshape(end - start, rowSamples, w, factor)
+            binned[start:end] = block.mean(axis=(1, 3))
+        del data
+        return binned
+
+
+def parseLocation(location):
+    """ Return (index, path) of a Scipion location: a path, an
+    (index, path) tuple or index@path. The index is 1 if not given.
+    """
+    if isinstance(location, tuple):
+        index, path = location
+    elif '@' in location:
+        index, path = location.split('@', 1)
+    else:
+        index, path = 1, location
+    # remove the format suffix, e.g. stack.mrc:mrcs
+    path = path.split(':')[0]
+    return max(1, int(index or 1)), path
+
+
+def isMrc(path):
+    return path.lower().endswith(MRC_EXTENSIONS)
+
+
+def readImageData(location):
+    """ Return the 2D array of the image. """
+    from pwem.emlib.image import ImageHandler
+    return np.asarray(ImageHandler().read(location).getData(),
+                      dtype=np.float32)
+
+
+def readBinnedData(location, width=None):
+    """ Return the image binned to be about width pixels wide (or the
+    whole image if width is None). MRC files are memory-mapped and only
+    the needed rows are read, other formats are read with ImageHandler.
+    """
+    index, path = parseLocation(location)
+    if isMrc(path):
+        try:
+            mrc = MrcImage(path)
+            factor = mrc.nx // width if width else 1
+            return mrc.getBinned(factor, index)
+        except ValueError as e:
+            print("Reading %s with ImageHandler: %s" % (path, e))
+    data = readImageData(location)
+    return binImage(data, data.shape[1] // width if width else 1)
+
+
+def binImage(data, factor):
+    """ Average blocks of factor x factor pixels (the image borders that
+    do not fill a whole block are discarded).
+    """
+    if factor <= 1:
+        return data
+    h = (data.shape[0] // factor) * factor
+    w = (data.shape[1] // factor) * factor
+    blocks = data[:h, :w].reshape(h // factor, factor, w // factor, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+def toUint8(data):
+    """ Scale the image to 0-255 clipping the extreme values, so a few hot
+    pixels do not ruin the contrast.
+    """
+    low, high = np.percentile(data, THUMB_CONTRAST)
+    if high <= low:
+        return np.zeros(data.shape, dtype=np.uint8)
+    data = np.clip((data - low) * (255. / (high - low)), 0, 255)
+    return data.astype(np.uint8)
+
+
+def createThumbnail(srcPath, dstPath, width=THUMB_WIDTH):
+    """ Write in dstPath a JPG of the image srcPath (a Scipion location)
+    binned to be at most (about) width pixels wide. If width is None the
+    image is not binned.
+    """
+    data = readBinnedData(srcPath, max(1, width) if width else None)
+    Image.fromarray(toUint8(data)).save(dstPath, 'JPEG', quality=90)
+    return dstPath
+
+
+class ThumbnailCache:
+    """ Persistent record of the created thumbnails. A thumbnail is valid
+    while its source file keeps the same path, modification time and size
+    (and it is requested with the same width), so the thumbnails are never
+    created again when the protocol is restarted.
+    """
+    def __init__(self, dbPath):
+        self.conn = connectLog(dbPath)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS thumbnails(
+                                dstPath TEXT PRIMARY KEY,
+                                srcPath TEXT,
+                                mtime FLOAT,
+                                size INTEGER,
+                                width INTEGER)""")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _getKey(srcPath, width):
+        stat = os.stat(srcPath)
+        return srcPath, stat.st_mtime, stat.st_size, width
+
+    def isValid(self, srcPath, dstPath, width=THUMB_WIDTH):
+        """ Return True if dstPath was created from the current srcPath. """
+        if not os.path.exists(dstPath) or not os.path.exists(srcPath):
+            return False
+        with self._lock:
+            row = self.conn.execute("SELECT srcPath, mtime, size, width "
+                                    "FROM thumbnails WHERE dstPath=?",
+                                    (dstPath,)).fetchone()
+        return row is not None and tuple(row) == self._getKey(srcPath, width)
+
+    def add(self, srcPath, dstPath, width=THUMB_WIDTH):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO thumbnails"
+                              "(dstPath, srcPath, mtime, size, width) "
+                              "VALUES(?, ?, ?, ?, ?)",
+                              (dstPath,) + self._getKey(srcPath, width))
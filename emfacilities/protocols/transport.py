@@ -26,72 +26,222 @@
 
 import paramiko
 import os
+import threading
+
+# Default number of SFTP channels used by Connect.putMany
+SFTP_CHANNELS = 4
+# Seconds between the keep-alive packets of the SSH transport
+KEEPALIVE_SECS = 30
+
+# Connections shared by all the users in this process
+_connections = {}
+_connectionsLock = threading.Lock()
+
+
+def getConnection(host, port, username, password, keyfilepath, keyfiletype,
+                  remote_path, projectName):
+    """ Return the Connect to host shared by this process, creating it
+    the first time. The connection is kept open between uses (reconnecting
+    if needed), so it must not be closed by its users: call
+    closeConnections() when it is not needed any more.
+    """
+    key = (host, port, username, keyfilepath, remote_path, projectName)
+    with _connectionsLock:
+        connect = _connections.get(key)
+        if connect is None:
+            connect = Connect(host, port, username, password, keyfilepath,
+                              keyfiletype, remote_path, projectName)
+            _connections[key] = connect
+        return connect
+
+
+def closeConnections():
+    with _connectionsLock:
+        for connect in _connections.values():
+            connect.close()
+        _connections.clear()
 
 
 class Connect:
     def __init__(self, host, port, username, password, keyfilepath, keyfiletype,
                  remote_path, projectName):
         """
-        create_sftp_client(host, port, username, password, keyfilepath, keyfiletype) -> SFTPClient
+        Connect(host, port, username, password, keyfilepath, keyfiletype, ...)
 
-        Creates a SFTP client connected to the supplied host on the supplied
-        port authenticating as the user with supplied username and supplied
+        SFTP connection to the supplied host on the supplied port
+        authenticating as the user with supplied username and supplied
         password or with the private key in a file with the supplied path.
         If a private key is used for authentication, the type of the keyfile
         needs to be specified as DSA or RSA.
-        :rtype: SFTPClient object.
+
+        The SSH transport is kept alive and it is opened again, when it is
+        used, if it was closed (e.g. by a network failure).
 
         remote_path: all paths are relative to this directory
         """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.key = None
         self.sftp = None
-        key = None
         self.transport = None
+        self.remote_path = remote_path
+        self._lock = threading.RLock()
+        # remote directories known to exist (remote_path must exist)
+        self._dirs = {remote_path.rstrip('/')}
+
+        if keyfilepath is not None:
+            # Get private key used to authenticate user.
+            if keyfiletype == 'DSA':
+                # The private key is a DSA type key.
+                self.key = paramiko.DSSKey.from_private_key_file(keyfilepath)
+            else:
+                # The private key is a RSA type key.
+                self.key = paramiko.RSAKey.from_private_key_file(keyfilepath)
+
         try:
-            if keyfilepath is not None:
-                # Get private key used to authenticate user.
-                if keyfiletype == 'DSA':
-                    # The private key is a DSA type key.
-                    key = paramiko.DSSKey.from_private_key_file(keyfilepath)
-                else:
-                    # The private key is a RSA type key.
-                    key = paramiko.RSAKey.from_private_key_file(keyfilepath)
+            self.makeDirs(os.path.join(self.remote_path, projectName))
+        except Exception as e:
+            print('An error occurred creating SFTP client: %s: %s'
+                  % (e.__class__, e))
 
-            # Create Transport object using supplied method of authentication
+    def isActive(self):
+        return self.transport is not None and self.transport.is_active()
 
-            self.transport = paramiko.Transport((host, port))
-            self.transport.connect(None, username, password, key)
+    def _connect(self):
+        """ Open the transport and the main SFTP channel if they are not
+        open. Return the main SFTP channel.
+        """
+        with self._lock:
+            if self.isActive():
+                # other threads may be using channels of this transport
+                if self.sftp is None:
+                    self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+                return self.sftp
+            # the transport is dead, so are all its channels
+            self.close()
+            try:
+                self.transport = paramiko.Transport((self.host, self.port))
+                self.transport.set_keepalive(KEEPALIVE_SECS)
+                self.transport.connect(None, self.username, self.password,
+                                       self.key)
+                self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+            except Exception:
+                self.close()
+                raise
+            return self.sftp
 
-            self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+    def _openChannel(self):
+        """ Return a new SFTP channel of the transport. """
+        with self._lock:
+            self._connect()
+            return paramiko.SFTPClient.from_transport(self.transport)
 
-        except Exception as e:
-            print('An error occurred creating SFTP client: %s: %s' % (e.__class__, e))
+    def makeDirs(self, directory):
+        """ Create the remote directory, and its parents, if they do not
+        exist. The existing directories are remembered.
+        """
+        with self._lock:
+            directory = directory.rstrip('/')
+            if directory in self._dirs or not directory:
+                return
+            parent = os.path.dirname(directory)
+            if parent != directory:
+                self.makeDirs(parent)
+            sftp = self._connect()
+            try:
+                sftp.stat(directory)  # Test if directory exists
+            except IOError:
+                sftp.mkdir(directory)  # Create directory
+            self._dirs.add(directory)
+
+    def put(self, listLocalPaths, listRemotePaths):
+        """ Upload the files one after the other. Return the list of
+        (local, remote, error) as putMany.
+        """
+        return self.putMany(zip(listLocalPaths, listRemotePaths), channels=1)
+
+    def putMany(self, files, channels=SFTP_CHANNELS, atomic=False):
+        """ Upload the (local, remote) pairs of files (remote relative to
+        remote_path) over several SFTP channels of the same transport.
+        files may be a generator, it is consumed while the files are being
+        uploaded. Return a list of (local, remote, error) tuples, with
+        error None for the files uploaded. If files raises an exception the
+        upload stops and the files not yielded are not in the results.
+        If atomic, each file is uploaded to a .tmp file and then renamed,
+        so the readers never see a partially uploaded file.
+        """
+        files = iter(files)
+        filesLock = threading.Lock()
+        resultsLock = threading.Lock()
+        results = []
+        lost = []  # set if the connection can not be opened again
+
+        def putFile(sftp, local, remote):
+            remote = os.path.join(self.remote_path, remote)
+            self.makeDirs(os.path.dirname(remote))
+            if atomic:
+                sftp.put(local, remote + '.tmp', confirm=True)
+                sftp.posix_rename(remote + '.tmp', remote)
+            else:
+                sftp.put(local, remote, confirm=True)
+
+        def upload():
+            sftp = None
+            try:
+                while True:
+                    with filesLock:
+                        try:
+                            item = next(files, None)
+                        except Exception as e:
+                            # the files not yielded have no result
+                            print("Error getting the files to upload: %s"
+                                  % e)
+                            item = None
+                    if item is None:
+                        return
+                    local, remote = item
+                    error = None
+                    try:
+                        if lost:
+                            raise IOError('no SFTP connection')
+                        if sftp is None:
+                            sftp = self._openChannel()
+                        putFile(sftp, local, remote)
+                    except Exception as e:
+                        error = str(e) or e.__class__.__name__
+                        if not lost and not self.isActive():
+                            # the connection was lost, open it again and retry
+                            print("SFTP connection lost (%s), reconnecting"
+                                  % error)
+                            try:
+                                sftp = self._openChannel()
+                                putFile(sftp, local, remote)
+                                error = None
+                            except Exception as e:
+                                sftp = None
+                                lost.append(True)
+                                error = str(e) or e.__class__.__name__
+                    with resultsLock:
+                        results.append((local, remote, error))
+            finally:
+                if sftp is not None:
+                    sftp.close()
+
+        threads = [threading.Thread(target=upload)
+                   for _ in range(max(1, channels))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def close(self):
+        with self._lock:
             if self.sftp is not None:
                 self.sftp.close()
             if self.transport is not None:
                 self.transport.close()
-        self.remote_path = remote_path
-        directory = os.path.join(self.remote_path, projectName)
-        try:
-            self.sftp.chdir(directory)  # Test if directory exists
-        except IOError:
-            self.sftp.mkdir(directory)  # Create directory
-
-    def put(self,listLocalPaths, listRemotePaths):
-        try:
-            for local, remote in zip(listLocalPaths, listRemotePaths):
-                remote = os.path.join(self.remote_path, remote)
-                print(local, "-->", remote)
-                self.sftp.put(local, remote, confirm=True)
-        except IOError:
-            pass
-        except OSError:
-            pass
-        except Exception as e:
-            print(str(e))
-        return 0
-
-    def close(self):
-        if self.sftp is not None:
-            self.sftp.close()
-        if self.transport is not None:
-            self.transport.close()
+            self.sftp = None
+            self.transport = None
@@ -21,15 +21,28 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # ***************************************************************************/
 
+import math
 import os
+import threading
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
+import numpy as np
+from PIL import Image
 
 import pyworkflow.tests as pwtests
 import pyworkflow.protocol as pwprot
 
+import pwem.objects as emobj
 import pwem.protocols as emprot
 
 import emfacilities.protocols as monitorsProt
+from emfacilities.protocols.influx_writer import InfluxBatchWriter
+from emfacilities.protocols.report_data import ReportDataWriter
+from emfacilities.protocols.report_html import ReportTemplate
+from emfacilities.protocols.report_publisher import ReportPublisher
+from emfacilities.protocols.thumbnails import (binImage, ThumbnailCache,
+                                               MrcImage, createThumbnail)
 
 # Load the number of movies for the simulation, by default equal 3,
 # but can be modified in the environement
@@ -100,3 +113,328 @@ class TestCtfStream(pwtests.BaseTest):
 
         baseFn = protMonitor._getPath(monitorsProt.CTF_LOG_SQLITE)
         self.assertTrue(os.path.isfile(baseFn))
+
+
+class TestCtfMonitorIngestion(pwtests.BaseTest):
+    """ Check that the CTF monitor only reads the new CTFs on each tick,
+    so the cost of a tick does not grow with the size of the set.
+    """
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def _createMonitor(self):
+        return monitorsProt.MonitorCTF(None,
+                                       workingDir=self.getOutputPath(),
+                                       samplingInterval=10,
+                                       monitorTime=5,
+                                       minDefocus=1000,
+                                       maxDefocus=40000,
+                                       astigmatism=2000)
+
+    def _appendCTFs(self, ctfSet, first, last):
+        for i in range(first, last + 1):
+            mic = emobj.Micrograph(location='mic_%06d.mrc' % i)
+            mic.setObjId(i)
+            ctf = emobj.CTFModel()
+            ctf.setStandardDefocus(20000 + i % 100, 19000, 45)
+            ctf.setPsdFile('mic_%06d_psd.mrc' % i)
+            ctf.setMicrograph(mic)
+            ctf.setResolution(3.5)
+            ctf.setFitQuality(0.1)
+            ctfSet.append(ctf)
+        ctfSet.write()
+
+    def test_ingestion(self):
+        chunk, nChunks = 500, 8
+        ctfSet = emobj.SetOfCTF(filename=self.getOutputPath('ctfs.sqlite'))
+        monitor = self._createMonitor()
+        monitor.initLoop()
+
+        for i in range(nChunks):
+            self._appendCTFs(ctfSet, i * chunk + 1, (i + 1) * chunk)
+            # Tick cost stays flat while the set grows: only the new
+            # CTFs are queried
+            with mock.patch.object(ctfSet, 'iterItems',
+                                   wraps=ctfSet.iterItems) as iterItems:
+                self.assertEqual(monitor.ingestCTFs(ctfSet), chunk)
+                # nothing new, nothing read
+                self.assertEqual(monitor.ingestCTFs(ctfSet), 0)
+            self.assertEqual([c[1]['where'] for c in iterItems.call_args_list],
+                             ['id > %d' % (i * chunk),
+                              'id > %d' % ((i + 1) * chunk)])
+
+        self.assertEqual(monitor.lastCtfId, chunk * nChunks)
+
+        # The html data is read from the log as columns
+        data = monitor.getDataHtml()
+        self.assertEqual(len(data['idValues']), chunk * nChunks)
+        self.assertEqual(len(data['imgPsdPath']), chunk * nChunks)
+        self.assertEqual(data['idValues'][-1], chunk * nChunks)
+        data = monitor.getDataHtml(sinceId=chunk * nChunks - 10)
+        self.assertEqual(list(data['idValues']),
+                         list(range(chunk * nChunks - 9, chunk * nChunks + 1)))
+
+        # A new monitor over the same log resumes from the stored watermark
+        monitor = self._createMonitor()
+        monitor.initLoop()
+        self.assertEqual(monitor.lastCtfId, chunk * nChunks)
+        self.assertEqual(monitor.ingestCTFs(ctfSet), 0)
+
+        # CTFs not stored because sqlite fails are read again
+        self._appendCTFs(ctfSet, chunk * nChunks + 1, chunk * nChunks + 3)
+        writer = monitor._logWriter
+        writer.conn.execute("ALTER TABLE %s RENAME TO broken" % writer.tableName)
+        self.assertEqual(monitor.ingestCTFs(ctfSet), 0)
+        self.assertEqual(monitor.lastCtfId, chunk * nChunks)
+        writer.conn.execute("ALTER TABLE broken RENAME TO %s" % writer.tableName)
+        self.assertEqual(monitor.ingestCTFs(ctfSet), 3)
+        self.assertEqual(monitor.lastCtfId, chunk * nChunks + 3)
+        ctfSet.close()
+
+
+class TestReportData(pwtests.BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def test_appendRows(self):
+        """ Only new rows are written, in chunks of chunkSize rows. """
+        reportDir = self.getOutputPath('report')
+        writer = ReportDataWriter(reportDir, chunkSize=4)
+        writer.appendColumns('ctf', {'defocusU': np.arange(6.),
+                                     'idValues': np.arange(1, 7)},
+                             ['idValues', 'defocusU'])
+        writer.appendColumns('ctf', {'defocusU': np.arange(10.),
+                                     'idValues': np.arange(1, 11)},
+                             ['idValues', 'defocusU'])
+        writer.writeState({'projectStatus': 'RUNNING'},
+                          {'runs': '[{protocolName: "ctf", output:[]}]'})
+
+        self.assertEqual(writer.getCount('ctf'), 10)
+        dataDir = os.path.join(reportDir, 'data')
+        self.assertEqual(sorted(os.listdir(dataDir)),
+                         ['ctf_0.js', 'ctf_1.js', 'ctf_2.js', 'state.js'])
+        with open(os.path.join(dataDir, 'ctf_2.js')) as f:
+            self.assertEqual(f.read(), 'R("ctf",8,[9, 8.0]);\n'
+                                       'R("ctf",9,[10, 9.0]);\n')
+        with open(os.path.join(dataDir, 'state.js')) as f:
+            state = f.read()
+        self.assertIn('"streams": {"ctf": 10}', state)
+        self.assertIn('"runs": [{protocolName: "ctf", output:[]}]', state)
+
+        # new columns: the stream is written again as a new version
+        writer.appendColumns('ctf', {'defocusU': np.arange(6.),
+                                     'defocusV': np.arange(6.),
+                                     'idValues': np.arange(1, 7)},
+                             ['idValues', 'defocusU', 'defocusV'])
+        writer.writeState({})
+        self.assertEqual(writer.getCount('ctf'), 6)
+        self.assertEqual(sorted(os.listdir(dataDir)),
+                         ['ctf_0.js', 'ctf_1.js', 'state.js'])
+        with open(os.path.join(dataDir, 'ctf_1.js')) as f:
+            self.assertEqual(f.read(), 'R("ctf",4,[5, 4.0, 4.0]);\n'
+                                       'R("ctf",5,[6, 5.0, 5.0]);\n')
+        with open(os.path.join(dataDir, 'state.js')) as f:
+            self.assertIn('"versions": {"ctf": 1}', f.read())
+        with self.assertRaises(ValueError):
+            writer.append('ctf', ['idValues'], [[7]])
+
+    def test_template(self):
+        """ The split template renders as % and is reloaded if modified. """
+        templatePath = self.getOutputPath('template.html')
+        with open(templatePath, 'w') as f:
+            f.write("<b>%(projectName)s</b> 100%% %(refresh)s")
+        template = ReportTemplate(templatePath)
+        self.assertTrue(template.load())
+        self.assertFalse(template.load())
+        args = {'projectName': 'box', 'refresh': 60, 'unused': 1}
+        self.assertEqual(template.render(args), template.text % args)
+
+        # any conversion spec of the % operator
+        with open(templatePath, 'w') as f:
+            f.write("%(refresh)05.1f %(refresh)d %(projectName)-6s| "
+                    "%(ratio).2e %(ratio)+g %(refresh)#x %(projectName)r %(ids)s")
+        os.utime(templatePath, (1, 1))
+        self.assertTrue(template.load())
+        args.update(ratio=0.125, ids=(1, 2))
+        self.assertEqual(template.render(args), template.text % args)
+
+        with open(templatePath, 'w') as f:
+            f.write("%(dataDir)s")
+        os.utime(templatePath, (0, 0))
+        self.assertTrue(template.load())
+        self.assertTrue(template.hasKey('dataDir'))
+
+    def test_thumbnails(self):
+        """ Images are binned in blocks and the cached thumbnails are only
+        valid while their source file does not change.
+        """
+        data = np.arange(64, dtype=np.float32).reshape(8, 8)
+        binned = binImage(data, 4)
+        self.assertEqual(binned.shape, (2, 2))
+        self.assertAlmostEqual(binned[0, 0], data[:4, :4].mean())
+        self.assertEqual(binImage(data, 3).shape, (2, 2))
+
+        srcPath = self.getOutputPath('mic.mrc')
+        dstPath = self.getOutputPath('mic_thumb.jpg')
+        for path in [srcPath, dstPath]:
+            with open(path, 'w') as f:
+                f.write('image')
+        cache = ThumbnailCache(self.getOutputPath('thumbnails.sqlite'))
+        self.assertFalse(cache.isValid(srcPath, dstPath, 512))
+        cache.add(srcPath, dstPath, 512)
+        self.assertTrue(cache.isValid(srcPath, dstPath, 512))
+        self.assertFalse(cache.isValid(srcPath, dstPath, 256))
+        os.utime(srcPath, (0, 0))
+        self.assertFalse(cache.isValid(srcPath, dstPath, 512))
+
+    def test_mrcThumbnail(self):
+        """ The memory-mapped MRC reader reads stacks with an extended
+        header and bins only some of the rows of each block.
+        """
+        data = np.random.rand(3, 40, 64).astype(np.float32)
+        header = np.zeros(256, dtype='<i4')
+        header[:4] = [64, 40, 3, 2]
+        header[23] = 96  # extended header
+        header.view(np.uint8)[212:214] = 0x44
+        mrcPath = self.getOutputPath('stack.mrcs')
+        with open(mrcPath, 'wb') as f:
+            f.write(header.tobytes() + bytes(96) + data.tobytes())
+
+        mrc = MrcImage(mrcPath)
+        self.assertEqual(mrc.getDim(), (64, 40, 3))
+        self.assertTrue(np.array_equal(mrc.getData(2), data[1]))
+        binned = mrc.getBinned(8, index=3, rowSamples=8)
+        self.assertTrue(np.allclose(binned, binImage(data[2], 8)))
+        sampled = mrc.getBinned(8, index=3, rowSamples=2)
+        rows = data[2].reshape(5, 8, 8, 8)[:, [0, 4]]
+        self.assertTrue(np.allclose(sampled, rows.mean(axis=(1, 3))))
+
+        jpgPath = self.getOutputPath('stack.jpg')
+        createThumbnail((2, mrcPath), jpgPath, width=16)
+        self.assertEqual(Image.open(jpgPath).size, (16, 10))
+
+    def test_influxBatches(self):
+        """ The points are sent in ceil(N/batchSize) requests and spooled
+        while the database does not answer.
+        """
+        try:
+            from influxdb import InfluxDBClient
+        except ImportError:
+            self.skipTest("influxdb is not installed")
+
+        received = []
+        status = [204]
+
+        class InfluxHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                code = status[0]
+                if code == 'drop':
+                    self.close_connection = True  # no response
+                    return
+                if code == 'badThenDrop':
+                    code, status[0] = 400, 'drop'
+                if code == 204 and b'bad' in body:
+                    code = 400  # e.g. a field type conflict
+                if code == 204:
+                    received.append(body.decode().splitlines())
+                self.send_response(code)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), InfluxHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            client = InfluxDBClient(port=server.server_port, database='db',
+                                    retries=1)
+            spoolPath = self.getOutputPath('influx_spool.txt')
+            writer = InfluxBatchWriter(client, spoolPath, batchSize=40,
+                                       retries=2, retryDelay=0)
+            numPoints = 100
+            point = {'measurement': 'box', 'tags': {'section': 'ctf'}}
+            for i in range(numPoints):
+                point['fields'] = {'defocusU': float(i)}
+                point['time'] = i + 1
+                writer.addPoint(point)
+            self.assertEqual(writer.flush(), numPoints)
+            self.assertEqual(len(received), math.ceil(numPoints / 40.))
+            self.assertEqual(received[-1][-1],
+                             'box,section=ctf defocusU=99.0 100')
+
+            status[0] = 500
+            writer.addPoint(point)
+            self.assertEqual(writer.flush(), 0)
+            self.assertTrue(os.path.exists(spoolPath))
+            status[0] = 204
+            writer.addPoint(point)
+            self.assertEqual(writer.flush(), 2)
+            self.assertFalse(os.path.exists(spoolPath))
+            self.assertEqual(len(received), 4)
+
+            # rejected points are dropped, not spooled, the others are sent
+            for i in range(4):
+                point['fields'] = {'defocusU': 'bad' if i == 1 else float(i)}
+                writer.addPoint(point)
+            self.assertEqual(writer.flush(), 4)
+            self.assertFalse(os.path.exists(spoolPath))
+            self.assertEqual(sum(len(lines) for lines in received[4:]), 3)
+
+            # the connection is lost while a rejected batch is split
+            status[0] = 'badThenDrop'
+            for i in range(4):
+                point['fields'] = {'defocusU': 'bad' if i == 1 else float(i)}
+                writer.addPoint(point)
+            self.assertEqual(writer.flush(), 0)
+            with open(spoolPath) as f:
+                self.assertEqual(len(f.read().splitlines()), 4)
+
+            # wrong user or database: nothing is dropped
+            status[0] = 401
+            self.assertEqual(writer.flush(), 0)
+            with open(spoolPath) as f:
+                self.assertEqual(len(f.read().splitlines()), 4)
+
+            status[0] = 204
+            self.assertEqual(writer.flush(), 4)
+            self.assertFalse(os.path.exists(spoolPath))
+            self.assertEqual(sum(len(lines) for lines in received[4:]), 6)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_publisher(self):
+        """ The whole report is published first, then only the files
+        marked as changed.
+        """
+        reportDir = self.getOutputPath('publish', 'report')
+        targetDir = self.getOutputPath('publish', 'www')
+        writer = ReportDataWriter(reportDir, chunkSize=2)
+        writer.appendColumns('ctf', {'idValues': np.arange(1, 4)},
+                             ['idValues'])
+        writer.writeState({})
+        with open(os.path.join(reportDir, 'index.html'), 'w') as f:
+            f.write('page')
+
+        publisher = ReportPublisher(reportDir, 'file://' + targetDir)
+        writer.popWritten()
+        publisher.publish(wait=True)
+        self.assertEqual(sorted(os.listdir(os.path.join(targetDir, 'data'))),
+                         ['ctf_0.js', 'ctf_1.js', 'state.js'])
+
+        writer.appendColumns('ctf', {'idValues': np.arange(1, 6)},
+                             ['idValues'])
+        with open(os.path.join(reportDir, 'index.html'), 'w') as f:
+            f.write('new page')  # not marked, it is not published
+        for path in writer.popWritten():
+            publisher.addChanged(path)
+        publisher.publish(wait=True)
+        with open(os.path.join(targetDir, 'data', 'ctf_1.js')) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertTrue(os.path.exists(
+            os.path.join(targetDir, 'data', 'ctf_2.js')))
+        with open(os.path.join(targetDir, 'index.html')) as f:
+            self.assertEqual(f.read(), 'page')
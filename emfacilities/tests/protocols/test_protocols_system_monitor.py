@@ -22,12 +22,25 @@
 # ***************************************************************************/
 
 import os.path
+import sqlite3
+import threading
+from concurrent.futures import wait
+from unittest import mock
+
+import numpy as np
+from pynvml import NVMLError, NVML_ERROR_NOT_FOUND
 
 import pyworkflow.tests as pwtests
 import pyworkflow.utils as pwutils
 
 import pwem.protocols as emprot
 import emfacilities.protocols as monitorsProt
+from emfacilities.protocols.monitor_log import (connectLog, MonitorWatermarks,
+                                               MonitorTimingLog)
+from emfacilities.protocols.protocol_monitor import Monitor, MonitorScheduler
+from emfacilities.protocols.protocol_monitor_movie_gain import MonitorMovieGain
+from emfacilities.protocols.protocol_monitor_system import (MonitorSystem,
+                                                              RingBuffer)
 
 
 class TestStress(pwtests.BaseTest):
@@ -79,3 +92,244 @@ class TestStress(pwtests.BaseTest):
 
         # not sure what to test here
         self.assertTrue(os.path.isfile(baseFn))
+
+
+class TestSystemSampler(pwtests.BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def test_ringBuffer(self):
+        ring = RingBuffer(4, 1)
+        for i in range(6):
+            ring.append([i])
+        self.assertEqual(len(ring), 4)
+        self.assertEqual(ring.drain()[:, 0].tolist(), [2, 3, 4, 5])
+        self.assertEqual(len(ring.drain()), 0)
+
+    def test_sampler(self):
+        """ Usage read in the background is logged as mean and aggregates. """
+        sysMon = MonitorSystem([], workingDir=self.getOutputPath(),
+                               samplingInterval=1,
+                               sampleInterval=0.001,
+                               cpuAlert=101, memAlert=101,
+                               swapAlert=101, doGpu=False,
+                               doNetwork=False, doDiskIO=False)
+        samples = []
+
+        def readUsage():
+            # five samples, then the sampler stops
+            samples.append(10. * (len(samples) + 1))
+            if len(samples) == 5:
+                sysMon._stopSampling.set()
+            return {'cpu': samples[-1], 'mem': 50., 'swap': 0.}
+
+        sysMon._readUsage = readUsage
+        sysMon.initLoop()
+        sysMon._sampler.join()
+        # no protocols to wait for, so it is finished and stops the thread
+        self.assertTrue(sysMon.step())
+        self.assertIsNone(sysMon._sampler)
+
+        conn = sqlite3.connect(os.path.join(self.getOutputPath(),
+                                            monitorsProt.SYSTEM_LOG_SQLITE))
+        row = conn.execute("select cpu, cpu_min, cpu_max, cpu_p95, mem "
+                           "from log").fetchone()
+        self.assertEqual(row, (30., 10., 50., 48., 50.))
+
+    def test_failingGpu(self):
+        """ A GPU that can not be read is reported once and dropped. """
+        sysMon = MonitorSystem([], workingDir=self.getOutputPath(),
+                               samplingInterval=1,
+                               cpuAlert=101, memAlert=101,
+                               swapAlert=101, doGpu=False,
+                               doNetwork=False, doDiskIO=False)
+        sysMon.doGpu = True
+        sysMon.gpusToUse = [0, 1]
+
+        def getHandle(i):
+            if i == 1:
+                raise NVMLError(NVML_ERROR_NOT_FOUND)
+            return i
+
+        module = 'emfacilities.protocols.protocol_monitor_system.'
+        with mock.patch(module + 'nvmlDeviceGetHandleByIndex', getHandle), \
+                mock.patch(module + 'nvmlDeviceGetMemoryInfo',
+                           return_value=mock.Mock(used=1, total=4)), \
+                mock.patch(module + 'nvmlDeviceGetUtilizationRates',
+                           return_value=mock.Mock(gpu=50)), \
+                mock.patch(module + 'nvmlDeviceGetTemperature',
+                           return_value=40), \
+                mock.patch('builtins.print') as printMock:
+            for _ in range(3):
+                usage = sysMon._readUsage()
+        self.assertEqual(printMock.call_count, 1)
+        self.assertEqual(sysMon.gpusToUse, [0])
+        self.assertEqual(usage['gpuMem_0'], 25.)
+        self.assertNotIn('gpuMem_1', usage)
+
+
+class FakeClock:
+    """ Replacement of the time module where sleep only moves the clock. """
+    def __init__(self, now=1000.):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class TestMonitorScheduler(pwtests.BaseTest):
+    def test_slowTask(self):
+        """ A slow task is skipped while it runs and does not delay others. """
+        clock = FakeClock()
+        release = threading.Event()
+        blocked = threading.Event()
+        running = []
+
+        def slow():
+            running.append(1)
+            self.assertEqual(len(running), 1, "slow task run twice at once")
+            if not release.is_set():
+                # the first run lasts until the clock is moved 4 ticks
+                blocked.set()
+                release.wait()
+            running.pop()
+
+        def failing():
+            raise Exception("errors do not stop the scheduler")
+
+        def fakeWait(futures, timeout, return_when):
+            # the quick tasks are done before the clock moves
+            if blocked.is_set() and not release.is_set():
+                wait([f for f in futures if f is not slowTask.future])
+                clock.sleep(timeout)
+            else:
+                wait(futures)
+
+        def isFinished():
+            if blocked.is_set() and not release.is_set() \
+                    and clock.time() >= start + 4:
+                release.set()
+                slowTask.future.result()
+            return clock.time() >= start + 10
+
+        scheduler = MonitorScheduler()
+        slowTask = scheduler.addTask('slow', slow, 1)
+        fastTask = scheduler.addTask('fast', lambda: None, 1)
+        failingTask = scheduler.addTask('failing', failing, 1)
+        start = clock.time()
+        module = 'emfacilities.protocols.protocol_monitor.'
+        with mock.patch(module + 'time', clock), \
+                mock.patch(module + 'wait', fakeWait):
+            scheduler.run(isFinished)
+
+        # ticks 0 to 9, the slow task is busy in ticks 1, 2 and 3
+        self.assertEqual(slowTask.runs, 7)
+        self.assertEqual(slowTask.skipped, 3)
+        self.assertEqual(slowTask.errors, 0)
+        self.assertEqual(slowTask.maxTime, 4)
+        self.assertEqual(fastTask.runs, 10)
+        self.assertEqual(fastTask.skipped, 0)
+        self.assertEqual(failingTask.runs, 10)
+        self.assertEqual(failingTask.errors, 10)
+
+
+class TestMonitorLoop(pwtests.BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def test_deadlines(self):
+        """ Steps start at fixed times and overrun ticks are skipped. """
+        clock = FakeClock()
+        starts = []
+
+        class SlowMonitor(Monitor):
+            def step(self):
+                starts.append(clock.time())
+                # the third step overruns two ticks
+                clock.sleep(0.25 if len(starts) == 3 else 0.02)
+                return len(starts) == 6
+
+        timingLog = MonitorTimingLog(self.getOutputPath('timing.sqlite'))
+        monitor = SlowMonitor(workingDir=self.getOutputPath(),
+                              samplingInterval=0.1, monitorTime=1,
+                              timingLog=timingLog)
+        with mock.patch('emfacilities.protocols.protocol_monitor.time', clock):
+            monitor.loop()
+
+        # ticks 0, 1, 2, (3, 4 skipped), 5, 6, 7
+        offsets = [(t - starts[0]) / 0.1 for t in starts]
+        for offset, tick in zip(offsets, [0, 1, 2, 5, 6, 7]):
+            self.assertAlmostEqual(offset, tick)
+
+        summary = timingLog.getSummary()
+        self.assertEqual(len(summary), 1)
+        self.assertEqual(summary[0]['name'], 'SlowMonitor')
+        self.assertEqual(summary[0]['runs'], 6)
+        self.assertEqual(summary[0]['overruns'], 1)
+        self.assertEqual(summary[0]['skipped'], 2)
+
+    def test_watermarks(self):
+        """ The watermarks of an update are stored together. """
+        dbPath = self.getOutputPath('watermarks.sqlite')
+        watermarks = MonitorWatermarks(connectLog(dbPath))
+        self.assertEqual(watermarks.getAll(), {})
+        watermarks.update({'ctf': 10, 'gain': 3, 'properties': 1})
+        watermarks.update({'ctf': 12, 'properties': 0})
+        self.assertEqual(MonitorWatermarks(connectLog(dbPath)).getAll(),
+                         {'ctf': 12, 'gain': 3, 'properties': 0})
+
+
+class TestMovieGainReader(pwtests.BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def test_tail(self):
+        """ Only the new complete lines are parsed and checked. """
+        outputPath = self.getOutputPath()
+
+        class GainProtocol:
+            def _getPath(self, *paths):
+                return os.path.join(outputPath, *paths)
+
+        monitor = MonitorMovieGain(GainProtocol(), workingDir=outputPath,
+                                   samplingInterval=1, monitorTime=1,
+                                   stddevValue=0.04, ratio1Value=1.15,
+                                   ratio2Value=4.5)
+        summaryPath = os.path.join(outputPath, 'summaryForMonitor.txt')
+        with open(summaryPath, 'w') as f:
+            f.write("movie_000001: 0.016 0.976 1.028 1.5\n"
+                    "movie_000002: 0.050 0.976 1.028 1.5\n"
+                    "movie_000003: 0.016 0.9")
+        reader = monitor._getReader()
+        self.assertEqual(reader.update(), (0, 2))
+        self.assertEqual(reader.names, ['movie_000001', 'movie_000002'])
+        messages = monitor.checkMovies(0, 2)
+        self.assertEqual(len(messages), 1)
+        self.assertTrue(messages[0].startswith('movie_000002:'))
+
+        with open(summaryPath, 'a') as f:
+            f.write("76 1.028 9.0\n")
+        self.assertEqual(reader.update(), (2, 3))
+        self.assertEqual(reader.update(), (3, 3))
+        self.assertAlmostEqual(reader.getColumn('ratio2')[2], 9.0 / 1.028)
+        self.assertEqual(len(monitor.checkMovies(2, 3)), 1)
+        self.assertEqual(monitor.getDataInflux(lastId=2)[0]['idx'], 3)
+        self.assertEqual(len(monitor.getDataHtml()['ratio1']), 3)
+
+        # zero percentiles give undefined ratios, not checked nor sent
+        with open(summaryPath, 'a') as f:
+            f.write("movie_000004: 0.016 0.0 1.028 1.5\n"
+                    "movie_000005: 0.016 0.976 0.0 1.5\n")
+        self.assertEqual(reader.update(), (3, 5))
+        self.assertTrue(np.isnan(reader.getColumn('ratio1')[3]))
+        self.assertTrue(np.isnan(reader.getColumn('ratio2')[4]))
+        self.assertEqual(monitor.checkMovies(3, 5), [])
+        points = monitor.getDataInflux(lastId=3)
+        self.assertEqual(points[0], {'idx': 4, 'stddev': 0.016, 'ratio2': 1.5 / 1.028})
+        self.assertEqual(sorted(points[1]), ['idx', 'ratio1', 'stddev'])
@@ -0,0 +1,257 @@
+# ***************************************************************************
+# * Authors:     agent (agent@local)
+# *
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# ***************************************************************************/
+
+import random
+from unittest import mock
+
+import networkx as nx
+import pyworkflow.tests as pwtests
+from pwem.objects import (SetOfParticles, Particle, SetOfMicrographs,
+                          Micrograph, SetOfClasses2D, Class2D, SetOfCTF,
+                          CTFModel)
+
+from emfacilities.protocols.protocol_trackUsedItems import (UsedItemsTracker,
+                                                             getDagPath,
+                                                             getDagPathLengths)
+from emfacilities.protocols.set_tables import readSetIds
+
+
+def createOutputsGraph(nProts, nInputs=2, seed=0):
+    """ Random outputs graph with the shape of a project: each protocol
+    output is generated from nInputs outputs of previous protocols.
+    """
+    rand = random.Random(seed)
+    graph = nx.DiGraph()
+    graph.add_node('root')
+    for i in range(1, nProts + 1):
+        code = '%d.output' % i
+        graph.add_node(code, objType='SetOfParticles' if i % 3 else 'SetOfCTF')
+        if i <= nInputs:
+            graph.add_edge('root', code)
+        else:
+            for j in rand.sample(range(1, i), nInputs):
+                graph.add_edge('%d.output' % j, code)
+    return graph
+
+
+class FakeSet:
+    def __init__(self, setType):
+        self.setType = setType
+
+    def __str__(self):
+        return '%s (1 items)' % self.setType
+
+    def getSamplingRate(self):
+        return 1.0
+
+
+class TestLineageQueries(pwtests.BaseTest):
+    def test_outputsGraph(self):
+        """ Diamond lineage: import -> picking and ctf -> extraction -> tracker. """
+        tracker = UsedItemsTracker()
+        tracker.inpDic = {1: {}, 2: {'inputMicrographs': None},
+                          3: {'inputMicrographs': None},
+                          4: {'inputCoordinates': None, 'ctfRelations': None},
+                          5: {'inputParticles': None}}
+        tracker.protDic = {1: {}, 2: {'inputMicrographs': '1.outputMicrographs'},
+                           3: {'inputMicrographs': '1.'},
+                           4: {'inputCoordinates': '2.outputCoordinates',
+                               'ctfRelations': '3.outputCTF'},
+                           5: {'inputParticles': ['4.outputParticles']}}
+        tracker.outDic = {1: {'outputMicrographs': FakeSet('SetOfMicrographs')},
+                          2: {'outputCoordinates': FakeSet('SetOfCoordinates')},
+                          3: {'outputCTF': FakeSet('SetOfCTF')},
+                          4: {'outputParticles': FakeSet('SetOfParticles')},
+                          5: {}}
+        graph = tracker.generateOutputsGraph(5)
+        self.assertEqual(sorted(graph.edges),
+                         [('1.outputMicrographs', '2.outputCoordinates'),
+                          ('1.outputMicrographs', '3.outputCTF'),
+                          ('2.outputCoordinates', '4.outputParticles'),
+                          ('3.outputCTF', '4.outputParticles'),
+                          ('root', '1.outputMicrographs')])
+        self.assertEqual(graph.nodes['3.outputCTF']['objType'], 'SetOfCTF')
+
+        # the protocols that are not ancestors are not resolved
+        tracker.inpDic[6] = {'inputProtocol': None}
+        tracker.protDic[6] = {'inputProtocol': '5.'}
+        tracker.protDic[4]['inputCoordinates'] = '1.outputMicrographs'
+        self.assertEqual(sorted(tracker.generateOutputsGraph(5).edges),
+                         [('1.outputMicrographs', '3.outputCTF'),
+                          ('1.outputMicrographs', '4.outputParticles'),
+                          ('3.outputCTF', '4.outputParticles'),
+                          ('root', '1.outputMicrographs')])
+
+    def test_pathLengths(self):
+        """ The DAG paths have the same length as the simple paths. """
+        graph = createOutputsGraph(30)
+        for source in ['root', '5.output', '20.output']:
+            for target in graph.nodes:
+                for upwards in [False, True]:
+                    fromNode, toNode = (target, source) if upwards else (source, target)
+                    if not nx.has_path(graph, fromNode, toNode):
+                        self.assertIsNone(getDagPath(graph, source, target, upwards=upwards))
+                        continue
+                    allPaths = list(nx.all_simple_paths(graph, fromNode, toNode)) or [[source]]
+                    longest = getDagPath(graph, source, target, upwards=upwards)
+                    shortest = getDagPath(graph, source, target, longest=False, upwards=upwards)
+                    self.assertIn(longest, allPaths)
+                    self.assertIn(shortest, allPaths)
+                    self.assertEqual(len(longest), max(len(p) for p in allPaths))
+                    self.assertEqual(len(shortest), min(len(p) for p in allPaths))
+
+        # the lengths are cached per source until the graph changes
+        lengths = getDagPathLengths(graph, 'root')
+        self.assertIs(getDagPathLengths(graph, 'root'), lengths)
+        graph.add_edge('30.output', '31.output')
+        self.assertEqual(getDagPathLengths(graph, 'root')[0]['31.output'],
+                         lengths[0]['30.output'] + 1)
+
+    def test_benchmark(self):
+        """ Furthest and closest outputs of a 500 protocols project, without
+        enumerating the paths and sorting the graph only once. """
+        graph = createOutputsGraph(500)
+        tracker = UsedItemsTracker()
+        noPaths = AssertionError("the paths must not be enumerated")
+        with mock.patch.object(nx, 'all_simple_paths', side_effect=noPaths), \
+                mock.patch.object(nx, 'all_shortest_paths', side_effect=noPaths), \
+                mock.patch.object(nx, 'topological_sort', wraps=nx.topological_sort) as sort:
+            furthest = tracker.getFurthestCodesFromNode(graph, 'root', [('objType', 'SetOfParticles')])
+            closest = tracker.getClosestCodesFromNode(graph, 'root', [('objType', 'SetOfCTF')])
+            usedCTFs = tracker.getFurthestCodesFromNode(graph, furthest[0], [('objType', 'SetOfCTF')], dir='up')
+            longest = tracker.getLongestPath(graph, 'root', furthest[0])
+        self.assertEqual(sort.call_count, 1)
+
+        depth = len(nx.dag_longest_path(graph))
+        self.assertEqual(len(longest), depth)
+        self.assertEqual(closest, ['3.output'])
+        for code in usedCTFs:
+            self.assertTrue(nx.has_path(graph, code, furthest[0]))
+
+
+class TestUsedItemsSets(pwtests.BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestOutput(cls)
+
+    def createParticles(self, name, ids, micIds=None):
+        particles = SetOfParticles(filename=self.getOutputPath(name + '.sqlite'))
+        particles.setSamplingRate(1.5)
+        for i in ids:
+            part = Particle(location=(i, 'particles.mrcs'))
+            part.setObjId(i)
+            if micIds is not None:
+                part.setMicId(micIds[i])
+            particles.append(part)
+        particles.write()
+        return particles
+
+    def createClasses(self, name, particles):
+        classes = SetOfClasses2D(filename=self.getOutputPath(name + '.sqlite'))
+        classes.setImages(particles)
+        for classId, partIds in [(1, [2, 4]), (2, []), (3, [1, 5, 7, 9])]:
+            newClass = Class2D()
+            newClass.setObjId(classId)
+            classes.append(newClass)
+            newClass.enableAppend()
+            for partId in partIds:
+                part = Particle(location=(partId, 'particles.mrcs'))
+                part.setObjId(partId)
+                part.setSamplingRate(1.5)
+                newClass.append(part)
+            classes.update(newClass)
+        classes.write()
+        return classes
+
+    def createTracker(self):
+        tracker = UsedItemsTracker()
+        tracker.workingDir.set(self.getOutputPath())
+        return tracker
+
+    def test_unused(self):
+        """ Particles of the original sets not used, each of them only once. """
+        used = self.createParticles('used', [2, 4, 6])
+        originals = [self.createParticles('original1', range(1, 9)),
+                     self.createParticles('original2', [7, 8, 9])]
+        tracker = self.createTracker()
+        self.assertEqual(tracker.joinParticleSetsIds(originals).tolist(), list(range(1, 10)))
+
+        notUsed = tracker.getUnused([used], originals)
+        self.assertEqual([p.getObjId() for p in notUsed], [1, 3, 5, 7, 8, 9])
+        self.assertEqual([p.getIndex() for p in notUsed], [1, 3, 5, 7, 8, 9])
+        self.assertEqual(notUsed.getSamplingRate(), 1.5)
+
+    def test_counts(self):
+        """ Particles per micrograph and per class read from the sqlite. """
+        mics = SetOfMicrographs(filename=self.getOutputPath('mics.sqlite'))
+        mics.setSamplingRate(1.5)
+        for i in range(1, 4):
+            mic = Micrograph(location='mic%d.mrc' % i)
+            mic.setObjId(i)
+            mics.append(mic)
+        mics.write()
+        particles = self.createParticles('micParticles', range(1, 8),
+                                         micIds={1: 1, 2: 1, 3: 3, 4: 1, 5: 3, 6: 5, 7: 3})
+        tracker = self.createTracker()
+        tracker.micDic = tracker.buildMicDic([mics])
+        self.assertEqual(tracker.micDic, {1: 'mic1.mrc', 2: 'mic2.mrc', 3: 'mic3.mrc'})
+        micCountDic, nMicDic = tracker.countParticlesPerMic(particles)
+        self.assertEqual(micCountDic, {'mic1.mrc': 3, 'mic2.mrc': 0, 'mic3.mrc': 3})
+        self.assertEqual(nMicDic, {1: 'mic1.mrc', 3: 'mic3.mrc'})
+
+        classes = self.createClasses('classes', particles)
+        classDic = tracker.buildClassesDic([classes])
+        self.assertEqual(classDic[0].tolist(), [1, 2, 4, 5, 7, 9])
+        self.assertEqual(classDic[1].tolist(), [3, 1, 1, 3, 3, 3])
+        self.assertEqual(tracker.countParticlesPerClass(particles, classDic), {1: 2, 3: 3})
+
+    def test_bulkCopy(self):
+        """ Output classes and CTFs copied from the input sqlite tables. """
+        particles = self.createParticles('classParticles', range(1, 10))
+        tracker = self.createTracker()
+        tracker.classes2DCountDic = {1: 2, 3: 3}
+        usedClasses, notUsedClasses = tracker.getUsedClasses2D(
+            [self.createClasses('inputClasses', particles)], particles)
+        self.assertEqual([(cl.getObjId(), cl.getSize()) for cl in usedClasses], [(1, 2), (3, 4)])
+        self.assertEqual([(cl.getObjId(), cl.getSize()) for cl in notUsedClasses], [(2, 0)])
+        self.assertEqual([p.getObjId() for p in usedClasses[3]], [1, 5, 7, 9])
+        self.assertEqual(readSetIds(usedClasses[3]).tolist(), [1, 5, 7, 9])
+        self.assertEqual(usedClasses[1].getSamplingRate(), 1.5)
+
+        # the CTFs take the id of their micrograph, once per micrograph, and
+        # the CTF of a micrograph not used (mic7) is skipped, even if its id
+        # is the id of a used micrograph
+        ctfs = SetOfCTF(filename=self.getOutputPath('inputCtfs.sqlite'))
+        for ctfId, micNum in [(30, 7), (31, 3), (32, 5), (33, 3)]:
+            mic = Micrograph(location='mic%d.mrc' % micNum)
+            ctf = CTFModel()
+            ctf.setStandardDefocus(12000 + ctfId, 10000, 30)
+            ctf.setMicrograph(mic)
+            ctf.setObjId(ctfId)
+            ctfs.append(ctf)
+        ctfs.write()
+        tracker.micDic = {30: 'mic3.mrc', 50: 'mic5.mrc'}
+        outputCTF = tracker.buildSetOfCTF(ctfs, [ctfs])
+        self.assertEqual([(ctf.getObjId(), ctf.getDefocusU(), ctf.getMicrograph().getFileName())
+                          for ctf in outputCTF],
+                         [(30, 12031, 'mic3.mrc'), (50, 12032, 'mic5.mrc')])